@@ -38,13 +38,15 @@ INSTALLED_APPS = [
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
+    # Before staticfiles and channels, so its runserver command (which
+    # compresses the large websocket messages) takes precedence.
+    'chatrooms',
     'django.contrib.staticfiles',
     'channels',
     'channels_redis',
     'bootstrap4',
     'rest_framework',
     'rest_framework.authtoken',
-    'chatrooms',
 ]
 
 MIDDLEWARE = [
@@ -62,7 +64,7 @@ REST_FRAMEWORK = {
         'rest_framework.renderers.JSONRenderer',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'channels_authtoken.CachedTokenAuthentication',
     ]
 }
 
@@ -96,6 +98,142 @@ CHANNEL_LAYERS = {
 }
 
 
+# Token lookups cache, for both websocket and REST authentication. Tokens are
+# kept up to `ttl` seconds, and explicitly forgotten on logout. By default, they
+# are kept in memory, which is only accurate when running a single server process
+# (other processes would accept a logged out token until it expires). To run several
+# server processes, give a Django cache alias (e.g. of a Redis cache) in `cache_alias`:
+# the tokens are then only kept there, shared among all the server processes.
+CHANNELS_AUTHTOKEN_CACHE = {
+    'max_size': 10000,
+    'ttl': 30,
+}
+
+
+# Presence tracking: which users are connected, and which ones are in each room.
+# The default backend tracks them in memory, which is only accurate when running
+# a single server process. To run several server processes, track them in Redis:
+# {
+#     'BACKEND': 'chatrooms.presence.RedisPresence',
+#     'CONFIG': {'host': 'redis://:%s@redis:6379/1' % (os.environ['REDIS_PASSWORD'],), 'ttl': 30},
+# }
+CHATROOMS_PRESENCE = {
+    'BACKEND': 'chatrooms.presence.LocalPresence',
+}
+
+
+# Recent messages buffers: the latest messages of each room, given to the users
+# when joining the room, without querying the database. The default backend keeps
+# them in memory, which is only accurate when running a single server process. To
+# run several server processes (and keep them across restarts), keep them in Redis:
+# {
+#     'BACKEND': 'chatrooms.history.RedisRecentMessages',
+#     'CONFIG': {'host': 'redis://:%s@redis:6379/1' % (os.environ['REDIS_PASSWORD'],)},
+# }
+CHATROOMS_RECENT_MESSAGES = {
+    'BACKEND': 'chatrooms.history.LocalRecentMessages',
+}
+
+
+# Chat messages write-behind. When set, chat messages are broadcast right away
+# and inserted later, in bulk (when a batch of `max_batch` messages is complete
+# or `flush_interval` seconds elapsed). At most `max_buffer` messages are kept
+# in memory before forcing a flush (if the database is not available, the oldest
+# one is dropped). Messages rejected by the database are logged and dropped. When
+# empty, each message is inserted before being broadcast.
+# Example: {'max_batch': 500, 'flush_interval': 0.25, 'max_buffer': 10000}
+CHATROOMS_WRITE_BEHIND = None
+
+
+# JSON encoding of the websocket messages: by default, the standard library is used,
+# and the frames are the same ones the chat always sent. When True, the orjson library
+# is used (if installed) instead: it is several times faster, and its frames are
+# smaller (compact separators, non-ASCII characters not escaped), but not the same
+# bytes. Any JSON client reads both. Enable it once no client depends on the bytes.
+CHATROOMS_FAST_JSON = False
+
+
+# Outbound queues: while the write buffer of a connection is full (its client is not
+# reading fast enough), the frames to send it are queued, up to `high_water` frames.
+# Then the `policy` decides what to do: 'drop-oldest' (drop the oldest pending frame),
+# 'coalesce-presence' (drop superseded joined/parted frames first) or 'disconnect'
+# (close the client's connection with a "slow-consumer" fatal code). It is applied by
+# the websocket protocol of the `runserver` command. When empty, frames are never
+# queued nor dropped (the server buffers them all).
+
+CHATROOMS_OUTBOUND_QUEUE = {
+    'high_water': 1000,
+    'policy': 'drop-oldest',
+}
+
+
+# Websocket compression: permessage-deflate is negotiated with the clients offering
+# it (e.g. browsers), and only the messages of at least `threshold` bytes (e.g. the
+# join status, with the room history and users) are compressed. Each compressing
+# connection keeps a deflate context: `no_context_takeover` (True to compress each
+# message by itself), `window_bits` (8 to 15) and `mem_level` (1 to 9) trade the
+# compression ratio for less memory per connection. When empty, it is disabled.
+CHATROOMS_COMPRESSION = {
+    'threshold': 1024,
+}
+
+
+# Rate limits of the websocket commands, per user, as token buckets: each command
+# type may have a rule allowing `capacity` commands, refilled over `per` seconds
+# (and tracked per room, if `per_room`). Commands without a rule are not limited.
+# Staff users (e.g. the bot accounts, which join every room and answer each asked
+# asset in a separate message) are not limited, unless EXEMPT_STAFF is False.
+# The default backend keeps the buckets in memory, which is only accurate when
+# running a single server process. To run several server processes, keep them in
+# Redis (with the same RULES):
+# {
+#     'BACKEND': 'chatrooms.ratelimit.RedisRateLimiter',
+#     'CONFIG': {'host': 'redis://:%s@redis:6379/1' % (os.environ['REDIS_PASSWORD'],)},
+# }
+CHATROOMS_RATE_LIMITS = {
+    'BACKEND': 'chatrooms.ratelimit.LocalRateLimiter',
+    'EXEMPT_STAFF': True,
+    'RULES': {
+        'message': {'capacity': 20, 'per': 10, 'per_room': True},
+        'custom': {'capacity': 20, 'per': 10, 'per_room': True},
+        'join': {'capacity': 20, 'per': 60},
+        'part': {'capacity': 20, 'per': 60},
+        'history': {'capacity': 30, 'per': 60, 'per_room': True},
+        'search': {'capacity': 10, 'per': 60},
+        'list': {'capacity': 30, 'per': 60},
+    },
+}
+
+
+# Slow commands: the websocket commands, and the broadcast handlers, taking at least
+# `slow_threshold` seconds are logged (as JSON) with the time spent in the database and
+# in the channel layer, and the size of the incoming frame. Optionally, a `profile_rate`
+# fraction of them (e.g. 0.01) are profiled with cProfile, and the stats are dumped
+# as pstats files into `profile_dir`. Keep the profiling disabled (0) in production,
+# unless it is being investigated.
+CHATROOMS_PROFILING = {
+    'slow_threshold': 0.5,
+    'profile_rate': 0,
+    'profile_dir': os.path.join(BASE_DIR, 'profiles'),
+}
+
+
+# Metrics: the /metrics endpoint is only served to these client addresses or networks
+# (e.g. the Prometheus server's, or '172.16.0.0/12' for a docker network). When empty,
+# the endpoint is disabled (not found).
+CHATROOMS_METRICS_ALLOWED_IPS = []
+
+
+# Message retention: the messages older than this amount of days are deleted (unless
+# the room sets its own retention days). When empty, the messages are kept forever.
+# The message table is partitioned by month, with no default partition: run the
+# `partition_messages` command daily (as the `maintenance` compose service does, or
+# from cron) to create the partitions of the coming months, purge the expired
+# messages, and detach (or, with --archive-dir, dump and drop) the partitions only
+# holding expired messages. Missing partitions are also created on demand.
+CHATROOMS_MESSAGE_RETENTION_DAYS = None
+
+
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
@@ -2,7 +2,9 @@ import urllib.parse
 from django.contrib.auth.models import AnonymousUser
 from channels.db import database_sync_to_async
 from channels.auth import AuthMiddlewareStack
-from rest_framework.authtoken.models import Token
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from .cache import token_cache
 import logging
 
 
@@ -11,11 +13,25 @@ logger = logging.getLogger(__name__)
 
 @database_sync_to_async
 def get_user(token_key):
-    try:
-        token = Token.objects.get(key=token_key)
-        return token.user
-    except Token.DoesNotExist:
-        return AnonymousUser()
+    token = token_cache.get(token_key)
+    return token.user if token else AnonymousUser()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    The same REST token authentication, but looking the tokens
+      up in the same cache used by the websocket connections.
+    """
+
+    def authenticate_credentials(self, key):
+        token = token_cache.get(key)
+        if token is None:
+            raise exceptions.AuthenticationFailed('Invalid token.')
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+
+        return (token.user, token)
 
 
 class TokenAuthMiddleware:
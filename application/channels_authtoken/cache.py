@@ -0,0 +1,126 @@
+import collections
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.authtoken.models import Token
+
+
+class TokenCache:
+    """
+    A cache of token key => token (with its user already
+      loaded), where each entry lives up to `ttl` seconds.
+      By default, it is a bounded LRU cache in memory, which
+      is only accurate when running a single server process.
+      To run several server processes, a Django cache (e.g.
+      one using Redis) may be given, shared among them all:
+      then, the tokens are only kept there, so a token being
+      invalidated is forgotten by all the processes at once.
+
+    Entries are invalidated explicitly when a token is
+      destroyed.
+    """
+
+    def __init__(self, max_size=10000, ttl=30, cache_alias=None, prefix='channels_authtoken:'):
+        """
+        :param max_size: The maximum amount of tokens kept locally.
+        :param ttl: The time, in seconds, the tokens are cached.
+        :param cache_alias: An optional Django cache alias to keep
+          the tokens in, instead of in memory.
+        :param prefix: The prefix of the keys in the shared tier.
+        """
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache_alias = cache_alias
+        self.prefix = prefix
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias] if self.cache_alias else None
+
+    def get(self, key):
+        """
+        Gets a token, loading it (and its user) in a single query
+          on a cache miss. This method performs queries, so it
+          must be run in a sync context.
+        :param key: The token key.
+        :return: The token, or None if it does not exist.
+        """
+
+        shared = self.shared
+        if shared:
+            token = shared.get(self.prefix + key)
+            if token is None:
+                token = self._load(key)
+                if token is not None:
+                    shared.set(self.prefix + key, token, self.ttl)
+            return token
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                token, expiration = entry
+                if expiration > now:
+                    self._entries.move_to_end(key)
+                    return token
+                del self._entries[key]
+
+        token = self._load(key)
+        if token is None:
+            return None
+        with self._lock:
+            self._entries[key] = (token, now + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return token
+
+    @staticmethod
+    def _load(key):
+        """
+        Loads a token, and its user, in a single query.
+        :param key: The token key.
+        :return: The token, or None if it does not exist.
+        """
+
+        try:
+            return Token.objects.select_related('user').get(key=key)
+        except Token.DoesNotExist:
+            return None
+
+    def invalidate(self, key):
+        """
+        Forgets a token, in this process and in the shared cache.
+        :param key: The token key.
+        """
+
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.shared:
+            self.shared.delete(self.prefix + key)
+
+
+token_cache = TokenCache(**getattr(settings, 'CHANNELS_AUTHTOKEN_CACHE', {}))
+
+
+def on_session_destroyed(sender, **kwargs):
+    """
+    This handler is invoked when a token session is destroyed.
+    :param sender: The session token being destroyed.
+    """
+
+    token_cache.invalidate(sender.key)
+
+
+def on_token_deleted(sender, instance, **kwargs):
+    """
+    This handler is invoked when a token is deleted.
+    :param sender: Token class.
+    :param instance: A Token instance.
+    """
+
+    token_cache.invalidate(instance.key)
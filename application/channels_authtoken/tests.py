@@ -0,0 +1,79 @@
+import pytest
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from rest_framework.authtoken.models import Token
+from .cache import TokenCache
+
+
+@pytest.fixture()
+def token():
+    """
+    Fixture for a token.
+    :return: The token of a new user.
+    """
+
+    user = User.objects.create_user('tokened', 'tokened@example.org', 'tokenedtokened$12345')
+    return Token.objects.create(user=user)
+
+
+@pytest.mark.django_db
+def test_token_cache(token, django_assert_num_queries):
+    """
+    Tests the in-memory token cache: tokens are loaded, with
+      their users, in a single query, and then cached until
+      they expire or are invalidated.
+    """
+
+    cache = TokenCache(max_size=2, ttl=30)
+    with django_assert_num_queries(1):
+        assert cache.get(token.key).user.username == 'tokened'
+    with django_assert_num_queries(0):
+        assert cache.get(token.key).user.username == 'tokened'
+    # Unknown tokens are not cached.
+    with django_assert_num_queries(2):
+        assert cache.get('unknown') is None
+        assert cache.get('unknown') is None
+    # Invalidated tokens are loaded again.
+    key = token.key
+    token.delete()
+    cache.invalidate(key)
+    with django_assert_num_queries(1):
+        assert cache.get(key) is None
+
+
+@pytest.mark.django_db
+def test_token_cache_expiration(token, django_assert_num_queries):
+    """
+    Tests that the cached tokens expire, and that only the most
+      recently used ones are kept.
+    """
+
+    expired = TokenCache(ttl=0)
+    expired.get(token.key)
+    with django_assert_num_queries(1):
+        expired.get(token.key)
+    other = Token.objects.create(user=User.objects.create_user('other', 'other@example.org', 'otherother$12345'))
+    bounded = TokenCache(max_size=1, ttl=30)
+    bounded.get(token.key)
+    bounded.get(other.key)
+    with django_assert_num_queries(1):
+        bounded.get(token.key)
+
+
+@pytest.mark.django_db
+def test_token_cache_shared(token, django_assert_num_queries):
+    """
+    Tests the shared token cache: a token invalidated by a
+      process is forgotten by the others at once.
+    """
+
+    caches['default'].clear()
+    first, second = TokenCache(cache_alias='default'), TokenCache(cache_alias='default')
+    with django_assert_num_queries(1):
+        assert first.get(token.key).user.username == 'tokened'
+        assert second.get(token.key).user.username == 'tokened'
+    key = token.key
+    token.delete()
+    first.invalidate(key)
+    with django_assert_num_queries(1):
+        assert second.get(key) is None
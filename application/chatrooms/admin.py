@@ -1,5 +1,24 @@
 from django.contrib.admin import site, ModelAdmin, TabularInline
+from django.forms.models import BaseInlineFormSet
+from django.utils.html import format_html
+from .changelists import EstimatedCountPaginator, KeysetChangeList
 from .models import Room, Message
+from .search import matching
+
+
+class LatestMessagesFormSet(BaseInlineFormSet):
+    """
+    Only takes the latest `limit` messages of the room, with a
+      bounded (LIMIT) query on the room index, instead of all the
+      messages of the room.
+    """
+
+    limit = 50
+
+    def get_queryset(self):
+        if not hasattr(self, '_queryset'):
+            self._queryset = self.queryset.select_related('user').order_by('-created_on', '-id')[:self.limit]
+        return self._queryset
 
 
 class RoomAdmin(ModelAdmin):
@@ -13,6 +32,9 @@ class RoomAdmin(ModelAdmin):
         """
 
         model = Message
+        formset = LatestMessagesFormSet
+        fields = ["created_on", "user", "content"]
+        readonly_fields = ["created_on", "user", "content"]
 
         def has_add_permission(self, request, obj):
             return False
@@ -23,24 +45,44 @@ class RoomAdmin(ModelAdmin):
         def has_delete_permission(self, request, obj=None):
             return False
 
-        max_num = 50
         extra = 0
-        ordering = ["-created_on"]
 
-    list_display = ["created_on", "updated_on", "name"]
+    list_display = ["created_on", "updated_on", "name", "retention_days"]
     ordering = ["name"]
     inlines = [InlineMessageAdmin]
 
 
 class MessageAdmin(ModelAdmin):
     """
-    Allows a lookup of a message by its content.
+    Allows a lookup of a message by its content, by means of
+      the full-text index (see the search module). The list is
+      paged by keyset, newest first, and its total is estimated,
+      so it stays fast on huge tables. It may be filtered by
+      room or user, both served by their indexes.
     """
 
-    list_display = ["created_on", "user", "room", "content"]
+    list_display = ["created_on", "author", "room", "content"]
     list_display_links = ["created_on"]
+    list_filter = ["room"]
+    list_select_related = ["user", "room"]
     search_fields = ["content"]
-    ordering = ["created_on"]
+    ordering = ["-created_on", "-id"]
+    sortable_by = []
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def author(self, obj):
+        return format_html('<a href="?user__id__exact={}">{}</a>', obj.user_id, obj.user)
+    author.short_description = "user"
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        return matching(queryset, search_term), False
 
     def has_add_permission(self, request):
         return False
@@ -51,4 +93,4 @@ class MessageAdmin(ModelAdmin):
 
 # Register your models here.
 site.register(Room, RoomAdmin)
-site.register(Message, MessageAdmin)
\ No newline at end of file
+site.register(Message, MessageAdmin)
@@ -1,8 +1,13 @@
+from django.http import StreamingHttpResponse
+from django.utils import timezone
 from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.generics import CreateAPIView
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from .export import EXPORT_FORMATS, export_room, parse_bound
+from .models import Room
 from .serializers import UserCreateSerializer, UserLoginSerializer
 from .signals import session_destroyed
 import logging
@@ -69,3 +74,36 @@ class UserLogoutView(APIView):
         session_destroyed.send(sender=token)
         token.delete()
         return Response(status=204)
+
+
+class RoomExportView(APIView):
+    """
+    Exports the transcript of a room, as NDJSON or CSV (by the
+      URL suffix), optionally in a date range (by the `since`
+      and `until` query parameters). It is streamed, as it is
+      read from the database. Only for staff users.
+    """
+
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, room_name, export_format, *args, **kwargs):
+        if export_format not in EXPORT_FORMATS:
+            raise NotFound("Unknown export format: %s" % export_format)
+        bounds = {}
+        for key in ('since', 'until'):
+            value = request.query_params.get(key)
+            try:
+                bounds[key] = parse_bound(value) if value else None
+            except ValueError as e:
+                raise ValidationError({key: str(e)})
+        room = Room.objects.filter(name=room_name).first()
+        if room is None:
+            raise NotFound("Room does not exist: %s" % room_name)
+
+        logger.info("Export of room %s by user %d" % (room_name, request.user.id))
+        response = StreamingHttpResponse(export_room(room, export_format, bounds['since'], bounds['until']),
+                                         content_type=EXPORT_FORMATS[export_format])
+        response['Content-Disposition'] = 'attachment; filename="%s-%s.%s"' % (
+            room_name, timezone.now().strftime('%Y%m%d%H%M%S'), export_format
+        )
+        return response
@@ -1,5 +1,25 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_save, post_delete
 
 
 class ChatroomsConfig(AppConfig):
     name = 'chatrooms'
+
+    def ready(self):
+        from rest_framework.authtoken.models import Token
+        from channels_authtoken.cache import on_session_destroyed, on_token_deleted
+        from .history import on_message_deleted
+        from .models import Room, Message
+        from .registry import on_room_saved, on_room_deleted
+        from .signals import session_destroyed
+
+        # Keep the in-process room registry up to date.
+        post_save.connect(on_room_saved, sender=Room, dispatch_uid='on_room_saved')
+        post_delete.connect(on_room_deleted, sender=Room, dispatch_uid='on_room_deleted')
+
+        # Drop the recent messages buffers holding deleted messages.
+        post_delete.connect(on_message_deleted, sender=Message, dispatch_uid='on_message_deleted')
+
+        # Forget the cached tokens when their sessions end.
+        session_destroyed.connect(on_session_destroyed, dispatch_uid='on_token_session_destroyed')
+        post_delete.connect(on_token_deleted, sender=Token, dispatch_uid='on_token_deleted')
@@ -0,0 +1,406 @@
+"""
+Load benchmarks for the chat consumer. They are not part of the regular
+  test suite, and must be explicitly run (from the application directory,
+  with the same services the unit tests need):
+
+    $ python -m pytest chatrooms/benchmarks.py -s
+
+The benchmarks simulate users joining rooms and chatting at a given rate,
+  and measure throughput, delivery and join latencies, and queries per
+  operation. They are configured via environment variables:
+
+ - BENCH_USERS: The amount of simulated users (default: 20).
+ - BENCH_ROOMS: The amount of rooms the users are spread into (default: 4).
+ - BENCH_MESSAGES: The amount of messages each user sends (default: 20).
+ - BENCH_RATE: The messages per second each user sends (default: 10).
+ - BENCH_LAYERS: A comma-separated list of channel layers to run the
+   benchmark with: "memory" and/or "redis" (default: "memory,redis").
+ - BENCH_REDIS_URL: The Redis server for the "redis" layer (default:
+   the one in the channel layer settings).
+ - BENCH_OUTPUT: The directory to store the JSON results in (default:
+   "bench_results"). Each result is tagged with the current commit,
+   so runs can be compared across commits.
+ - BENCH_COMPRESSION_THRESHOLDS: A comma-separated list of compression
+   thresholds (in bytes) to measure the websocket compression CPU time
+   versus bandwidth trade-off with (default: "0,256,1024,4096").
+ - BENCH_CODEC_ROUNDS: How many times the JSON codec benchmark encodes
+   and decodes the sample messages (default: 200).
+"""
+
+import asyncio
+import datetime
+import json
+import os
+import subprocess
+import random
+import time
+import pytest
+from autobahn.websocket.compress import PerMessageDeflate
+from django.conf import settings as django_settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from channels.db import database_sync_to_async
+from .codecs import JsonCodec, json_codec
+from .history import HISTORY_PAGE_SIZE
+from .models import Room
+from .tests import make_communicator, attempt_login, attempt_register
+
+
+BENCH_USERS = int(os.environ.get('BENCH_USERS', 20))
+BENCH_ROOMS = int(os.environ.get('BENCH_ROOMS', 4))
+BENCH_MESSAGES = int(os.environ.get('BENCH_MESSAGES', 20))
+BENCH_RATE = float(os.environ.get('BENCH_RATE', 10))
+BENCH_LAYERS = [layer for layer in os.environ.get('BENCH_LAYERS', 'memory,redis').split(',') if layer]
+BENCH_OUTPUT = os.environ.get('BENCH_OUTPUT', 'bench_results')
+BENCH_COMPRESSION_THRESHOLDS = [
+    int(threshold) for threshold in os.environ.get('BENCH_COMPRESSION_THRESHOLDS', '0,256,1024,4096').split(',')
+    if threshold
+]
+BENCH_CODEC_ROUNDS = int(os.environ.get('BENCH_CODEC_ROUNDS', 200))
+
+
+def channel_layer_settings(layer):
+    """
+    Builds the CHANNEL_LAYERS setting for a benchmark.
+    :param layer: Either "memory" or "redis".
+    :return: The setting value.
+    """
+
+    if layer == 'memory':
+        return {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 1000}}}
+    hosts = [os.environ['BENCH_REDIS_URL']] if os.environ.get('BENCH_REDIS_URL') else \
+        django_settings.CHANNEL_LAYERS['default']['CONFIG']['hosts']
+    return {'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer',
+                        'CONFIG': {'hosts': hosts, 'capacity': 1000, 'prefix': 'bench'}}}
+
+
+class QueryCounter:
+    """
+    Counts the queries run in any thread, while active. Since
+      the connections used by database_sync_to_async are opened
+      (and closed) on demand, the counter is installed in each
+      new connection as well.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def _install(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        for connection in connections.all():
+            connection.execute_wrappers.append(self)
+        connection_created.connect(self._install, weak=False)
+        return self
+
+    def __exit__(self, *args):
+        connection_created.disconnect(self._install)
+        for connection in connections.all():
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+def percentiles(values):
+    """
+    Summarizes a list of latencies.
+    :param values: The latencies, in seconds.
+    :return: A dict with the p50, p95, p99 and max latencies,
+      in milliseconds.
+    """
+
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    values = sorted(values)
+
+    def at(fraction):
+        return round(values[min(len(values) - 1, int(fraction * len(values)))] * 1000, 3)
+
+    return {"p50": at(0.50), "p95": at(0.95), "p99": at(0.99), "max": round(values[-1] * 1000, 3)}
+
+
+def current_commit():
+    """
+    :return: The current commit hash, or None if unknown.
+    """
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def prepare_users_and_rooms():
+    """
+    Creates (if needed) and logs in the benchmark users, and
+      creates (if needed) the benchmark rooms.
+    :return: A (tokens, room names) tuple.
+    """
+
+    room_names = ['bench-room-%d' % index for index in range(BENCH_ROOMS)]
+    for room_name in room_names:
+        await database_sync_to_async(Room.objects.get_or_create)(name=room_name)
+    tokens = []
+    for index in range(BENCH_USERS):
+        username = 'bench_user_%d' % index
+        password = username * 2 + '$12345'
+        await attempt_register(username, password, username + '@example.org')
+        tokens.append(await attempt_login(username, password))
+    return tokens, room_names
+
+
+async def run_benchmark(tokens, room_names):
+    """
+    Runs the benchmark: every user connects and joins a room
+      (in round robin), then every user sends messages at the
+      configured rate while receiving all the messages of its
+      room.
+    :param tokens: The tokens of the users.
+    :param room_names: The names of the rooms.
+    :return: The results.
+    """
+
+    members = {room_name: 0 for room_name in room_names}
+    communicators = []
+    for index, token in enumerate(tokens):
+        communicator = make_communicator(token)
+        connected, _ = await communicator.connect()
+        assert connected
+        motd = await communicator.receive_json_from()
+        assert motd['code'] == 'api-motd'
+        room_name = room_names[index % len(room_names)]
+        members[room_name] += 1
+        communicators.append((communicator, room_name))
+
+    async def join(communicator, room_name):
+        started = time.perf_counter()
+        await communicator.send_json_to({'type': 'join', 'room_name': room_name})
+        while True:
+            notification = await communicator.receive_json_from(timeout=30)
+            if notification.get('code') == 'joined' and notification.get('you'):
+                return time.perf_counter() - started
+
+    with QueryCounter() as join_queries:
+        join_latencies = await asyncio.gather(*(join(communicator, room_name) for communicator, room_name in communicators))
+
+    delivery_latencies = []
+    missing = 0
+
+    async def chat(communicator, room_name, index):
+        for sequence in range(BENCH_MESSAGES):
+            await communicator.send_json_to({'type': 'message', 'room_name': room_name,
+                                             'body': 'bench %d %d %r' % (index, sequence, time.perf_counter())})
+            await asyncio.sleep(1 / BENCH_RATE)
+
+    async def listen(communicator, room_name):
+        nonlocal missing
+        expected = members[room_name] * BENCH_MESSAGES
+        while expected:
+            try:
+                notification = await communicator.receive_json_from(timeout=30)
+            except asyncio.TimeoutError:
+                missing += expected
+                return
+            if notification.get('code') == 'message':
+                delivery_latencies.append(time.perf_counter() - float(notification['body'].split()[3]))
+                expected -= 1
+
+    with QueryCounter() as message_queries:
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            [chat(communicator, room_name, index) for index, (communicator, room_name) in enumerate(communicators)] +
+            [listen(communicator, room_name) for communicator, room_name in communicators]
+        ))
+        elapsed = time.perf_counter() - started
+
+    for communicator, _ in communicators:
+        await communicator.disconnect()
+
+    sent = len(communicators) * BENCH_MESSAGES
+    return {
+        "messages_sent": sent,
+        "messages_per_second": round(sent / elapsed, 3),
+        "deliveries": len(delivery_latencies),
+        "deliveries_per_second": round(len(delivery_latencies) / elapsed, 3),
+        "missing_deliveries": missing,
+        "delivery_latency_ms": percentiles(delivery_latencies),
+        "join_latency_ms": percentiles(join_latencies),
+        "queries_per_join": round(join_queries.count / len(communicators), 3),
+        "queries_per_message": round(message_queries.count / sent, 3) if sent else None,
+    }
+
+
+def sample_messages():
+    """
+    Builds the messages a connection typically receives: a join
+      status (with a full page of history and all the users),
+      and then the chat messages of the room.
+    :return: The messages.
+    """
+
+    words = ['stock', 'price', 'market', 'buy', 'sell', 'today', 'rally', 'dip', 'hold', 'forex', 'aapl.us', 'nice']
+    stamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def body():
+        return ' '.join(random.choice(words) for _ in range(random.randint(3, 20)))
+
+    joined = {
+        "type": "room:notification", "code": "joined", "you": True, "user": "bench_user_0",
+        "room_name": "bench-room-0", "stamp": stamp,
+        "status": {
+            "users": [{"name": "bench_user_%d" % index, "you": not index} for index in range(BENCH_USERS)],
+            "messages": [{"stamp": stamp, "user": "bench_user_%d" % random.randrange(BENCH_USERS), "body": body(),
+                          "you": False} for _ in range(HISTORY_PAGE_SIZE)],
+            "before": "MjAyMC0wOS0yNlQxMjoxMjoxMyswMDowMHwxMjM0NQ=="
+        }
+    }
+    return [joined] + [{
+        "type": "room:notification", "code": "message", "you": False,
+        "user": "bench_user_%d" % random.randrange(BENCH_USERS), "room_name": "bench-room-0",
+        "body": body(), "stamp": stamp, "seq": seq
+    } for seq in range(BENCH_MESSAGES * BENCH_USERS)]
+
+
+def measure_codec(codec, messages, rounds):
+    """
+    Encodes and decodes a list of messages with a codec.
+    :param codec: The codec to measure.
+    :param messages: The messages to encode and decode.
+    :param rounds: How many times to encode and decode them.
+    :return: The bytes and the time spent per message.
+    """
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        frames = [codec.encode(message) for message in messages]
+    encoded = time.perf_counter()
+    for _ in range(rounds):
+        for frame in frames:
+            codec.decode(frame)
+    decoded = time.perf_counter()
+    count = len(messages) * rounds
+    return {
+        "messages": len(messages),
+        "bytes": sum(len(frame) for frame in frames),
+        "encode_us": round((encoded - started) * 1e6 / count, 3),
+        "decode_us": round((decoded - encoded) * 1e6 / count, 3),
+    }
+
+
+def measure_compression(frames, threshold, no_context_takeover):
+    """
+    Compresses a stream of frames like the server would, with
+      the same permessage-deflate implementation.
+    :param frames: The frames, as bytes.
+    :param threshold: The minimum size of a frame to compress it.
+    :param no_context_takeover: Whether each frame is compressed
+      by itself, instead of sharing the deflate context.
+    :return: The bytes and CPU time spent.
+    """
+
+    deflate = PerMessageDeflate(True, no_context_takeover, False, 0, 0, None)
+    original = sent = 0
+    started = time.process_time()
+    for frame in frames:
+        original += len(frame)
+        if len(frame) >= threshold:
+            deflate.start_compress_message()
+            sent += len(deflate.compress_message_data(frame) + deflate.end_compress_message())
+        else:
+            sent += len(frame)
+    cpu_time = time.process_time() - started
+    return {
+        "threshold": threshold,
+        "no_context_takeover": no_context_takeover,
+        "original_bytes": original,
+        "sent_bytes": sent,
+        "ratio": round(sent / original, 4),
+        "cpu_ms": round(cpu_time * 1000, 3),
+        "cpu_us_per_saved_kb": round(cpu_time * 1e6 / ((original - sent) / 1024), 3) if original > sent else None,
+    }
+
+
+def store_report(report, name):
+    """
+    Stores (and prints) the results of a benchmark.
+    :param report: The results, tagged with the commit.
+    :param name: A name to tell the results apart.
+    """
+
+    os.makedirs(BENCH_OUTPUT, exist_ok=True)
+    path = os.path.join(BENCH_OUTPUT, '%s-%s-%s.json' % (
+        datetime.datetime.now().strftime('%Y%m%d%H%M%S'), (report["commit"] or 'unknown')[:8], name
+    ))
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('layer', BENCH_LAYERS)
+async def test_chat_load(layer, settings):
+    """
+    Benchmarks the chat consumer with a given channel layer,
+      and stores the results.
+    """
+
+    settings.CHANNEL_LAYERS = channel_layer_settings(layer)
+    # The simulated users chat faster than the default rate limits allow.
+    settings.CHATROOMS_RATE_LIMITS = dict(getattr(django_settings, 'CHATROOMS_RATE_LIMITS', None) or {}, RULES={})
+    tokens, room_names = await prepare_users_and_rooms()
+    results = await run_benchmark(tokens, room_names)
+    report = {
+        "commit": current_commit(),
+        "date": datetime.datetime.now().isoformat(),
+        "layer": layer,
+        "config": {"users": BENCH_USERS, "rooms": BENCH_ROOMS, "messages": BENCH_MESSAGES, "rate": BENCH_RATE},
+        "results": results,
+    }
+    store_report(report, layer)
+    assert results["missing_deliveries"] == 0
+
+
+def test_compression_tradeoff():
+    """
+    Benchmarks the websocket compression: the CPU time spent versus
+      the bytes saved, for each threshold, with and without sharing
+      the deflate context among the frames of a connection.
+    """
+
+    frames = [json_codec.encode(message) for message in sample_messages()]
+    report = {
+        "commit": current_commit(),
+        "date": datetime.datetime.now().isoformat(),
+        "config": {"users": BENCH_USERS, "messages": BENCH_MESSAGES, "frames": len(frames),
+                   "join_status_bytes": len(frames[0])},
+        "results": [measure_compression(frames, threshold, no_context_takeover)
+                    for threshold in BENCH_COMPRESSION_THRESHOLDS for no_context_takeover in (False, True)],
+    }
+    store_report(report, 'compression')
+
+
+def test_json_codec_speed():
+    """
+    Benchmarks the JSON codec backends (orjson, when installed,
+      and the standard library) on join statuses and on chat
+      messages, which have quite different shapes.
+    """
+
+    messages = sample_messages()
+    samples = {"join_status": messages[:1], "chat_messages": messages[1:]}
+    codecs = {"stdlib": JsonCodec(fast=False)}
+    if JsonCodec(fast=True).fast:
+        codecs["orjson"] = JsonCodec(fast=True)
+    report = {
+        "commit": current_commit(),
+        "date": datetime.datetime.now().isoformat(),
+        "config": {"users": BENCH_USERS, "messages": BENCH_MESSAGES, "rounds": BENCH_CODEC_ROUNDS},
+        "results": [dict(measure_codec(codec, sample, BENCH_CODEC_ROUNDS), backend=backend, sample=name)
+                    for backend, codec in codecs.items() for name, sample in samples.items()],
+    }
+    store_report(report, 'json-codec')
@@ -0,0 +1,94 @@
+import json
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from .history import encode_cursor, decode_cursor
+
+
+# Below this estimated amount of rows, the exact count is taken
+# instead (it is cheap enough, and more accurate).
+EXACT_COUNT_THRESHOLD = 1000
+# The query string parameter of the keyset cursors.
+CURSOR_VAR = 'before'
+
+
+def estimated_count(queryset):
+    """
+    Estimates the amount of rows of a queryset from the planner
+      statistics (by means of EXPLAIN), instead of counting them.
+      Small amounts are counted exactly.
+    :param queryset: The queryset to count.
+    :return: The (perhaps estimated) amount of rows.
+    """
+
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    rows = plan[0]['Plan']['Plan Rows']
+    if rows < EXACT_COUNT_THRESHOLD:
+        return queryset.count()
+    return rows
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A paginator telling an estimated count (see estimated_count)
+      instead of running an exact COUNT(*).
+    """
+
+    @cached_property
+    def count(self):
+        return estimated_count(self.object_list)
+
+
+class KeysetChangeList(ChangeList):
+    """
+    A changelist of messages, newest first, paged by their
+      (created_on, id) key instead of by page number: each page
+      is fetched with an index range scan, no matter how deep
+      it is, instead of skipping (OFFSET) the previous rows.
+      Only the latest page, and the next (older) one, may be
+      linked to. The total is estimated.
+    """
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        queryset = self.queryset.order_by('-created_on', '-id')
+        cursor = request.GET.get(CURSOR_VAR)
+        if cursor:
+            try:
+                created_on, id_, _ = decode_cursor(cursor)
+            except ValueError:
+                raise IncorrectLookupParameters
+            if id_ is None:
+                queryset = queryset.filter(created_on__lt=created_on)
+            else:
+                queryset = queryset.filter(Q(created_on__lt=created_on) | Q(created_on=created_on, id__lt=id_))
+        # One extra row is fetched to know whether an older page exists.
+        result_list = list(queryset[:self.list_per_page + 1])
+        older = None
+        if len(result_list) > self.list_per_page:
+            result_list = result_list[:self.list_per_page]
+            older = encode_cursor(result_list[-1].created_on, result_list[-1].id)
+
+        self.result_count = paginator.count
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = result_list
+        self.can_show_all = False
+        self.multi_page = bool(cursor or older)
+        self.paginator = paginator
+        self.latest_url = self.get_query_string(remove=[CURSOR_VAR]) if cursor else None
+        self.older_url = self.get_query_string({CURSOR_VAR: older}) if older else None
@@ -0,0 +1,202 @@
+import json
+import struct
+import msgpack
+from django.conf import settings
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# The keys used by the chat protocol, and their compact versions
+# (used by the msgpack codec).
+COMPACT_KEYS = {
+    "type": "t",
+    "code": "c",
+    "content": "ct",
+    "details": "d",
+    "name": "n",
+    "room_name": "r",
+    "user": "u",
+    "users": "us",
+    "you": "y",
+    "body": "b",
+    "stamp": "s",
+    "seq": "q",
+    "status": "st",
+    "messages": "m",
+    "before": "bf",
+    "limit": "lm",
+    "command": "cm",
+    "payload": "p",
+    "list": "l",
+    "joined": "j",
+    "members": "mb",
+    "help": "h",
+    "options": "o",
+    "batch_ms": "bm",
+    "events": "e",
+    "query": "qy",
+    "results": "rs",
+    "after": "af",
+}
+EXPANDED_KEYS = {compact: key for key, compact in COMPACT_KEYS.items()}
+
+
+def _rename_keys(content, keys):
+    """
+    Renames the keys of all the dictionaries in a content.
+    :param content: The content to rename the keys of.
+    :param keys: The mapping of the keys to rename.
+    :return: A content with the renamed keys.
+    """
+
+    if isinstance(content, dict):
+        return {keys.get(key, key): _rename_keys(value, keys) for key, value in content.items()}
+    elif isinstance(content, list):
+        return [_rename_keys(value, keys) for value in content]
+    return content
+
+
+class JsonCodec:
+    """
+    Encodes the messages as JSON text frames. This is the
+      default codec, when no subprotocol is negotiated.
+
+    Messages are encoded as UTF-8 JSON bytes. By default, the
+      standard library is used, and the frames are the same
+      ones json.dumps always produced. In fast mode, the orjson
+      library is used (when installed), which produces compact
+      JSON (no spaces after the separators, and non-ASCII
+      characters not escaped): the same content, in less bytes
+      and time, but not the same bytes.
+    """
+
+    name = 'json'
+    subprotocol = None
+    binary = False
+
+    def __init__(self, fast=False):
+        """
+        :param fast: Whether to use orjson, if installed.
+        """
+
+        self.fast = bool(fast and orjson)
+
+    def encode(self, content):
+        """
+        :param content: The content to encode.
+        :return: The encoded frame, as UTF-8 bytes.
+        """
+
+        if self.fast:
+            return orjson.dumps(content)
+        return json.dumps(content).encode('utf-8')
+
+    def decode(self, data):
+        """
+        :param data: A text frame.
+        :return: The decoded content.
+        :raises ValueError: If the frame is not valid JSON.
+        """
+
+        if data is None:
+            raise ValueError("A text frame was expected")
+        if self.fast:
+            # orjson.JSONDecodeError is a ValueError.
+            return orjson.loads(data)
+        return json.loads(data)
+
+    def frame(self, data):
+        """
+        :param data: An encoded frame.
+        :return: The arguments to send it with. ASGI text frames
+          are str, so this is the only place they are decoded.
+        """
+
+        return {"text_data": data.decode('utf-8')}
+
+    def batch(self, frames):
+        """
+        Builds a {"type": "batch", "events": [...]} frame out of
+          already-encoded frames, without decoding them.
+        :param frames: The encoded frames.
+        :return: The encoded batch frame, in the same format
+          as the frames.
+        """
+
+        if self.fast:
+            return b'{"type":"batch","events":[' + b','.join(frames) + b']}'
+        return b'{"type": "batch", "events": [' + b', '.join(frames) + b']}'
+
+
+class MsgpackCodec:
+    """
+    Encodes the messages as msgpack binary frames, with their
+      keys in the compact form. Negotiated via the websocket
+      subprotocol: finchat.msgpack.
+    """
+
+    name = 'msgpack'
+    subprotocol = 'finchat.msgpack'
+    binary = True
+
+    def encode(self, content):
+        return msgpack.packb(_rename_keys(content, COMPACT_KEYS), use_bin_type=True)
+
+    def decode(self, data):
+        """
+        :param data: A binary frame.
+        :return: The decoded content, with its keys expanded.
+        :raises ValueError: If the frame is not valid msgpack.
+        """
+
+        if data is None:
+            raise ValueError("A binary frame was expected")
+        try:
+            return _rename_keys(msgpack.unpackb(data, raw=False), EXPANDED_KEYS)
+        except (ValueError, TypeError, msgpack.UnpackException) as e:
+            raise ValueError(str(e))
+
+    def frame(self, data):
+        return {"bytes_data": data}
+
+    def batch(self, frames):
+        """
+        Builds a {"t": "batch", "e": [...]} frame out of already
+          encoded frames, by writing the map and array headers
+          by hand and appending the frames as they are.
+        :param frames: The encoded frames.
+        :return: The encoded batch frame.
+        """
+
+        count = len(frames)
+        if count < 16:
+            header = struct.pack('>B', 0x90 | count)
+        elif count < 0x10000:
+            header = struct.pack('>BH', 0xdc, count)
+        else:
+            header = struct.pack('>BI', 0xdd, count)
+        return b''.join([
+            b'\x82', msgpack.packb(COMPACT_KEYS["type"]), msgpack.packb("batch"),
+            msgpack.packb(COMPACT_KEYS["events"]), header
+        ] + frames)
+
+
+json_codec = JsonCodec(getattr(settings, 'CHATROOMS_FAST_JSON', False))
+msgpack_codec = MsgpackCodec()
+CODECS = (json_codec, msgpack_codec)
+
+
+def negotiate_codec(subprotocols):
+    """
+    Chooses the codec of a connection, out of the subprotocols
+      asked by the client. JSON is the fallback.
+    :param subprotocols: The subprotocols asked by the client.
+    :return: The codec.
+    """
+
+    for codec in CODECS:
+        if codec.subprotocol and codec.subprotocol in (subprotocols or ()):
+            return codec
+    return json_codec
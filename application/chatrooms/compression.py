@@ -0,0 +1,111 @@
+import collections
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+from daphne.server import Server
+from django.conf import settings
+from . import metrics
+from .outbound import QueueingWebSocketProtocol
+
+
+# Process-wide counters of the outgoing websocket messages: how
+# many were compressed (and their size before and after it) and
+# how many were sent as they were.
+_stats = collections.Counter()
+
+
+def compression_stats():
+    """
+    :return: The compression stats of this process. The ratio is
+      the compressed size over the original size, only counting
+      the compressed messages (None if there are none yet).
+    """
+
+    stats = dict(_stats)
+    stats["ratio"] = _stats["compressed_out"] / _stats["compressed_in"] if _stats["compressed_in"] else None
+    return stats
+
+
+def _compression_config():
+    """
+    :return: The CHATROOMS_COMPRESSION setting, or None if the
+      compression is disabled.
+    """
+
+    return getattr(settings, 'CHATROOMS_COMPRESSION', None) or None
+
+
+def accept_deflate(offers):
+    """
+    Accepts the first permessage-deflate offer of a client.
+    :param offers: The permessage-compress offers of the client.
+    :return: The accepted offer, or None.
+    """
+
+    config = _compression_config()
+    for offer in offers:
+        if config and isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(
+                offer, no_context_takeover=config.get('no_context_takeover') or None,
+                window_bits=config.get('window_bits'), mem_level=config.get('mem_level')
+            )
+    return None
+
+
+class CompressingWebSocketProtocol(QueueingWebSocketProtocol):
+    """
+    A daphne websocket protocol which only compresses the messages
+      reaching the size threshold. Smaller messages (e.g. most chat
+      messages) are sent uncompressed, since the deflate overhead
+      is not worth it for them. Frames for slow clients wait in
+      an outbound queue (see the CHATROOMS_OUTBOUND_QUEUE setting).
+    """
+
+    def sendMessage(self, payload, isBinary=False, fragmentSize=None, sync=False, doNotCompress=False):
+        threshold = (_compression_config() or {}).get('threshold', 0)
+        compress = self._perMessageCompress is not None and not doNotCompress and len(payload) >= threshold
+        sent = self.trafficStats.outgoingOctetsWebSocketLevel
+        super().sendMessage(payload, isBinary, fragmentSize, sync, not compress)
+        if compress:
+            _stats["compressed_messages"] += 1
+            _stats["compressed_in"] += len(payload)
+            _stats["compressed_out"] += self.trafficStats.outgoingOctetsWebSocketLevel - sent
+        else:
+            _stats["uncompressed_messages"] += 1
+            _stats["uncompressed_bytes"] += len(payload)
+
+
+class CompressingServer(Server):
+    """
+    A daphne server negotiating permessage-deflate with the clients
+      offering it, according to the CHATROOMS_COMPRESSION setting,
+      and bounding the frames pending for slow clients, according
+      to the CHATROOMS_OUTBOUND_QUEUE setting.
+
+    Daphne builds its websocket factory inside run(), so the factory
+      is customized when it is assigned.
+    """
+
+    @property
+    def ws_factory(self):
+        return self._ws_factory
+
+    @ws_factory.setter
+    def ws_factory(self, factory):
+        factory.protocol = CompressingWebSocketProtocol
+        factory.setProtocolOptions(perMessageCompressionAccept=accept_deflate)
+        self._ws_factory = factory
+
+
+@metrics.registry.collector
+def collect_compression():
+    """
+    :return: The compression stats of this process.
+    """
+
+    messages = metrics.Counter('chatrooms_ws_messages_total', 'Outgoing websocket messages.', ('compressed',))
+    messages.inc(_stats["compressed_messages"], compressed='yes')
+    messages.inc(_stats["uncompressed_messages"], compressed='no')
+    octets = metrics.Counter('chatrooms_ws_bytes_total', 'Outgoing websocket bytes.', ('stage',))
+    octets.inc(_stats["compressed_in"], stage='before-compression')
+    octets.inc(_stats["compressed_out"], stage='compressed')
+    octets.inc(_stats["uncompressed_bytes"], stage='uncompressed')
+    return [messages, octets]
@@ -1,8 +1,19 @@
+import asyncio
 import datetime
+import time
 from asgiref.sync import async_to_sync
-from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from .models import Room, Message
+from . import metrics
+from .codecs import CODECS, json_codec, negotiate_codec
+from .history import HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE, get_room_messages, decode_cursor, message_entry, \
+    entries_cursor, recent_messages
+from .presence import presence
+from .profiling import spending, timing
+from .ratelimit import check_rate, is_exempt
+from .search import SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE, SEARCH_MAX_QUERY_LENGTH, search_messages, \
+    decode_search_cursor
+from .persistence import store_message, flush_messages, next_sequence
+from .registry import registry
 from .signals import session_destroyed
 import logging
 
@@ -10,18 +21,159 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# Clients may ask room notifications to be batched, during up to
+# MAX_BATCH_MS milliseconds, and up to MAX_BATCH_EVENTS per batch.
+MAX_BATCH_MS = 1000
+MAX_BATCH_EVENTS = 100
+
+
+# The command types, as labelled in the metrics. Other types are
+# labelled as "unsupported".
+COMMAND_TYPES = ("help", "list", "join", "part", "message", "history", "search", "custom", "options")
+
+
 class ChatConsumer(AsyncJsonWebsocketConsumer):
     """
     A chat consumer is aware of:
 
     - The existing rooms: Only to existing rooms can the consumers
       be joined.
-    - A map of (user.id) => channel for the users being logged in.
+    - A map of (user.id) => channel for the users being logged in
+      in this process.
+
+    Which users are connected, and which ones are in each room, is
+      tracked by the presence backend, which may be shared by all
+      the server processes.
     """
 
     USERS = {}
     ROOMS = {}
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.codec = json_codec
+        self.batch_ms = 0
+        self._batch = []
+        self._batch_flusher = None
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        """
+        Sends a frame to the client, after the batched notifications
+          (if any), to keep the order.
+        :param text_data: The text frame to send.
+        :param bytes_data: The binary frame to send.
+        :param close: Whether to close the connection after it.
+        """
+
+        if self._batch:
+            await self._flush_batch()
+        await super().send(text_data, bytes_data, close)
+
+    def _encode(self, content):
+        """
+        Encodes a message with the codec of this connection.
+        :param content: The message to encode.
+        :return: The arguments to send the frame with.
+        """
+
+        return self.codec.frame(self.codec.encode(content))
+
+    async def send_json(self, content, close=False):
+        """
+        Sends a message to the client, encoded with the codec of
+          this connection (JSON, unless msgpack was negotiated).
+        :param content: The message to send.
+        :param close: Whether to close the connection after it.
+        """
+
+        await self.send(close=close, **self._encode(content))
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        """
+        Decodes an incoming frame with the codec of this connection.
+        :param text_data: The text frame, if any.
+        :param bytes_data: The binary frame, if any.
+        :param kwargs: Other arguments for receive_json.
+        """
+
+        data = bytes_data if self.codec.binary else text_data
+        try:
+            content = self.codec.decode(data)
+        except ValueError:
+            await self.send_json({"type": "error", "code": "invalid-format"})
+            return
+        type_ = content.get('type') if isinstance(content, dict) else None
+        room_name = content.get('room_name') if isinstance(content, dict) else None
+        user = self.scope.get("user")
+        with timing(type_ if type_ in COMMAND_TYPES else "unsupported",
+                    room_name if isinstance(room_name, str) else None, len(data),
+                    user.id if user and not user.is_anonymous else None):
+            await self.receive_json(content, **kwargs)
+
+    async def dispatch(self, message):
+        """
+        Dispatches a message to its handler, timing the broadcast_*
+          handlers like the commands.
+        :param message: The message to dispatch.
+        """
+
+        if message["type"].startswith("broadcast_"):
+            with timing(message["type"], message.get("room_name")):
+                await super().dispatch(message)
+        else:
+            await super().dispatch(message)
+
+    async def _send_notification(self, frame, presence=None):
+        """
+        Sends an already-encoded room notification. If the client
+          asked for batching, it is buffered instead, and sent in
+          the next batch. Joined/parted frames of other users may
+          be superseded by a later frame of the same user and room
+          under the coalesce-presence policy of the outbound queue
+          (see outbound.QueueingWebSocketProtocol).
+        :param frame: The already-encoded frame.
+        :param presence: A (room name, user name) key, if the frame
+          is a presence notification of another user.
+        """
+
+        if self.batch_ms:
+            self._batch.append(frame)
+            if len(self._batch) >= MAX_BATCH_EVENTS:
+                await self._flush_batch()
+            elif self._batch_flusher is None:
+                self._batch_flusher = asyncio.ensure_future(self._flush_batch_later())
+        elif presence:
+            if self._batch:
+                await self._flush_batch()
+            key = "bytes" if self.codec.binary else "text"
+            data = frame if self.codec.binary else frame.decode('utf-8')
+            await self.base_send({"type": "websocket.send", key: data, "presence": list(presence)})
+        else:
+            await self.send(**self.codec.frame(frame))
+
+    async def _flush_batch_later(self):
+        """
+        Sends the current batch once the batching window elapses.
+        """
+
+        await asyncio.sleep(self.batch_ms / 1000)
+        self._batch_flusher = None
+        await self._flush_batch()
+
+    async def _flush_batch(self):
+        """
+        Sends the buffered notifications as a single batch frame.
+          The frame is built out of the already-encoded ones, by
+          the codec of this connection.
+        """
+
+        if self._batch_flusher is not None:
+            self._batch_flusher.cancel()
+            self._batch_flusher = None
+        frames, self._batch = self._batch, []
+        if frames:
+            await self.send(**self.codec.frame(self.codec.batch(frames)))
+
     @classmethod
     def _on_session_destroyed(cls, sender, **kwargs):
         """
@@ -62,12 +214,13 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
         logger.info("New connection established")
         user = self.scope["user"]
-        await self.accept()
+        self.codec = negotiate_codec(self.scope.get("subprotocols"))
+        await self.accept(self.codec.subprotocol)
         if not user or user.is_anonymous:
             logger.info(">> It has no user - closing")
             await self.send_json({"type": "fatal", "code": "not-authenticated"}, True)
             return False
-        elif user.id in self.USERS:
+        elif user.id in self.USERS or not await presence.claim_user(user.id, self.channel_name):
             logger.info(">> It is already connected with user: %d - closing" % user.id)
             self.scope.pop("user", None)
             await self.send_json({"type": "fatal", "code": "already-chatting"}, True)
@@ -76,8 +229,31 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             logger.info(">> It is connecting with user: %d - moving forward" % user.id)
             self.USERS[user.id] = self
             self.rooms = set()
+            if presence.heartbeat_interval:
+                self.heartbeat = asyncio.ensure_future(self._keep_presence_alive())
             return True
 
+    async def _keep_presence_alive(self):
+        """
+        Periodically refreshes the session of the current user,
+          and its room memberships, in the presence backend. If
+          the session was lost meanwhile (it expired, and perhaps
+          another connection claimed it), the connection is closed.
+        """
+
+        user = self.scope["user"]
+        while True:
+            await asyncio.sleep(presence.heartbeat_interval)
+            try:
+                held = await presence.heartbeat(user.id, self.channel_name, user.username, list(self.rooms))
+            except Exception as e:
+                logger.warning("Could not refresh the presence of user %d: %s, %s" % (user.id, type(e).__name__, e.args))
+                continue
+            if not held:
+                logger.info(">> The session of user %d was lost - closing" % user.id)
+                await self.send_json({"type": "fatal", "code": "session-lost"}, True)
+                return
+
     async def connect(self):
         """
         A connection lifecycle involves checking the user and then
@@ -104,12 +280,20 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         :param close_code: The close code of the connection.
         """
 
+        if self._batch_flusher is not None:
+            self._batch_flusher.cancel()
         user = self.scope.get("user")
         if user:
             for room_name in getattr(self, 'rooms', set()).copy():
                 await self._notify_user_leaving_room(room_name)
                 await self._remove_from_room(room_name)
-            self.USERS.pop(user.id, None)
+            if self.USERS.get(user.id) is self:
+                if getattr(self, 'heartbeat', None):
+                    self.heartbeat.cancel()
+                await presence.release_user(user.id, self.channel_name)
+                self.USERS.pop(user.id, None)
+            if not self.USERS:
+                await flush_messages()
 
     async def receive_json(self, content, **kwargs):
         """
@@ -122,6 +306,11 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
          - {"type": "join", "room_name": "..."}
          - {"type": "part", "room_name": "..."}
          - {"type": "message", "room_name": "...", "content": "..."}
+         - {"type": "history", "room_name": "...", "before": "...", "limit": N}
+           - "before" and "limit" are optional.
+         - {"type": "search", "query": "...", "room_name": "...", "after": "...", "limit": N}
+           - "room_name", "after" and "limit" are optional.
+         - {"type": "options", "batch_ms": N}
          - {"type": "custom", "code": "...", "payload": "..."}
            - These "custom" messages are not stored in log.
            - Special clients may attend these messages when sent
@@ -135,9 +324,15 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         # ... = {"type": "on_broadcast",  ...more data}
 
         if not isinstance(content, dict):
+            metrics.COMMANDS.inc(type="invalid")
             await self.send_json({"type": "error", "code": "invalid-format"})
+            return
+
+        type_ = content.get('type')
+        metrics.COMMANDS.inc(type=type_ if type_ in COMMAND_TYPES else "unsupported")
+        if not await self._check_rate(content):
+            return
         else:
-            type_ = content.get('type')
             if type_ == "help":
                 await self.receive_help()
             elif type_ == "list":
@@ -148,11 +343,38 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                 await self.receive_part(content.get('room_name'))
             elif type_ == "message":
                 await self.receive_message(content.get('room_name'), content.get('body'))
+            elif type_ == "history":
+                await self.receive_history(content.get('room_name'), content.get('before'), content.get('limit'))
+            elif type_ == "search":
+                await self.receive_search(content.get('query'), content.get('room_name'), content.get('after'),
+                                          content.get('limit'))
             elif type_ == "custom":
                 await self.receive_custom(content.get('room_name'), content.get('command'), content.get('payload'))
+            elif type_ == "options":
+                await self.receive_options(content.get('batch_ms'))
             else:
                 await self.send_json({"type": "error", "code": "unsupported-command", "details": {"type": type_}})
 
+    async def _check_rate(self, content):
+        """
+        Checks the command against the rate limits of the user.
+          Notifies the user if the command is rate-limited.
+        :param content: The command.
+        :return: Whether the command may be processed.
+        """
+
+        type_ = content.get('type')
+        user = self.scope.get("user")
+        if not isinstance(type_, str) or not user or user.is_anonymous or is_exempt(user):
+            return True
+        retry_after = await check_rate(user.id, type_, content.get('room_name'))
+        if retry_after:
+            await self.send_json({"type": "error", "code": "rate-limited", "details": {
+                "type": type_, "retry_after": round(retry_after, 3)
+            }})
+            return False
+        return True
+
     async def receive_help(self):
         """
         Processes a help command. This command will return
@@ -179,19 +401,49 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
           - Joins the channel, if not already joined.
         - {"type": "part", "room_name": "making_friends"}
           - Leaves the channel, if already joined.
+        - {"type": "history", "room_name": "making_friends", "before": "...", "limit": 50}
+          - Retrieves older messages of the channel, newest first.
+          - "before" is optional, and is a cursor given by a previous history page
+            or by the join status. Only messages older than it will be retrieved.
+          - "limit" is optional, and must be between 1 and 100 (50 by default).
+          - You must be already joined in the channel.
+        - {"type": "search", "query": "aapl -sell", "room_name": "making_friends", "after": "...", "limit": 20}
+          - Searches the messages of the joined channels, best matches first.
+          - "query" may have words, "quoted phrases", -excluded words, and "or".
+          - "room_name" is optional, and only searches that channel (which you must
+            be already joined in).
+          - "after" is optional, and is a cursor given by a previous search page.
+          - "limit" is optional, and must be between 1 and 50 (20 by default).
+        - {"type": "options", "batch_ms": 10}
+          - Batches the room notifications: they will be sent together, every
+            10 milliseconds, as {"type": "batch", "events": [...]}.
+          - "batch_ms" must be between 0 and 1000. 0 (the default) disables it.
         """})
 
+    async def _resolve_room(self, room_name):
+        """
+        Resolves a room name from the registry.
+        :param room_name: The name of the room.
+        :return: The room id, or None if it does not exist.
+        """
+
+        await registry.ensure()
+        return registry.get(room_name)
+
     async def receive_list(self):
         """
         Processes a list command. This command will return
           a list of all the available rooms in the server,
-          also telling which one is the user joined to.
+          also telling which one is the user joined to and
+          how many users are in it.
         """
 
-        rooms = await database_sync_to_async(lambda: list(Room.objects.order_by('name')))()
+        await registry.ensure()
+        room_names = registry.names()
+        counts = await presence.counts(room_names)
         await self.send_json({"type": "notification", "code": "list", "list": [{
-            "name": room.name, "joined": room.name in self.rooms
-        } for room in rooms]})
+            "name": room_name, "joined": room_name in self.rooms, "members": counts[room_name]
+        } for room_name in room_names]})
 
     async def _expect_types(self, specs):
         """
@@ -223,7 +475,9 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
         self.rooms.add(room_name)
         self.ROOMS.setdefault(room_name, set()).add(self)
-        await self.channel_layer.group_add(room_name, self.channel_name)
+        await presence.join(room_name, self.scope["user"].username)
+        with spending("channel_layer"):
+            await self.channel_layer.group_add(room_name, self.channel_name)
 
     async def _remove_from_room(self, room_name):
         """
@@ -233,7 +487,37 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
         self.ROOMS.setdefault(room_name, set()).discard(self)
         self.rooms.discard(room_name)
-        await self.channel_layer.group_discard(room_name, self.channel_name)
+        await presence.leave(room_name, self.scope["user"].username)
+        with spending("channel_layer"):
+            await self.channel_layer.group_discard(room_name, self.channel_name)
+
+    async def _broadcast_notification(self, type_, room_name, notification, you=True):
+        """
+        Broadcasts a room notification from the current user. The
+          notification is encoded here, once per codec, in two
+          versions: one for the current user and one for the others.
+          This way, the broadcast_* handlers only forward the frame
+          for their user and codec.
+        :param type_: The handler of the group event.
+        :param room_name: The room to broadcast the notification to.
+        :param notification: The notification content. It must have
+          a "you" key, which will be set in each version.
+        :param you: Whether to encode the version for the current
+          user. Otherwise, the handler builds it by itself.
+        """
+
+        frames = {}
+        for codec in CODECS:
+            frames[codec.name] = {"others": codec.encode(dict(notification, you=False))}
+            if you:
+                frames[codec.name]["you"] = codec.encode(dict(notification, you=True))
+        started = time.perf_counter()
+        with spending("channel_layer"):
+            await self.channel_layer.group_send(room_name, {
+                "type": type_, "user": self.scope["user"].username, "room_name": room_name, "frames": frames
+            })
+        metrics.GROUP_SEND_SECONDS.observe(time.perf_counter() - started, event=type_)
+        metrics.BROADCAST_FANOUT.observe(len(self.ROOMS.get(room_name, ())), event=type_)
 
     async def _notify_user_joining_room(self, room_name):
         """
@@ -242,25 +526,57 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         :param room_name: The room the user is joining.
         """
 
-        await self.channel_layer.group_send(room_name, {
-            "type": "broadcast_joined",
-            "user": self.scope["user"].username, "room_name": room_name,
+        # The current user will receive a different version,
+        # with the room status, built in the handler.
+        await self._broadcast_notification("broadcast_joined", room_name, {
+            "type": "room:notification",
+            "code": "joined",
+            "you": False,
+            "status": None,
+            "user": self.scope["user"].username,
+            "room_name": room_name,
             "stamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        })
+        }, you=False)
 
-    async def _get_last_50_room_messages(self, room_name):
+    def _serialize_room_messages(self, messages):
         """
-        Gets the last 50 messages, of a room.
-        :param room_name: The room to grab the last messages from.
+        Serializes a page of room messages for the current user.
+        :param messages: The messages to serialize.
+        :return: The serialized messages.
         """
 
         return [
             {"stamp": message.created_on.strftime("%Y-%m-%d %H:%M:%S"),
              "user": message.user.username, "body": message.content,
              "you": message.user == self.scope["user"]}
-            for message in await database_sync_to_async(lambda: list(Message.objects.select_related('user').filter(room__name=room_name).order_by("-created_on")[:50]))()
+            for message in messages
         ]
 
+    async def _get_last_50_room_messages(self, room_name):
+        """
+        Gets the last 50 messages, of a room. They are taken from
+          the recent messages buffer of the room, which is primed
+          from the database only when cold.
+        :param room_name: The room to grab the last messages from.
+        :return: A (messages, cursor) tuple. The cursor allows
+          retrieving older messages via the history command.
+        """
+
+        room_id = await self._resolve_room(room_name)
+        entries = await recent_messages.get(room_id)
+        if entries is None:
+            version = await recent_messages.version(room_id)
+            await flush_messages()
+            messages, _ = await metrics.timed_database_sync_to_async(get_room_messages)(room_id)
+            entries = [message_entry(message) for message in messages]
+            await recent_messages.prime(room_id, entries, version)
+
+        username = self.scope["user"].username
+        return [
+            {"stamp": entry["stamp"], "user": entry["user"], "body": entry["body"], "you": entry["user"] == username}
+            for entry in entries[:HISTORY_PAGE_SIZE]
+        ], entries_cursor(entries)
+
     async def _get_room_users(self, room_name):
         """
         Gets all the room users (including self).
@@ -268,9 +584,10 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         :return: The room users
         """
 
-        return sorted([
-            {"name": channel.scope["user"].username, "you": channel.scope["user"] == self.scope["user"]} for channel in self.ROOMS[room_name]
-        ], key=lambda d: d['name'])
+        username = self.scope["user"].username
+        return [
+            {"name": name, "you": name == username} for name in sorted(await presence.members(room_name))
+        ]
 
     async def receive_join(self, room_name):
         """
@@ -282,15 +599,14 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         if not await self._expect_types([(room_name, str)]):
             return
 
-        try:
-            await database_sync_to_async(lambda: Room.objects.get(name=room_name))()
+        if await self._resolve_room(room_name) is not None:
             self.rooms = getattr(self, 'rooms', set())
             if room_name in self.rooms:
                 await self.send_json({"type": "error", "code": "room:already-joined", "details": {"name": room_name}})
             else:
                 await self._add_to_room(room_name)
                 await self._notify_user_joining_room(room_name)
-        except Room.DoesNotExist:
+        else:
             await self.send_json({"type": "error", "code": "room:invalid", "details": {"name": room_name}})
 
     async def _notify_user_leaving_room(self, room_name):
@@ -300,9 +616,12 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         :param room_name: The room the user is leaving.
         """
 
-        await self.channel_layer.group_send(room_name, {
-            "type": "broadcast_parted",
-            "user": self.scope["user"].username, "room_name": room_name,
+        await self._broadcast_notification("broadcast_parted", room_name, {
+            "type": "room:notification",
+            "code": "parted",
+            "you": False,
+            "user": self.scope["user"].username,
+            "room_name": room_name,
             "stamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         })
 
@@ -325,19 +644,21 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
     async def _store_message(self, room_name, body):
         """
-        Stores the message, sent by the user, in database.
+        Stores the message, sent by the user, in database. In
+          write-behind mode, it will be inserted shortly after.
         :param room_name: The name of the room where the message
           was sent.
         :param body: The message body.
         :return: The stored message
         """
 
-        try:
-            return await database_sync_to_async(lambda: Message.objects.create(room=Room.objects.get(
-                name=room_name
-            ), content=body[:512], user=self.scope["user"]))()
-        except Room.DoesNotExist:
+        room_id = await self._resolve_room(room_name)
+        if room_id is None:
             logger.warning("Trying to store a message for non-existing room: " + room_name)
+            return None
+        message = await store_message(room_id, self.scope["user"], body)
+        await recent_messages.push(room_id, message_entry(message))
+        return message
 
     async def _broadcast_message(self, room_name, body, stamp):
         """
@@ -347,9 +668,15 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         :param stamp: The message timestamp.
         """
 
-        await self.channel_layer.group_send(room_name, {
-            "type": "broadcast_message",
-            "user": self.scope["user"].username, "room_name": room_name, "body": body, "stamp": stamp
+        await self._broadcast_notification("broadcast_message", room_name, {
+            "type": "room:notification",
+            "code": "message",
+            "you": False,
+            "user": self.scope["user"].username,
+            "room_name": room_name,
+            "body": body,
+            "stamp": stamp,
+            "seq": next_sequence()
         })
 
     async def receive_message(self, room_name, body):
@@ -368,12 +695,130 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             body = body.strip()
             if body:
                 message = await self._store_message(room_name, body)
-                await self._broadcast_message(room_name, body, message.created_on.strftime("%Y-%m-%d %H:%M:%S"))
+                if message:
+                    await self._broadcast_message(room_name, body, message.created_on.strftime("%Y-%m-%d %H:%M:%S"))
+                else:
+                    await self.send_json({"type": "error", "code": "room:invalid", "details": {"name": room_name}})
             else:
                 await self.send_json({"type": "error", "code": "room:empty-message"})
         else:
             await self.send_json({"type": "error", "code": "room:not-joined", "details": {"name": room_name}})
 
+    async def receive_history(self, room_name, before, limit):
+        """
+        Processes a history command. If the user is present in the
+          intended room, we send a page of messages older than the
+          given cursor (or the latest ones if no cursor is given).
+        :param room_name: The name of the room to get the history from.
+        :param before: An optional cursor from a previous page.
+        :param limit: An optional amount of messages to retrieve.
+        """
+
+        if not await self._expect_types([(room_name, str), (before, str, True), (limit, int, True)]):
+            return
+
+        if limit is None:
+            limit = HISTORY_PAGE_SIZE
+        if not 1 <= limit <= HISTORY_MAX_PAGE_SIZE:
+            await self.send_json({"type": "error", "code": "invalid-format"})
+            return
+
+        if before is not None:
+            try:
+                before = decode_cursor(before)
+            except ValueError:
+                await self.send_json({"type": "error", "code": "room:invalid-cursor", "details": {"name": room_name}})
+                return
+
+        if room_name in self.rooms:
+            room_id = await self._resolve_room(room_name)
+            await flush_messages()
+            messages, cursor = await metrics.timed_database_sync_to_async(get_room_messages)(room_id, before, limit)
+            await self.send_json({
+                "type": "notification",
+                "code": "history",
+                "room_name": room_name,
+                "messages": self._serialize_room_messages(messages),
+                "before": cursor
+            })
+        else:
+            await self.send_json({"type": "error", "code": "room:not-joined", "details": {"name": room_name}})
+
+    async def receive_search(self, query, room_name, after, limit):
+        """
+        Processes a search command. The messages of the rooms the
+          user is present in (or only the given one) are searched,
+          and a page of the best matches is sent.
+        :param query: The full-text query.
+        :param room_name: An optional room to search in.
+        :param after: An optional cursor from a previous page.
+        :param limit: An optional amount of results to retrieve.
+        """
+
+        if not await self._expect_types([(query, str), (room_name, str, True), (after, str, True),
+                                         (limit, int, True)]):
+            return
+
+        query = query.strip()
+        if limit is None:
+            limit = SEARCH_PAGE_SIZE
+        if not query or len(query) > SEARCH_MAX_QUERY_LENGTH or not 1 <= limit <= SEARCH_MAX_PAGE_SIZE:
+            await self.send_json({"type": "error", "code": "invalid-format"})
+            return
+
+        if after is not None:
+            try:
+                after = decode_search_cursor(after)
+            except ValueError:
+                await self.send_json({"type": "error", "code": "search:invalid-cursor"})
+                return
+
+        if room_name is not None and room_name not in self.rooms:
+            await self.send_json({"type": "error", "code": "room:not-joined", "details": {"name": room_name}})
+            return
+
+        room_names = {}
+        for name in ([room_name] if room_name is not None else self.rooms):
+            room_id = await self._resolve_room(name)
+            if room_id is not None:
+                room_names[room_id] = name
+        messages, cursor = [], None
+        if room_names:
+            await flush_messages()
+            messages, cursor = await metrics.timed_database_sync_to_async(search_messages)(
+                list(room_names), query, after, limit
+            )
+        results = self._serialize_room_messages(messages)
+        for result, message in zip(results, messages):
+            result["room_name"] = room_names[message.room_id]
+        await self.send_json({
+            "type": "notification",
+            "code": "search",
+            "query": query,
+            "results": results,
+            "after": cursor
+        })
+
+    async def receive_options(self, batch_ms):
+        """
+        Processes an options command. The only option, so far, is
+          the batching window of the room notifications.
+        :param batch_ms: The batching window, in milliseconds. 0
+          disables the batching.
+        """
+
+        if not await self._expect_types([(batch_ms, int)]):
+            return
+
+        if not 0 <= batch_ms <= MAX_BATCH_MS:
+            await self.send_json({"type": "error", "code": "invalid-format"})
+            return
+
+        # The notifications batched so far are sent right away.
+        await self._flush_batch()
+        self.batch_ms = batch_ms
+        await self.send_json({"type": "notification", "code": "options", "options": {"batch_ms": batch_ms}})
+
     async def _broadcast_custom(self, room_name, code, payload):
         """
         Broadcasts the message in the channel.
@@ -382,9 +827,14 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         :param payload: The payload data.
         """
 
-        await self.channel_layer.group_send(room_name, {
-            "type": "broadcast_custom",
-            "user": self.scope["user"].username, "room_name": room_name, "command": code, "payload": payload,
+        await self._broadcast_notification("broadcast_custom", room_name, {
+            "type": "room:notification",
+            "code": "custom",
+            "you": False,
+            "user": self.scope["user"].username,
+            "room_name": room_name,
+            "command": code,
+            "payload": payload,
             "stamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         })
 
@@ -414,53 +864,63 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
     # From this point, the broadcast_* methods are listed. They
     # have a different logic depending on the user: whether the
     # same or different user broadcast it, how is a notification
-    # sent to the client side.
+    # sent to the client side. The notifications come already
+    # encoded in both versions, per codec, in the "frames" of
+    # the event.
+
+    async def _forward_frame(self, event, presence=False):
+        """
+        Sends the already-encoded version of a notification
+          which corresponds to the current user.
+        :param event: A {"user": ..., "room_name": ..., "frames":
+          {codec: {"you": ..., "others": ...}}} packet.
+        :param presence: Whether the notification is about the
+          presence of the user in the room.
+        """
+
+        frames = event["frames"][self.codec.name]
+        if self.scope["user"].username == event["user"]:
+            await self._send_notification(frames["you"])
+        else:
+            await self._send_notification(frames["others"], (event["room_name"], event["user"]) if presence else None)
 
     async def broadcast_joined(self, event):
         """
         Sends a message about a joining user, to the
           current user. If the user is the same, then
-          a different message is sent.
-        :param event: A {"user": ..., "room_name": ...} message.
+          a different message is sent, with the status
+          of the room.
+        :param event: A {"user": ..., "room_name": ...,
+          "frames": {codec: {"others": ...}}} packet.
         """
 
         username = event["user"]
         room_name = event["room_name"]
-        stamp = event["stamp"]
 
-        await self.send_json({
-            "type": "room:notification",
-            "code": "joined",
-            "you": self.scope["user"].username == username,
-            "status": None if self.scope["user"].username != username else {
-                "users": await self._get_room_users(room_name),
-                "messages": await self._get_last_50_room_messages(room_name)
-            },
-            "user": username,
-            "room_name": room_name,
-            "stamp": stamp
-        })
+        if self.scope["user"].username != username:
+            await self._send_notification(event["frames"][self.codec.name]["others"], (room_name, username))
+            return
+
+        content = json_codec.decode(event["frames"][json_codec.name]["others"])
+        messages, cursor = await self._get_last_50_room_messages(room_name)
+        content["you"] = True
+        content["status"] = {
+            "users": await self._get_room_users(room_name),
+            "messages": messages,
+            "before": cursor
+        }
+        await self.send_json(content)
 
     async def broadcast_parted(self, event):
         """
         Sends a message about a leaving user, to the
           current user. If the user is the same, then
           a different message is sent.
-        :param event: A {"user": ..., "room_name": ...} packet.
+        :param event: A {"user": ..., "room_name": ...,
+          "frames": {codec: {"you": ..., "others": ...}}} packet.
         """
 
-        username = event["user"]
-        room_name = event["room_name"]
-        stamp = event["stamp"]
-
-        await self.send_json({
-            "type": "room:notification",
-            "code": "parted",
-            "you": self.scope["user"].username == username,
-            "user": username,
-            "room_name": room_name,
-            "stamp": stamp
-        })
+        await self._forward_frame(event, presence=True)
 
     async def broadcast_message(self, event):
         """
@@ -468,23 +928,10 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
           by a particular user. If the user is
           the same, a different message is sent.
         :param event: A {"user": ..., "room_name": ...,
-          "body": ..., "stamp": ...} packet.
+          "frames": {codec: {"you": ..., "others": ...}}} packet.
         """
 
-        username = event['user']
-        room_name = event['room_name']
-        body = event['body']
-        stamp = event['stamp']
-
-        await self.send_json({
-            "type": "room:notification",
-            "code": "message",
-            "you": self.scope["user"].username == username,
-            "user": username,
-            "room_name": room_name,
-            "body": body,
-            "stamp": stamp
-        })
+        await self._forward_frame(event)
 
     async def broadcast_custom(self, event):
         """
@@ -492,23 +939,21 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
           by a particular user. If the user is
           the same, a different message is sent.
         :param event: A {"user": ..., "room_name": ...,
-          "command": ..., "payload": ..., "stamp": ...}
-          packet.
+          "frames": {codec: {"you": ..., "others": ...}}} packet.
         """
 
-        username = event['user']
-        room_name = event['room_name']
-        command = event['command']
-        payload = event['payload']
-        stamp = event['stamp']
+        await self._forward_frame(event)
 
-        await self.send_json({
-            "type": "room:notification",
-            "code": "custom",
-            "you": self.scope["user"].username == username,
-            "user": username,
-            "room_name": room_name,
-            "command": command,
-            "payload": payload,
-            "stamp": stamp
-        })
+
+@metrics.registry.collector
+def collect_connections():
+    """
+    :return: The connections and room members of this process.
+    """
+
+    connections = metrics.Gauge('chatrooms_connections', 'Active websocket connections of this process.')
+    connections.set(len(ChatConsumer.USERS))
+    members = metrics.Gauge('chatrooms_room_members', 'Room members connected to this process.', ('room',))
+    for room_name, consumers in list(ChatConsumer.ROOMS.items()):
+        members.set(len(consumers), room=room_name)
+    return [connections, members]
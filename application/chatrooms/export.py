@@ -0,0 +1,128 @@
+import csv
+import datetime
+import io
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from .codecs import json_codec
+from .models import Message
+
+
+# The export formats, and their content types.
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+# The rows fetched from the server-side cursor at a time, and
+# the size of the blocks written out at a time.
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_BLOCK_SIZE = 64 * 1024
+# The columns of the exported rows.
+EXPORT_COLUMNS = ('id', 'created_on', 'user', 'room', 'content')
+
+
+def parse_bound(value):
+    """
+    Parses a bound of an export date range.
+    :param value: An ISO datetime or date. A date stands for
+      its midnight, and naive datetimes are taken in the
+      current time zone.
+    :return: The aware datetime.
+    :raises ValueError: If the value is malformed.
+    """
+
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError("Invalid date: %s" % value)
+        moment = datetime.datetime.combine(day, datetime.time())
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def room_rows(room, since=None, until=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Iterates over the messages of a room, oldest first, through a
+      server-side cursor, so only `chunk_size` rows are held in
+      memory at a time.
+    :param room: The room.
+    :param since: An optional date. Only the messages created at
+      or after it are exported.
+    :param until: An optional date. Only the messages created
+      before it are exported.
+    :param chunk_size: The amount of rows fetched at a time.
+    :return: An iterator of rows, with the EXPORT_COLUMNS.
+    """
+
+    query = Message.objects.filter(room=room)
+    if since is not None:
+        query = query.filter(created_on__gte=since)
+    if until is not None:
+        query = query.filter(created_on__lt=until)
+    rows = query.order_by('created_on', 'id').values_list('id', 'created_on', 'user__username', 'content')
+    for id_, created_on, username, content in rows.iterator(chunk_size=chunk_size):
+        yield id_, created_on.isoformat(), username, room.name, content
+
+
+def _csv_lines(rows):
+    """
+    :param rows: The rows to encode.
+    :return: An iterator of CSV lines, as bytes, starting with
+      the header.
+    """
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for values in rows:
+        writer.writerow(values)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    # Only the header, when there are no rows.
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def _ndjson_lines(rows):
+    """
+    :param rows: The rows to encode.
+    :return: An iterator of JSON lines, as bytes.
+    """
+
+    for values in rows:
+        yield json_codec.encode(dict(zip(EXPORT_COLUMNS, values))) + b'\n'
+
+
+def export_room(room, format_, since=None, until=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Exports the messages of a room, as blocks of bytes. Memory use
+      does not depend on the amount of exported messages, so it
+      may be streamed right away (e.g. by a StreamingHttpResponse).
+    :param room: The room.
+    :param format_: One of the EXPORT_FORMATS.
+    :param since: An optional date. Only the messages created at
+      or after it are exported.
+    :param until: An optional date. Only the messages created
+      before it are exported.
+    :param chunk_size: The amount of rows fetched at a time.
+    :return: An iterator of blocks of up to EXPORT_BLOCK_SIZE
+      bytes (or one line, if longer).
+    """
+
+    if format_ not in EXPORT_FORMATS:
+        raise ValueError("Invalid format: %s" % format_)
+    rows = room_rows(room, since, until, chunk_size)
+    lines = _csv_lines(rows) if format_ == 'csv' else _ndjson_lines(rows)
+    block = []
+    size = 0
+    for line in lines:
+        block.append(line)
+        size += len(line)
+        if size >= EXPORT_BLOCK_SIZE:
+            yield b''.join(block)
+            block = []
+            size = 0
+    if block:
+        yield b''.join(block)
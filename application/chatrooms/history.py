@@ -0,0 +1,328 @@
+import base64
+import binascii
+import collections
+import json
+import time
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.module_loading import import_string
+from .metrics import HISTORY_QUERY_SECONDS
+from .models import Message
+from .redis_pools import RedisPools
+
+
+# The default amount of messages retrieved when joining a room
+# or paging backwards through its history, and the maximum one
+# a client may ask for.
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(created_on, id_, users=()):
+    """
+    Builds an opaque cursor pointing to a message. Pages fetched
+      with this cursor will only contain messages older than it.
+    :param created_on: The creation date of the message.
+    :param id_: The id of the message. It may be None for messages
+      not inserted yet (in write-behind mode).
+    :param users: When the id is None, the names of the users whose
+      messages of that same creation date were already seen. A user
+      cannot send two messages at the same microsecond, so they tell
+      which messages of that date to skip.
+    :return: The cursor, as a url-safe string.
+    """
+
+    raw = "%s|%s|%s" % (created_on.isoformat(), '' if id_ is None else id_, ','.join(users))
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Decodes an opaque cursor into its (created_on, id, users) key.
+    :param cursor: The cursor, as given by `encode_cursor`.
+    :return: A (created_on, id, users) tuple. The id may be None,
+      and then the users are a (perhaps empty) tuple of names.
+    :raises ValueError: If the cursor is malformed.
+    """
+
+    try:
+        parts = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        if len(parts) == 2:
+            # Cursors given before the users were included.
+            parts.append('')
+        stamp, id_, users = parts
+        created_on = parse_datetime(stamp)
+        if created_on is None:
+            raise ValueError("Invalid cursor stamp")
+        return created_on, int(id_) if id_ else None, tuple(users.split(',')) if users else ()
+    except (binascii.Error, UnicodeError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def get_room_messages(room_id, before=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Gets a page of messages of a room, newest first. Pages are
+      keyset-based on (created_on, id), so fetching an old page
+      costs the same as fetching the latest one.
+    :param room_id: The id of the room to grab the messages from.
+    :param before: An optional (created_on, id, users) key. Only
+      older messages will be retrieved.
+    :param limit: The maximum amount of messages to retrieve.
+    :return: A (messages, cursor) tuple, where the cursor is None
+      when there are no older messages to retrieve.
+    """
+
+    started = time.perf_counter()
+    query = Message.objects.select_related('user').filter(room_id=room_id)
+    if before is not None:
+        created_on, id_, users = before
+        if id_ is None:
+            # The messages of the same date are kept, but the ones
+            # of the given users (which were already seen).
+            query = query.filter(Q(created_on__lt=created_on) | (
+                Q(created_on=created_on) & ~Q(user__username__in=users)
+            ))
+        else:
+            query = query.filter(Q(created_on__lt=created_on) | Q(created_on=created_on, id__lt=id_))
+    # One extra row is fetched to know whether an older page exists.
+    messages = list(query.order_by("-created_on", "-id")[:limit + 1])
+    HISTORY_QUERY_SECONDS.observe(time.perf_counter() - started, page='latest' if before is None else 'older')
+    if len(messages) > limit:
+        messages = messages[:limit]
+        return messages, encode_cursor(messages[-1].created_on, messages[-1].id)
+    return messages, None
+
+
+def message_entry(message):
+    """
+    Builds the entry of a message, as kept in the recent
+      messages buffers.
+    :param message: The message (with its user).
+    :return: The entry.
+    """
+
+    return {
+        "id": message.id,
+        "created_on": message.created_on.isoformat(),
+        "stamp": message.created_on.strftime("%Y-%m-%d %H:%M:%S"),
+        "user": message.user.username,
+        "body": message.content
+    }
+
+
+def entries_cursor(entries):
+    """
+    Builds the cursor to page backwards from a list of recent
+      messages entries. Buffers are primed with all the room
+      messages when they are less than a page, so there are
+      older messages only if the buffer is full.
+
+    Entries pushed in write-behind mode have no id, so the users
+      of the entries sharing the date of the oldest one are given
+      instead (see encode_cursor).
+    :param entries: The entries, newest first.
+    :return: The cursor, or None if there are no older messages.
+    """
+
+    if len(entries) < HISTORY_PAGE_SIZE:
+        return None
+    oldest = entries[-1]
+    if oldest["id"] is not None:
+        return encode_cursor(parse_datetime(oldest["created_on"]), oldest["id"])
+    users = sorted({entry["user"] for entry in entries if entry["created_on"] == oldest["created_on"]})
+    return encode_cursor(parse_datetime(oldest["created_on"]), None, users)
+
+
+class LocalRecentMessages:
+    """
+    Keeps, in memory, a ring buffer with the latest messages
+      of each room, so joining a room does not need to query
+      them. A room is cold until it is primed with the latest
+      messages from the database.
+
+    Each room also has a version, increased with each message,
+      and when the buffer is invalidated (e.g. because messages
+      were deleted). Priming is discarded if the version changed
+      meanwhile, so a message is never missed by a buffer, and a
+      deleted one is never brought back.
+
+    Only accurate when a single server process is running.
+    """
+
+    def __init__(self, size=HISTORY_PAGE_SIZE):
+        self.size = size
+        self._rooms = {}
+        self._versions = collections.Counter()
+
+    async def get(self, room_id):
+        """
+        Gets the recent messages of a room.
+        :param room_id: The id of the room.
+        :return: The entries, newest first, or None if the room
+          buffer is cold.
+        """
+
+        buffer = self._rooms.get(room_id)
+        return None if buffer is None else list(buffer)
+
+    async def version(self, room_id):
+        """
+        :param room_id: The id of the room.
+        :return: The current version of the room buffer.
+        """
+
+        return self._versions[room_id]
+
+    async def prime(self, room_id, entries, version):
+        """
+        Primes the buffer of a room, unless its version changed.
+        :param room_id: The id of the room.
+        :param entries: The latest entries, newest first.
+        :param version: The version obtained before querying
+          the entries.
+        """
+
+        if self._versions[room_id] == version:
+            self._rooms[room_id] = collections.deque(entries[:self.size], self.size)
+
+    async def push(self, room_id, entry):
+        """
+        Adds a new message to the buffer of a room, if warm.
+        :param room_id: The id of the room.
+        :param entry: The message entry.
+        """
+
+        self._versions[room_id] += 1
+        buffer = self._rooms.get(room_id)
+        if buffer is not None:
+            buffer.appendleft(entry)
+
+    async def invalidate(self, room_ids):
+        """
+        Drops the buffers of some rooms, so they are primed again
+          from the database when needed.
+        :param room_ids: The ids of the rooms.
+        """
+
+        for room_id in room_ids:
+            self._versions[room_id] += 1
+            self._rooms.pop(room_id, None)
+
+
+class RedisRecentMessages:
+    """
+    Keeps, in Redis, a capped list with the latest messages of
+      each room. It works like LocalRecentMessages, but shared
+      among all the server processes, and surviving restarts.
+    """
+
+    # Primes a list, unless its version changed. A marker entry
+    # is appended to tell an empty room from a cold one, and is
+    # eventually trimmed when the list is full.
+    PRIME_SCRIPT = """
+    if (redis.call('get', KEYS[2]) or '0') ~= ARGV[1] then
+        return 0
+    end
+    redis.call('del', KEYS[1])
+    for i = 3, #ARGV do
+        redis.call('rpush', KEYS[1], ARGV[i])
+    end
+    redis.call('rpush', KEYS[1], '')
+    redis.call('ltrim', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+    return 1
+    """
+
+    def __init__(self, host, size=HISTORY_PAGE_SIZE, prefix='chatrooms:recent'):
+        """
+        :param host: A redis://[:password@]host:port/db address.
+        :param size: The amount of messages kept per room.
+        :param prefix: The prefix of all the keys.
+        """
+
+        self.pools = RedisPools(host)
+        self.size = size
+        self.prefix = prefix
+
+    def _list_key(self, room_id):
+        return '%s:room:%s' % (self.prefix, room_id)
+
+    def _version_key(self, room_id):
+        return '%s:version:%s' % (self.prefix, room_id)
+
+    async def get(self, room_id):
+        redis = await self.pools.get()
+        entries = await redis.lrange(self._list_key(room_id), 0, self.size)
+        if not entries:
+            return None
+        return [json.loads(entry) for entry in entries if entry][:self.size]
+
+    async def version(self, room_id):
+        redis = await self.pools.get()
+        return await redis.get(self._version_key(room_id)) or '0'
+
+    async def prime(self, room_id, entries, version):
+        redis = await self.pools.get()
+        await redis.eval(self.PRIME_SCRIPT, keys=[self._list_key(room_id), self._version_key(room_id)],
+                         args=[version, self.size + 1] + [json.dumps(entry) for entry in entries[:self.size]])
+
+    async def push(self, room_id, entry):
+        redis = await self.pools.get()
+        key = self._list_key(room_id)
+        pipeline = redis.multi_exec()
+        pipeline.incr(self._version_key(room_id))
+        pipeline.lpushx(key, json.dumps(entry))
+        pipeline.ltrim(key, 0, self.size)
+        await pipeline.execute()
+
+    async def invalidate(self, room_ids):
+        if not room_ids:
+            return
+        redis = await self.pools.get()
+        pipeline = redis.multi_exec()
+        for room_id in room_ids:
+            pipeline.incr(self._version_key(room_id))
+            pipeline.delete(self._list_key(room_id))
+        await pipeline.execute()
+
+
+def _build_recent_messages():
+    """
+    Builds the recent messages buffers according to the
+      CHATROOMS_RECENT_MESSAGES setting, which has a BACKEND
+      class path and its CONFIG kwargs. They are kept in
+      memory by default.
+    :return: The recent messages buffers.
+    """
+
+    config = getattr(settings, 'CHATROOMS_RECENT_MESSAGES', None) or {}
+    backend = import_string(config.get('BACKEND', 'chatrooms.history.LocalRecentMessages'))
+    return backend(**config.get('CONFIG', {}))
+
+
+recent_messages = _build_recent_messages()
+
+
+def invalidate_rooms(room_ids):
+    """
+    Drops the recent messages buffers of some rooms, from a sync
+      context (e.g. after deleting some of their messages).
+    :param room_ids: The ids of the rooms.
+    """
+
+    async_to_sync(recent_messages.invalidate)(list(room_ids))
+
+
+def on_message_deleted(sender, instance, **kwargs):
+    """
+    Drops the recent messages buffer of the room of a deleted
+      message, once the deletion is committed (so the buffer is
+      not primed again with the message in the meantime).
+    :param sender: The Message class.
+    :param instance: The deleted message.
+    """
+
+    room_id = instance.room_id
+    transaction.on_commit(lambda: invalidate_rooms([room_id]))
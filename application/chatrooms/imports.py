@@ -0,0 +1,218 @@
+import csv
+import io
+import json
+import re
+import time
+from django.contrib.auth.models import User
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import Message, Room
+from .partitions import month_start, partitions, ensure_partitions
+
+
+# The import formats.
+IMPORT_FORMATS = ('ndjson', 'csv')
+# The rows validated, and copied into the database, at a time.
+IMPORT_BATCH_SIZE = 10000
+# The fields of the imported rows (as given by the exports).
+# Other fields (e.g. the id) are ignored: new ids are assigned.
+IMPORT_FIELDS = ('created_on', 'user', 'room', 'content')
+CONTENT_MAX_LENGTH = Message._meta.get_field('content').max_length
+
+
+def read_records(stream, format_):
+    """
+    Reads the records of an NDJSON or CSV (with a header) input,
+      one at a time.
+    :param stream: A text stream.
+    :param format_: One of the IMPORT_FORMATS.
+    :return: An iterator of (line number, record, error) tuples.
+      The record is a dict, or None if it could not be read
+      (then, the error tells why).
+    """
+
+    if format_ == 'csv':
+        # The line number is the one where the record ends.
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record, None
+    else:
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_number, None, "invalid JSON: %s" % (e,)
+                continue
+            if isinstance(record, dict):
+                yield line_number, record, None
+            else:
+                yield line_number, None, "not a JSON object"
+
+
+def drop_indexes():
+    """
+    Drops the secondary indexes of the message table (and of all
+      its partitions), so a bulk load does not update them row by
+      row. Only the primary key is kept.
+    :return: The (name, definition) pairs of the dropped indexes,
+      to create them again by means of create_indexes. The
+      definitions are not restricted to the parent table (i.e.
+      ON ONLY), so they create the indexes of all the partitions.
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT index_class.relname, pg_get_indexdef(pg_index.indexrelid) FROM pg_index "
+            "JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid "
+            "WHERE pg_index.indrelid = %s::regclass AND NOT pg_index.indisprimary ORDER BY 1",
+            [Message._meta.db_table]
+        )
+        indexes = [(name, re.sub(r' ON ONLY ', ' ON ', definition, count=1))
+                   for name, definition in cursor.fetchall()]
+        for name, _ in indexes:
+            cursor.execute('DROP INDEX %s' % connection.ops.quote_name(name))
+    return indexes
+
+
+def create_indexes(indexes):
+    """
+    Creates again the indexes dropped by drop_indexes. Each index
+      is built at once (which is much faster than row by row).
+    :param indexes: The (name, definition) pairs of the indexes.
+    """
+
+    with connection.cursor() as cursor:
+        for _, definition in indexes:
+            cursor.execute(definition)
+
+
+class MessageImporter:
+    """
+    Imports messages in bulk: the records are validated in batches,
+      resolving the usernames and room names by means of lookup
+      maps (loaded once), and each batch of valid rows is streamed
+      into the message table by a single COPY. The partitions of
+      the imported months are created as needed.
+    """
+
+    def __init__(self, batch_size=IMPORT_BATCH_SIZE, on_rejected=None, on_progress=None):
+        """
+        :param batch_size: The amount of records per batch.
+        :param on_rejected: An optional function, called with the
+          line number, the record (or None) and the reason of each
+          rejected record.
+        :param on_progress: An optional function, called with the
+          stats after each batch.
+        """
+
+        self.batch_size = batch_size
+        self.on_rejected = on_rejected
+        self.on_progress = on_progress
+        self.users = dict(User.objects.values_list('username', 'id'))
+        self.rooms = dict(Room.objects.values_list('name', 'id'))
+        self._months = {month for month, _ in partitions()}
+        self.stats = {'read': 0, 'imported': 0, 'rejected': 0, 'seconds': 0.0}
+
+    def validate(self, record):
+        """
+        Validates a record, and resolves its user and room.
+        :param record: The record.
+        :return: The (created_on, content, room_id, user_id) row.
+        :raises ValueError: If the record is not valid.
+        """
+
+        missing = [field for field in IMPORT_FIELDS if record.get(field) in (None, '')]
+        if missing:
+            raise ValueError("missing fields: %s" % ', '.join(missing))
+        created_on, username, room_name, content = [record[field] for field in IMPORT_FIELDS]
+        if not all(isinstance(value, str) for value in (created_on, username, room_name, content)):
+            raise ValueError("fields must be strings")
+        stamp = parse_datetime(created_on)
+        if stamp is None:
+            raise ValueError("invalid created_on: %s" % created_on)
+        if timezone.is_naive(stamp):
+            stamp = timezone.make_aware(stamp)
+        if len(content) > CONTENT_MAX_LENGTH:
+            raise ValueError("content longer than %d characters" % CONTENT_MAX_LENGTH)
+        if '\x00' in content:
+            raise ValueError("content has null characters")
+        user_id = self.users.get(username)
+        if user_id is None:
+            raise ValueError("unknown user: %s" % username)
+        room_id = self.rooms.get(room_name)
+        if room_id is None:
+            raise ValueError("unknown room: %s" % room_name)
+        return stamp, content, room_id, user_id
+
+    def _reject(self, line_number, record, reason):
+        self.stats['rejected'] += 1
+        if self.on_rejected:
+            self.on_rejected(line_number, record, reason)
+
+    def _copy(self, rows):
+        """
+        Copies a batch of valid rows into the message table.
+        :param rows: The (created_on, content, room_id, user_id) rows.
+        """
+
+        months = {month_start(row[0]) for row in rows} - self._months
+        if months:
+            ensure_partitions(min(months), max(months))
+            self._months.update(months)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for created_on, content, room_id, user_id in rows:
+            writer.writerow((created_on.isoformat(), content, room_id, user_id))
+        buffer.seek(0)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                'COPY %s (created_on, content, room_id, user_id) FROM STDIN WITH (FORMAT csv)' %
+                connection.ops.quote_name(Message._meta.db_table), buffer
+            )
+
+    def _flush(self, batch):
+        """
+        Validates a batch of records, reports the rejected ones,
+          and copies the valid ones.
+        :param batch: The (line number, record, error) tuples.
+        """
+
+        started = time.perf_counter()
+        rows = []
+        for line_number, record, error in batch:
+            if error is None:
+                try:
+                    rows.append(self.validate(record))
+                    continue
+                except ValueError as e:
+                    error = str(e)
+            self._reject(line_number, record, error)
+        if rows:
+            self._copy(rows)
+        self.stats['read'] += len(batch)
+        self.stats['imported'] += len(rows)
+        self.stats['seconds'] += time.perf_counter() - started
+        if self.on_progress:
+            self.on_progress(dict(self.stats))
+
+    def run(self, records):
+        """
+        Imports all the records.
+        :param records: The (line number, record, error) tuples,
+          as given by read_records.
+        :return: The stats: records read, imported and rejected,
+          and the seconds spent validating and copying.
+        """
+
+        batch = []
+        for entry in records:
+            batch.append(entry)
+            if len(batch) >= self.batch_size:
+                self._flush(batch)
+                batch = []
+        if batch:
+            self._flush(batch)
+        return self.stats
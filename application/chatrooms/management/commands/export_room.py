@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...export import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, export_room, parse_bound
+from ...models import Room
+
+
+class Command(BaseCommand):
+    """
+    Exports the transcript of a room (all its messages, or the
+      ones in a date range) as NDJSON or CSV, streamed from a
+      server-side cursor.
+    """
+
+    help = "Exports the messages of a room, as NDJSON or CSV."
+
+    def add_arguments(self, parser):
+        parser.add_argument('room_name', help="The name of the room to export.")
+        parser.add_argument('--format', dest='format_', choices=list(EXPORT_FORMATS), default='ndjson',
+                            help="The export format.")
+        parser.add_argument('--since', help="Only export the messages created at or after this ISO date/datetime.")
+        parser.add_argument('--until', help="Only export the messages created before this ISO date/datetime.")
+        parser.add_argument('--output', help="The file to export to. By default, the standard output.")
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE,
+                            help="The amount of messages fetched from the database at a time.")
+
+    def handle(self, *args, room_name, format_, since, until, output, chunk_size, **options):
+        try:
+            since = parse_bound(since) if since else None
+            until = parse_bound(until) if until else None
+        except ValueError as e:
+            raise CommandError(str(e))
+        room = Room.objects.filter(name=room_name).first()
+        if room is None:
+            raise CommandError("Room does not exist: %s" % room_name)
+
+        blocks = export_room(room, format_, since, until, chunk_size)
+        size = 0
+        if output:
+            with open(output, 'wb') as stream:
+                for block in blocks:
+                    stream.write(block)
+                    size += len(block)
+        else:
+            # The blocks hold whole lines, so they are decoded by themselves.
+            for block in blocks:
+                self.stdout.write(block.decode('utf-8'), ending='')
+                size += len(block)
+        self.stderr.write("Exported %d bytes of room %s" % (size, room_name))
@@ -0,0 +1,74 @@
+import json
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from ...imports import IMPORT_BATCH_SIZE, IMPORT_FORMATS, MessageImporter, read_records, drop_indexes, \
+    create_indexes
+from ...models import Message
+
+
+class Command(BaseCommand):
+    """
+    Imports messages in bulk (e.g. the history of another chat
+      system), from NDJSON or CSV, by means of COPY. The records
+      have the `created_on`, `user`, `room` and `content` fields
+      (like the exports), and the users and rooms must exist.
+    """
+
+    help = "Imports messages in bulk, from NDJSON or CSV."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="The file to import. Use - for the standard input.")
+        parser.add_argument('--format', dest='format_', choices=IMPORT_FORMATS,
+                            help="The input format. By default, told by the file extension (or NDJSON).")
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE,
+                            help="The amount of records validated, and copied, at a time.")
+        parser.add_argument('--rejects',
+                            help="A file to write the rejected records into (as NDJSON, with their line "
+                                 "number and the reason).")
+        parser.add_argument('--drop-indexes', dest='without_indexes', action='store_true',
+                            help="Drops the secondary message indexes during the import, and builds them again "
+                                 "afterwards. Much faster for large imports, but the chat and the admin will "
+                                 "be slow meanwhile.")
+
+    def handle(self, *args, path, format_, batch_size, rejects, without_indexes, **options):
+        if format_ is None:
+            format_ = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+        try:
+            stream = sys.stdin if path == '-' else open(path, newline='' if format_ == 'csv' else None,
+                                                         encoding='utf-8')
+        except OSError as e:
+            raise CommandError("Could not open the input: %s" % (e,))
+        rejects_stream = open(rejects, 'w', encoding='utf-8') if rejects else None
+
+        def on_rejected(line_number, record, reason):
+            if rejects_stream:
+                rejects_stream.write(json.dumps({"line": line_number, "reason": reason, "record": record}) + '\n')
+
+        def on_progress(stats):
+            self.stdout.write("Read %d records: %d imported, %d rejected (%.0f records/s)" % (
+                stats['read'], stats['imported'], stats['rejected'], stats['read'] / max(stats['seconds'], 1e-6)
+            ))
+
+        indexes = []
+        try:
+            if without_indexes:
+                indexes = drop_indexes()
+                for name, definition in indexes:
+                    # Told in advance, should the import be interrupted.
+                    self.stdout.write("Dropped index %s: %s" % (name, definition))
+            importer = MessageImporter(batch_size, on_rejected, on_progress)
+            stats = importer.run(read_records(stream, format_))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            if rejects_stream:
+                rejects_stream.close()
+            if indexes:
+                self.stdout.write("Creating the %d dropped indexes" % len(indexes))
+                create_indexes(indexes)
+
+        # The planner statistics are refreshed for the new rows.
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE %s' % connection.ops.quote_name(Message._meta.db_table))
+        self.stdout.write("Imported %d messages (%d rejected)" % (stats['imported'], stats['rejected']))
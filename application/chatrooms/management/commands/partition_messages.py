@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from ...history import invalidate_rooms
+from ...partitions import add_months, month_start, ensure_partitions, retention_cutoffs, purge_room_messages, \
+    expired_partitions, detach_partition, archive_partition
+
+
+class Command(BaseCommand):
+    """
+    Maintains the monthly partitions of the message table. Meant
+      to be run daily (e.g. from cron): it creates the partitions
+      of the coming months, detaches (or archives) the partitions
+      which only hold expired messages, and deletes the remaining
+      expired messages of each room. The recent messages buffers
+      of the affected rooms are invalidated afterwards.
+    """
+
+    help = "Creates the upcoming message partitions, and applies the message retention."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=3,
+                            help="Amount of months, after the current one, to have partitions for.")
+        parser.add_argument('--archive-dir',
+                            help="Directory to dump the expired partitions into (as gzipped CSV files) before "
+                                 "dropping them. When not given, they are only detached.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only tell what would be done.")
+
+    def handle(self, *args, ahead, archive_dir, dry_run, **options):
+        now = timezone.now()
+        if dry_run:
+            self.stdout.write("Partitions needed up to: %s" % (add_months(month_start(now), ahead).strftime('%Y-%m'),))
+        else:
+            for name in ensure_partitions(now, add_months(month_start(now), ahead)):
+                self.stdout.write("Created partition: %s" % (name,))
+
+        # The partitions holding only expired messages are let go as a
+        # whole, first, so the messages are not deleted one by one.
+        cutoffs = retention_cutoffs(now)
+        affected = set()
+        for _, name in expired_partitions(cutoffs):
+            if dry_run:
+                self.stdout.write("Expired partition: %s" % (name,))
+            elif archive_dir:
+                self.stdout.write("Archived partition: %s into %s" % (name, archive_partition(name, archive_dir)))
+            else:
+                self.stdout.write("Detached partition: %s as %s" % (name, detach_partition(name)))
+            # Any room may have had messages there.
+            affected.update(cutoffs)
+
+        for room_id, cutoff in cutoffs.items():
+            if cutoff is None:
+                continue
+            if dry_run:
+                self.stdout.write("Messages of room %d older than: %s" % (room_id, cutoff.isoformat()))
+            else:
+                deleted = purge_room_messages(room_id, cutoff)
+                if deleted:
+                    self.stdout.write("Deleted %d messages of room %d" % (deleted, room_id))
+                    affected.add(room_id)
+        if affected and not dry_run:
+            invalidate_rooms(affected)
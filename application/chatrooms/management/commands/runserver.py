@@ -0,0 +1,11 @@
+from channels.management.commands.runserver import Command as ChannelsRunserverCommand
+from ...compression import CompressingServer
+
+
+class Command(ChannelsRunserverCommand):
+    """
+    The channels development server, negotiating permessage-deflate
+      compression (see the CHATROOMS_COMPRESSION setting).
+    """
+
+    server_cls = CompressingServer
@@ -0,0 +1,246 @@
+import bisect
+import threading
+import time
+from channels.db import database_sync_to_async
+from .profiling import spending
+
+
+# Buckets of the latency histograms, in seconds, and of the
+# size histograms (e.g. the broadcast fan-out).
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+def _format_labels(labels):
+    """
+    :param labels: A sequence of (name, value) label pairs.
+    :return: The labels in the Prometheus text format.
+    """
+
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')) for name, value in labels)
+
+
+def _format_value(value):
+    """
+    :param value: A sample value.
+    :return: The value in the Prometheus text format.
+    """
+
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A metric of the registry, holding a value per combination
+      of its labels. Metrics may be updated from any thread
+      (e.g. the ones running database_sync_to_async).
+    """
+
+    kind = None
+
+    def __init__(self, name, help_, labels=()):
+        """
+        :param name: The metric name.
+        :param help_: The metric description.
+        :param labels: The label names.
+        """
+
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self):
+        """
+        :return: A list of (name, labels, value) samples.
+        """
+
+        with self._lock:
+            return [(self.name, tuple(zip(self.labels, key)), value) for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    """
+    A value which only goes up.
+    """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value which goes up and down.
+    """
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """
+    Counts the observed values in cumulative buckets, also
+      keeping their sum and count.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        for name, labels, (counts, total) in super().samples():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((name + '_bucket', labels + (('le', _format_value(bound)),), cumulative))
+            samples.append((name + '_sum', labels, total))
+            samples.append((name + '_count', labels, cumulative))
+        return samples
+
+
+class Registry:
+    """
+    The in-process metrics registry. Besides its own metrics, it
+      renders the ones given by the collectors: functions called
+      on each scrape, which read the stats already kept by other
+      components (e.g. the outbound queues).
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_, labels=()):
+        return self._add(Counter(name, help_, labels))
+
+    def gauge(self, name, help_, labels=()):
+        return self._add(Gauge(name, help_, labels))
+
+    def histogram(self, name, help_, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help_, labels, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, func):
+        """
+        Registers a collector. It may be used as a decorator.
+        :param func: A function returning a list of metrics, whose
+          values are set on each call.
+        :return: The same function.
+        """
+
+        self._collectors.append(func)
+        return func
+
+    def collect(self):
+        """
+        :return: All the metrics, including the collected ones.
+        """
+
+        metrics = list(self._metrics)
+        for collector in self._collectors:
+            metrics.extend(collector())
+        return metrics
+
+    def render(self):
+        """
+        :return: All the metrics, in the Prometheus text format.
+        """
+
+        lines = []
+        for metric in self.collect():
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+COMMANDS = registry.counter('chatrooms_commands_total', 'Websocket commands received, by type.', ('type',))
+GROUP_SEND_SECONDS = registry.histogram(
+    'chatrooms_group_send_seconds', 'Time taken by the channel layer group_send calls.', ('event',)
+)
+BROADCAST_FANOUT = registry.histogram(
+    'chatrooms_broadcast_fanout', 'Room members of this process reached by each broadcast.', ('event',),
+    SIZE_BUCKETS
+)
+DB_WAIT_SECONDS = registry.histogram(
+    'chatrooms_db_wait_seconds', 'Time database calls waited for a database_sync_to_async thread.', ('operation',)
+)
+DB_EXECUTION_SECONDS = registry.histogram(
+    'chatrooms_db_execution_seconds', 'Time database calls ran in a database_sync_to_async thread.', ('operation',)
+)
+HISTORY_QUERY_SECONDS = registry.histogram(
+    'chatrooms_history_query_seconds', 'Time taken by the room history queries.', ('page',)
+)
+SEARCH_QUERY_SECONDS = registry.histogram(
+    'chatrooms_search_query_seconds', 'Time taken by the message search queries.'
+)
+WRITER_FLUSH_SIZE = registry.histogram(
+    'chatrooms_writer_flush_size', 'Chat messages inserted by each write-behind flush.', (), SIZE_BUCKETS
+)
+WRITER_FLUSH_LAG_SECONDS = registry.histogram(
+    'chatrooms_writer_flush_lag_seconds', 'Time the oldest message of each write-behind flush waited to be inserted.'
+)
+
+
+def timed_database_sync_to_async(func, operation=None):
+    """
+    Like database_sync_to_async, but also measures how long each
+      call waits for a thread, and how long it runs there. The
+      whole call is also tracked as time spent in the database
+      by the command being handled.
+    :param func: The sync function to wrap.
+    :param operation: The operation label. By default, the name
+      of the function.
+    :return: The coroutine function.
+    """
+
+    operation = operation or func.__name__
+
+    async def call(*args, **kwargs):
+        submitted = time.perf_counter()
+
+        def run():
+            started = time.perf_counter()
+            DB_WAIT_SECONDS.observe(started - submitted, operation=operation)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                DB_EXECUTION_SECONDS.observe(time.perf_counter() - started, operation=operation)
+
+        with spending("db"):
+            return await database_sync_to_async(run)()
+
+    return call
@@ -0,0 +1,20 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # The index is built concurrently, so the message
+    # table is not locked against writes meanwhile.
+    atomic = False
+
+    dependencies = [
+        ('chatrooms', '0002_auto_20200928_1513'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='message',
+            index=models.Index(fields=['room', 'created_on', 'id'], name='chatrooms_msg_room_created_idx'),
+        ),
+    ]
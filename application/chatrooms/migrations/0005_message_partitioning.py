@@ -0,0 +1,129 @@
+from django.conf import settings
+from django.db import migrations, models
+
+
+# The message table is rebuilt as a table partitioned by month on
+# created_on, with partitions for all the months from the oldest
+# message to 3 months ahead. Later partitions are created by the
+# partition_messages command (run daily by the maintenance service
+# of the compose file) or, when missing, on demand by the message
+# inserts (see chatrooms.partitions). The rows are copied, so the table is
+# locked meanwhile. The primary key must include the partition
+# key, so it becomes (id, created_on). The ids keep coming from
+# the same sequence.
+PARTITION_MESSAGES = [
+    "ALTER TABLE chatrooms_message RENAME TO chatrooms_message_unpartitioned",
+    "ALTER INDEX chatrooms_message_pkey RENAME TO chatrooms_message_unpartitioned_pkey",
+    "ALTER INDEX chatrooms_msg_room_created_idx RENAME TO chatrooms_msg_room_created_unpartitioned_idx",
+    """
+    CREATE TABLE chatrooms_message (
+        id integer NOT NULL DEFAULT nextval('chatrooms_message_id_seq'),
+        created_on timestamp with time zone NOT NULL,
+        content varchar(512) NOT NULL,
+        room_id integer NOT NULL REFERENCES chatrooms_room (id) DEFERRABLE INITIALLY DEFERRED,
+        user_id integer NOT NULL REFERENCES auth_user (id) DEFERRABLE INITIALLY DEFERRED,
+        PRIMARY KEY (id, created_on)
+    ) PARTITION BY RANGE (created_on)
+    """,
+    "ALTER SEQUENCE chatrooms_message_id_seq OWNED BY chatrooms_message.id",
+    """
+    DO $$
+    DECLARE
+        month timestamp;
+        last_month timestamp := date_trunc('month', now() AT TIME ZONE 'UTC') + interval '3 months';
+    BEGIN
+        SELECT date_trunc('month', coalesce(min(created_on), now()) AT TIME ZONE 'UTC') INTO month
+        FROM chatrooms_message_unpartitioned;
+        WHILE month <= last_month LOOP
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF chatrooms_message FOR VALUES FROM (%L) TO (%L)',
+                'chatrooms_message_p' || to_char(month, 'YYYY_MM'),
+                month AT TIME ZONE 'UTC', (month + interval '1 month') AT TIME ZONE 'UTC'
+            );
+            month := month + interval '1 month';
+        END LOOP;
+    END $$
+    """,
+    # The foreign keys are checked right away, so the
+    # indexes may be created in the same transaction.
+    "SET CONSTRAINTS ALL IMMEDIATE",
+    """
+    INSERT INTO chatrooms_message (id, created_on, content, room_id, user_id)
+    SELECT id, created_on, content, room_id, user_id FROM chatrooms_message_unpartitioned
+    """,
+    "DROP TABLE chatrooms_message_unpartitioned",
+    "CREATE INDEX chatrooms_msg_room_created_idx ON chatrooms_message (room_id, created_on, id)",
+    "CREATE INDEX chatrooms_message_user_id_idx ON chatrooms_message (user_id)",
+]
+
+
+# Rebuilds the plain message table, out of all the attached partitions.
+UNPARTITION_MESSAGES = [
+    "ALTER TABLE chatrooms_message RENAME TO chatrooms_message_partitioned",
+    "ALTER INDEX chatrooms_message_pkey RENAME TO chatrooms_message_partitioned_pkey",
+    "ALTER INDEX chatrooms_msg_room_created_idx RENAME TO chatrooms_msg_room_created_partitioned_idx",
+    "ALTER INDEX chatrooms_message_user_id_idx RENAME TO chatrooms_message_user_id_partitioned_idx",
+    """
+    CREATE TABLE chatrooms_message (
+        id integer NOT NULL DEFAULT nextval('chatrooms_message_id_seq') PRIMARY KEY,
+        created_on timestamp with time zone NOT NULL,
+        content varchar(512) NOT NULL,
+        room_id integer NOT NULL REFERENCES chatrooms_room (id) DEFERRABLE INITIALLY DEFERRED,
+        user_id integer NOT NULL REFERENCES auth_user (id) DEFERRABLE INITIALLY DEFERRED
+    )
+    """,
+    "ALTER SEQUENCE chatrooms_message_id_seq OWNED BY chatrooms_message.id",
+    "SET CONSTRAINTS ALL IMMEDIATE",
+    """
+    INSERT INTO chatrooms_message (id, created_on, content, room_id, user_id)
+    SELECT id, created_on, content, room_id, user_id FROM chatrooms_message_partitioned
+    """,
+    "DROP TABLE chatrooms_message_partitioned",
+    "CREATE INDEX chatrooms_msg_room_created_idx ON chatrooms_message (room_id, created_on, id)",
+    # The foreign key indexes get back the names Django gave them.
+    "CREATE INDEX chatrooms_message_room_id_acbfa9b1 ON chatrooms_message (room_id)",
+    "CREATE INDEX chatrooms_message_user_id_2be58c06 ON chatrooms_message (user_id)",
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chatrooms', '0004_message_created_on_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='retention_days',
+            field=models.PositiveIntegerField(
+                blank=True, null=True, help_text='Days the messages are kept. If empty, the '
+                                                 'CHATROOMS_MESSAGE_RETENTION_DAYS setting applies.'
+            ),
+        ),
+        # The room index is served by the (room, created_on, id) one,
+        # and the user index has its own name: the state tells so.
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(PARTITION_MESSAGES, UNPARTITION_MESSAGES),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='message',
+                    name='room',
+                    field=models.ForeignKey(db_index=False, on_delete=models.deletion.PROTECT, to='chatrooms.Room'),
+                ),
+                migrations.AlterField(
+                    model_name='message',
+                    name='user',
+                    field=models.ForeignKey(db_index=False, on_delete=models.deletion.PROTECT,
+                                            to=settings.AUTH_USER_MODEL),
+                ),
+                migrations.AddIndex(
+                    model_name='message',
+                    index=models.Index(fields=['user'], name='chatrooms_message_user_id_idx'),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations
+
+
+# The search vector of the messages is a generated column (so it
+# is kept by the database itself, and it is not part of the
+# model), with a GIN index for the full-text searches. Both are
+# propagated to all the partitions. Adding the column rewrites
+# the table, so it is locked meanwhile.
+ADD_SEARCH_VECTOR = [
+    """
+    ALTER TABLE chatrooms_message ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED
+    """,
+    "CREATE INDEX chatrooms_message_search_idx ON chatrooms_message USING gin (search_vector)",
+]
+
+
+REMOVE_SEARCH_VECTOR = [
+    "DROP INDEX chatrooms_message_search_idx",
+    "ALTER TABLE chatrooms_message DROP COLUMN search_vector",
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatrooms', '0005_message_partitioning'),
+    ]
+
+    operations = [
+        migrations.RunSQL(ADD_SEARCH_VECTOR, REMOVE_SEARCH_VECTOR),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatrooms', '0006_message_search_vector'),
+    ]
+
+    # The indexes cannot be built concurrently on the partitioned
+    # message table, so it is locked against writes meanwhile.
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['created_on', 'id'], name='chatrooms_msg_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['user', 'created_on', 'id'], name='chatrooms_msg_user_created_idx'),
+        ),
+        # The user index is superseded by the (user, created_on, id) one.
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    "DROP INDEX chatrooms_message_user_id_idx",
+                    "CREATE INDEX chatrooms_message_user_id_idx ON chatrooms_message (user_id)"
+                ),
+            ],
+            state_operations=[
+                migrations.RemoveIndex(
+                    model_name='message',
+                    name='chatrooms_message_user_id_idx',
+                ),
+            ],
+        ),
+    ]
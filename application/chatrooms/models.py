@@ -1,15 +1,21 @@
 from django.core.validators import RegexValidator
 from django.db import models
+from django.utils import timezone
 
 
 class Room(models.Model):
     """
-    Chat rooms have only its name as relevant value.
+    Chat rooms have only its name as relevant value, and
+      perhaps how long their messages are kept.
     """
 
     created_on = models.DateTimeField(auto_now_add=True, editable=False)
     updated_on = models.DateTimeField(auto_now=True, editable=False)
     name = models.CharField(max_length=50, validators=[RegexValidator("^[a-zA-Z][a-zA-Z0-9_]*?(-[a-zA-Z0-9_]+)*$")])
+    retention_days = models.PositiveIntegerField(
+        null=True, blank=True, help_text="Days the messages are kept. If empty, the "
+                                         "CHATROOMS_MESSAGE_RETENTION_DAYS setting applies."
+    )
 
     def __str__(self):
         return self.name
@@ -22,9 +28,30 @@ class Message(models.Model):
     """
     These messages exist as a log, and will be restored
       when the server is started, in a per-channel basis.
+
+    The creation date is assigned by the server when the message
+      is received (instead of when it is inserted), since they may
+      be inserted later, in bulk.
+
+    The table is partitioned by month on the creation date (see
+      the partitions module), so its primary key is actually the
+      (id, created_on) pair. The ids are still unique, since they
+      come from a single sequence.
     """
 
-    created_on = models.DateTimeField(auto_now_add=True, editable=False)
-    user = models.ForeignKey('auth.User', on_delete=models.PROTECT)
-    room = models.ForeignKey(Room, on_delete=models.PROTECT)
+    created_on = models.DateTimeField(default=timezone.now, editable=False)
+    # Served by the (user, created_on, id) index instead.
+    user = models.ForeignKey('auth.User', on_delete=models.PROTECT, db_index=False)
+    # Served by the (room, created_on, id) index instead.
+    room = models.ForeignKey(Room, on_delete=models.PROTECT, db_index=False)
     content = models.CharField(max_length=512)
+
+    class Meta:
+        indexes = [
+            # Serves the room history, newest first, paged by (created_on, id).
+            models.Index(fields=['room', 'created_on', 'id'], name='chatrooms_msg_room_created_idx'),
+            # Serve the admin message list, newest first, paged by
+            # (created_on, id), by itself or filtered by user.
+            models.Index(fields=['created_on', 'id'], name='chatrooms_msg_created_idx'),
+            models.Index(fields=['user', 'created_on', 'id'], name='chatrooms_msg_user_created_idx'),
+        ]
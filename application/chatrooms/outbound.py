@@ -0,0 +1,271 @@
+import collections
+from daphne.ws_protocol import WebSocketProtocol
+from django.conf import settings
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+from . import metrics
+from .codecs import json_codec, negotiate_codec
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+POLICIES = ('drop-oldest', 'coalesce-presence', 'disconnect')
+
+
+# Process-wide counters of all the outbound queues.
+totals = collections.Counter()
+
+
+class OutboundQueue:
+    """
+    A bounded queue of the frames pending to be sent through a
+      connection. Frames are written right away while the queue
+      is running, and queued while it is paused (i.e. while the
+      write buffer of the connection is full, because its client
+      is slow to read). Queued frames are written, in order, when
+      it is resumed.
+
+    When the queue reaches its high-water mark, the policy
+      decides what to do with a new frame:
+
+    - drop-oldest: The oldest pending frame is dropped.
+    - coalesce-presence: Pending presence (joined/parted) frames
+      superseded by a newer one of the same user and room are
+      dropped. If none, the oldest presence frame is dropped,
+      and only then the oldest frame.
+    - disconnect: The pending frames are dropped, and the client
+      is disconnected (with a "slow-consumer" fatal code).
+    """
+
+    def __init__(self, write, high_water=1000, policy='drop-oldest', disconnect=None):
+        """
+        :param write: A function writing a frame to the connection.
+        :param high_water: The maximum amount of pending frames.
+        :param policy: What to do when the queue is full.
+        :param disconnect: A function disconnecting the client,
+          under the disconnect policy.
+        """
+
+        if policy not in POLICIES:
+            raise ValueError("Unknown outbound queue policy: %s" % policy)
+        self.write = write
+        self.high_water = high_water
+        self.policy = policy
+        self.disconnect = disconnect
+        self._items = collections.deque()
+        self._paused = False
+        self._closing = False
+        self._stats = {"max_depth": 0, "dropped": 0, "coalesced": 0}
+
+    def stats(self):
+        """
+        :return: The stats of this queue.
+        """
+
+        return dict(self._stats, depth=len(self._items), paused=self._paused)
+
+    def put(self, frame, presence=None, close=False):
+        """
+        Writes a frame, or queues it if the queue is paused (or
+          other frames are still pending).
+        :param frame: The frame to write.
+        :param presence: A (room name, user name) key, if the frame
+          is a presence notification which may be coalesced.
+        :param close: Whether the frame closes the connection. It
+          is always queued, and no frame is accepted after it.
+        """
+
+        if self._closing:
+            return
+        self._closing = close
+        if not self._paused and not self._items:
+            self.write(frame)
+            return
+        if len(self._items) >= self.high_water and not close:
+            if self.policy == 'disconnect':
+                self._disconnect()
+                return
+            elif self.policy == 'coalesce-presence':
+                self._coalesce()
+            else:
+                self._drop(0)
+        self._items.append((frame, presence))
+        depth = len(self._items)
+        if depth > self._stats["max_depth"]:
+            self._stats["max_depth"] = depth
+            totals["max_depth"] = max(totals["max_depth"], depth)
+
+    def pause(self):
+        """
+        Pauses the queue: frames are queued until it is resumed.
+        """
+
+        self._paused = True
+
+    def resume(self):
+        """
+        Resumes the queue, writing the pending frames in order. If
+          a write fills the buffer of the connection again (i.e. it
+          pauses the queue), the remaining frames keep waiting.
+        """
+
+        self._paused = False
+        while self._items and not self._paused:
+            frame, _ = self._items.popleft()
+            self.write(frame)
+
+    def _drop(self, index):
+        """
+        Drops a pending frame.
+        :param index: The index of the frame to drop.
+        """
+
+        del self._items[index]
+        if not self._stats["dropped"]:
+            logger.warning("Dropping outbound frames of a slow connection")
+        self._stats["dropped"] += 1
+        totals["dropped"] += 1
+
+    def _coalesce(self):
+        """
+        Makes room in the queue by dropping presence frames.
+        """
+
+        seen = set()
+        kept = collections.deque()
+        for frame, presence in reversed(self._items):
+            if presence is not None and presence in seen:
+                self._stats["coalesced"] += 1
+                totals["coalesced"] += 1
+                continue
+            if presence is not None:
+                seen.add(presence)
+            kept.appendleft((frame, presence))
+        self._items = kept
+        if len(self._items) >= self.high_water:
+            index = next((index for index, (_, presence) in enumerate(self._items) if presence is not None), 0)
+            self._drop(index)
+
+    def _disconnect(self):
+        """
+        Drops all the pending frames, and disconnects the client.
+        """
+
+        logger.warning("Disconnecting a slow connection with %d pending frames" % len(self._items))
+        self._stats["dropped"] += len(self._items)
+        totals["dropped"] += len(self._items)
+        totals["disconnected"] += 1
+        self.stop()
+        if self.disconnect:
+            self.disconnect()
+
+    def stop(self):
+        """
+        Stops the queue. Pending frames are discarded.
+        """
+
+        self._closing = True
+        self._items.clear()
+
+
+def build_outbound_queue(write, disconnect=None):
+    """
+    Builds the outbound queue of a connection according to the
+      CHATROOMS_OUTBOUND_QUEUE setting (the high_water mark and
+      the policy). When absent or empty, there is no queue.
+    :param write: The function writing a frame.
+    :param disconnect: The function disconnecting the client.
+    :return: The outbound queue, or None.
+    """
+
+    config = getattr(settings, 'CHATROOMS_OUTBOUND_QUEUE', None)
+    if not config:
+        return None
+    return OutboundQueue(write, disconnect=disconnect, **config)
+
+
+@implementer(IPushProducer)
+class QueueingWebSocketProtocol(WebSocketProtocol):
+    """
+    A daphne websocket protocol bounding the frames pending to be
+      sent to a slow client. It becomes the producer of its own
+      transport, which pauses it while the write buffer is full
+      (i.e. above the transport's bufferSize) and resumes it once
+      the buffer is drained. Meanwhile, the frames sent by the
+      application wait in an outbound queue, under its policy.
+
+    The frames of presence notifications carry a "presence" key
+      ([room name, user name]) in their websocket.send message,
+      so they can be coalesced.
+    """
+
+    outbound = None
+    codec = json_codec
+
+    def connectionMade(self):
+        super().connectionMade()
+        self.outbound = build_outbound_queue(self._write, self._disconnect)
+        if self.outbound is not None:
+            # The HTTP channel which upgraded the connection is still
+            # registered as the producer of the transport.
+            self.transport.unregisterProducer()
+            self.transport.registerProducer(self, True)
+
+    def handle_reply(self, message):
+        if message.get("type") == "websocket.accept":
+            self.codec = negotiate_codec([message.get("subprotocol")])
+        if self.outbound is None or self.state == self.STATE_CONNECTING or \
+                message.get("type") not in ("websocket.send", "websocket.close"):
+            super().handle_reply(message)
+        else:
+            presence = message.get("presence")
+            self.outbound.put(message, tuple(presence) if presence else None, message["type"] == "websocket.close")
+
+    def _write(self, message):
+        """
+        Writes a websocket.send or websocket.close message.
+        :param message: The message to write.
+        """
+
+        super().handle_reply(message)
+
+    def _disconnect(self):
+        """
+        Closes the connection with a "slow-consumer" fatal code.
+        """
+
+        frame = self.codec.encode({"type": "fatal", "code": "slow-consumer"})
+        self.sendMessage(frame, self.codec.binary)
+        self.serverClose()
+
+    def onClose(self, wasClean, code, reason):
+        if self.outbound is not None:
+            self.outbound.stop()
+        super().onClose(wasClean, code, reason)
+
+    def pauseProducing(self):
+        self.outbound.pause()
+
+    def resumeProducing(self):
+        self.outbound.resume()
+
+    def stopProducing(self):
+        self.outbound.stop()
+
+
+@metrics.registry.collector
+def collect_totals():
+    """
+    :return: The totals of the outbound queues of this process.
+    """
+
+    max_depth = metrics.Gauge('chatrooms_outbound_max_depth', 'Maximum depth reached by an outbound queue.')
+    max_depth.set(totals["max_depth"])
+    dropped = metrics.Counter('chatrooms_outbound_discarded_total', 'Outbound frames discarded, by reason.', ('reason',))
+    dropped.inc(totals["dropped"], reason='dropped')
+    dropped.inc(totals["coalesced"], reason='coalesced')
+    disconnected = metrics.Counter('chatrooms_outbound_disconnected_total', 'Slow connections disconnected.')
+    disconnected.inc(totals["disconnected"])
+    return [max_depth, dropped, disconnected]
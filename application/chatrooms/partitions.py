@@ -0,0 +1,224 @@
+import datetime
+import gzip
+import os
+import re
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError
+from django.utils import timezone
+from .models import Message, Room
+
+
+# The message table is partitioned by month, on created_on. Each
+# month lives in a chatrooms_message_pYYYY_MM table (in UTC).
+PARENT_TABLE = Message._meta.db_table
+PARTITION_PATTERN = re.compile(r'^%s_p(\d{4})_(\d{2})$' % PARENT_TABLE)
+# The months known to have a partition, in this process.
+_known_months = set()
+
+
+def month_start(moment):
+    """
+    :param moment: An aware datetime.
+    :return: The start of its month, in UTC.
+    """
+
+    moment = moment.astimezone(datetime.timezone.utc)
+    return datetime.datetime(moment.year, moment.month, 1, tzinfo=datetime.timezone.utc)
+
+
+def add_months(month, count):
+    """
+    :param month: The start of a month.
+    :param count: The amount of months to add (or subtract).
+    :return: The start of the resulting month.
+    """
+
+    year, index = divmod(month.year * 12 + month.month - 1 + count, 12)
+    return month.replace(year=year, month=index + 1)
+
+
+def partition_name(month):
+    """
+    :param month: The start of a month.
+    :return: The name of its partition.
+    """
+
+    return '%s_p%04d_%02d' % (PARENT_TABLE, month.year, month.month)
+
+
+def partitions():
+    """
+    :return: The sorted (month, name) pairs of the partitions
+      currently attached to the message table.
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = %s::regclass", [PARENT_TABLE]
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    found = []
+    for name in names:
+        match = PARTITION_PATTERN.match(name)
+        if match:
+            found.append((datetime.datetime(int(match.group(1)), int(match.group(2)), 1,
+                                            tzinfo=datetime.timezone.utc), name))
+    return sorted(found)
+
+
+def ensure_partitions(start, end):
+    """
+    Creates the missing partitions of the months from start to
+      end (both included). There is no default partition (so
+      the partitions may be scanned in order, and the latest
+      history only touches the latest partitions), so the
+      messages of a month without a partition would be rejected:
+      the partitions are created ahead of time, by the
+      partition_messages command, and on demand otherwise (see
+      ensure_month_partition).
+    :param start: A datetime in the first month.
+    :param end: A datetime in the last month.
+    :return: The names of the created partitions.
+    """
+
+    existing = {name for _, name in partitions()}
+    created = []
+    month, last = month_start(start), month_start(end)
+    with connection.cursor() as cursor:
+        while month <= last:
+            name = partition_name(month)
+            if name not in existing:
+                cursor.execute('CREATE TABLE %s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)' % (
+                    connection.ops.quote_name(name), connection.ops.quote_name(PARENT_TABLE)
+                ), [month, add_months(month, 1)])
+                created.append(name)
+            month = add_months(month, 1)
+    return created
+
+
+def ensure_month_partition(moment):
+    """
+    Ensures the partition of a month exists before inserting
+      messages into it, creating it if needed. The months known
+      to have a partition are remembered, so this is usually a
+      set lookup. Another process may be creating the same
+      partition meanwhile, which is not an error.
+    :param moment: A datetime in the month.
+    """
+
+    month = month_start(moment)
+    if month in _known_months:
+        return
+    try:
+        with transaction.atomic():
+            ensure_partitions(month, month)
+    except DatabaseError:
+        if month not in [existing for existing, _ in partitions()]:
+            raise
+    _known_months.add(month)
+
+
+def retention_cutoffs(now=None):
+    """
+    Computes, per room, the date before which its messages
+      expire: its retention_days or, if not set, the default
+      CHATROOMS_MESSAGE_RETENTION_DAYS setting.
+    :param now: The current date.
+    :return: A dict of room id => cutoff date, or None if its
+      messages never expire.
+    """
+
+    now = now or timezone.now()
+    default = getattr(settings, 'CHATROOMS_MESSAGE_RETENTION_DAYS', None)
+    cutoffs = {}
+    for room_id, days in Room.objects.values_list('id', 'retention_days'):
+        days = default if days is None else days
+        cutoffs[room_id] = None if days is None else now - datetime.timedelta(days=days)
+    return cutoffs
+
+
+def expired_partitions(cutoffs):
+    """
+    Tells which partitions only hold expired messages, for all
+      the rooms (i.e. are older than the longest retention).
+    :param cutoffs: The cutoffs, as given by retention_cutoffs.
+    :return: The (month, name) pairs of the expired partitions.
+    """
+
+    if any(cutoff is None for cutoff in cutoffs.values()):
+        return []
+    oldest = min(cutoffs.values()) if cutoffs else None
+    if oldest is None:
+        return []
+    return [(month, name) for month, name in partitions() if add_months(month, 1) <= oldest]
+
+
+def purge_room_messages(room_id, cutoff):
+    """
+    Deletes the expired messages of a room. Only the partitions
+      older than the cutoff are scanned. They are deleted in a
+      single statement, without loading them to send the deletion
+      signals, so the recent messages buffer of the room must be
+      invalidated afterwards (see history.invalidate_rooms).
+    :param room_id: The id of the room.
+    :param cutoff: The date before which its messages expire.
+    :return: The amount of deleted messages.
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM %s WHERE room_id = %%s AND created_on < %%s' % (
+            connection.ops.quote_name(PARENT_TABLE),
+        ), [room_id, cutoff])
+        return cursor.rowcount
+
+
+def detach_partition(name):
+    """
+    Detaches a partition. It is kept as a standalone table,
+      out of the reach of the chat and the admin, renamed after
+      the moment it was detached: the partition of its month may
+      be created again later (e.g. by an import of old messages).
+    :param name: The name of the partition.
+    :return: The new name of the table.
+    """
+
+    detached = '%s_d%s' % (name, timezone.now().strftime('%Y%m%d%H%M%S'))
+    with connection.cursor() as cursor:
+        cursor.execute('ALTER TABLE %s DETACH PARTITION %s' % (
+            connection.ops.quote_name(PARENT_TABLE), connection.ops.quote_name(name)
+        ))
+        cursor.execute('ALTER TABLE %s RENAME TO %s' % (
+            connection.ops.quote_name(name), connection.ops.quote_name(detached)
+        ))
+    # Its month is no longer known to have a partition.
+    _known_months.clear()
+    return detached
+
+
+def archive_partition(name, directory):
+    """
+    Dumps a partition into a gzipped CSV file (with the user
+      and room names, instead of their ids), and drops it.
+    :param name: The name of the partition.
+    :param directory: The directory to store the file in.
+    :return: The path of the file.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '%s.csv.gz' % name)
+    with transaction.atomic():
+        detached = detach_partition(name)
+        with connection.cursor() as cursor, gzip.open(path, 'wt', newline='') as output:
+            cursor.copy_expert(
+                "COPY (SELECT message.id, message.created_on, users.username, rooms.name, message.content "
+                "FROM %s message JOIN %s users ON users.id = message.user_id JOIN %s rooms ON "
+                "rooms.id = message.room_id ORDER BY message.created_on, message.id) "
+                "TO STDOUT WITH (FORMAT csv, HEADER)" % (
+                    connection.ops.quote_name(detached),
+                    connection.ops.quote_name(Message._meta.get_field('user').related_model._meta.db_table),
+                    connection.ops.quote_name(Room._meta.db_table)
+                ), output
+            )
+            cursor.execute('DROP TABLE %s' % connection.ops.quote_name(detached))
+    return path
@@ -0,0 +1,319 @@
+import asyncio
+import atexit
+import collections
+import itertools
+import threading
+import time
+from django.conf import settings
+from django.db import transaction, DataError, IntegrityError
+from django.utils import timezone
+from . import metrics
+from .models import Message
+from .partitions import month_start, ensure_month_partition
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# Every message being broadcast gets a server-assigned sequence
+# number. It is increasing within the same server process only:
+# each process counts on its own, so the numbers given by several
+# processes overlap. They must not be used to order or dedupe the
+# messages of different processes: the (created_on, id) order of
+# the database is the one shared by all of them.
+_sequence = itertools.count(1)
+
+
+def next_sequence():
+    """
+    :return: The next message sequence number of this process.
+    """
+
+    return next(_sequence)
+
+
+class MessageWriter:
+    """
+    A write-behind buffer for the chat messages. Messages are
+      buffered and inserted in bulk, either when a batch is
+      complete or when the flush interval elapses, so storing
+      a message is not in the path of its broadcast anymore.
+
+    The buffer is bounded: when it is full, writers wait for
+      a flush to happen before buffering more messages. If the
+      database is not available, the oldest buffered message is
+      dropped instead.
+
+    Flushing never fails: messages rejected by the database (e.g.
+      their room was deleted meanwhile) are logged and dropped,
+      and the other messages of their batch are still inserted.
+      If the database is not available, the batch is kept in the
+      buffer and retried later.
+
+    Batches are popped and inserted under a lock, so concurrent
+      flushes (the background flusher, the last disconnection and
+      the process shutdown) insert them in order.
+    """
+
+    def __init__(self, max_batch=500, flush_interval=0.25, max_buffer=10000):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._buffer = collections.deque()
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._batch_ready = None
+        self._stats = {
+            "flushes": 0,
+            "flushed": 0,
+            "errors": 0,
+            "dropped": 0,
+            "last_flush_size": 0,
+            "max_flush_size": 0,
+            "last_flush_lag": 0.0,
+            "max_flush_lag": 0.0,
+        }
+
+    def stats(self):
+        """
+        :return: The flush statistics of this writer. Lags are
+          measured in seconds, from the moment the oldest message
+          of a batch was created until the batch was inserted.
+        """
+
+        return dict(self._stats, buffered=len(self._buffer))
+
+    async def write(self, message):
+        """
+        Buffers a message to be inserted later.
+        :param message: An unsaved Message instance.
+        """
+
+        if len(self._buffer) >= self.max_buffer:
+            await self.flush()
+            if len(self._buffer) >= self.max_buffer:
+                self._drop(self._buffer.popleft(), "the buffer is full")
+        self._buffer.append(message)
+        self._ensure_flusher()
+        if len(self._buffer) >= self.max_batch:
+            self._batch_ready.set()
+
+    def _ensure_flusher(self):
+        """
+        Starts the background flusher, if not running.
+        """
+
+        if self._flusher is None or self._flusher.done():
+            self._batch_ready = asyncio.Event()
+            self._flusher = asyncio.ensure_future(self._run_flusher())
+
+    async def _run_flusher(self):
+        """
+        Flushes the buffer each time a batch is complete or the
+          flush interval elapses. It finishes when the buffer is
+          empty, and is started again on the next write.
+        """
+
+        while self._buffer:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+                complete_only = True
+            except asyncio.TimeoutError:
+                complete_only = False
+            self._batch_ready.clear()
+            if not await self.flush(complete_only):
+                # The messages were kept in the buffer. They
+                # will be retried after the flush interval.
+                await asyncio.sleep(self.flush_interval)
+
+    async def flush(self, complete_only=False):
+        """
+        Inserts all the buffered messages, in batches.
+        :param complete_only: Whether to only insert complete
+          batches, leaving the remaining messages buffered.
+        :return: Whether all the batches could be inserted. Otherwise,
+          the database is not available, and the remaining messages
+          are kept in the buffer.
+        """
+
+        minimum = self.max_batch if complete_only else 1
+        while len(self._buffer) >= minimum:
+            if not await metrics.timed_database_sync_to_async(self._flush_batch, 'insert_messages')(minimum):
+                return False
+        return True
+
+    def flush_sync(self):
+        """
+        Inserts all the buffered messages, from a sync context.
+          Intended for the process shutdown.
+        """
+
+        while self._buffer:
+            if not self._flush_batch():
+                logger.error("Could not flush %d buffered messages on shutdown" % len(self._buffer))
+                return
+
+    def _flush_batch(self, minimum=1):
+        """
+        Pops the next batch and inserts it, holding the lock.
+        :param minimum: The minimum amount of buffered messages to
+          insert a batch. Otherwise (e.g. a concurrent flush took
+          them), nothing is done.
+        :return: Whether the batch was processed (see _insert).
+        """
+
+        with self._lock:
+            if len(self._buffer) < minimum:
+                return True
+            return self._insert([self._buffer.popleft() for _ in range(min(len(self._buffer), self.max_batch))])
+
+    def _drop(self, message, reason):
+        """
+        Drops a message which could not be inserted, logging it
+          entirely so it can be recovered by hand.
+        :param message: The message.
+        :param reason: Why it was dropped.
+        """
+
+        logger.error("Dropped message (room: %s, user: %s, created_on: %s, content: %r): %s" % (
+            message.room_id, message.user_id, message.created_on.isoformat(), message.content, reason
+        ))
+        self._stats["dropped"] += 1
+
+    def _bulk_create(self, batch, rejected):
+        """
+        Inserts a batch of messages. If the database rejects the
+          batch, it is split in halves to insert the valid messages,
+          down to the single messages being rejected.
+        :param batch: The messages to insert.
+        :param rejected: A list to add the rejected (message, error)
+          pairs to.
+        """
+
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(batch)
+        except (DataError, IntegrityError) as e:
+            if len(batch) == 1:
+                rejected.append((batch[0], e))
+                return
+            half = len(batch) // 2
+            self._bulk_create(batch[:half], rejected)
+            self._bulk_create(batch[half:], rejected)
+
+    def _insert(self, batch):
+        """
+        Inserts a batch of messages, tracking the flush stats.
+          The rejected messages are dropped. If the database is
+          not available, the messages not inserted yet are put
+          back in the buffer.
+        :param batch: The messages to insert.
+        :return: Whether the batch was processed.
+        """
+
+        rejected = []
+        pending = []
+        try:
+            for month in {month_start(message.created_on) for message in batch}:
+                ensure_month_partition(month)
+            self._bulk_create(batch, rejected)
+        except Exception as e:
+            logger.error("Could not flush %d buffered messages: %s, %s" % (len(batch), type(e).__name__, e.args))
+            self._stats["errors"] += 1
+            dropped = {id(message) for message, _ in rejected}
+            pending = [message for message in batch if message.pk is None and id(message) not in dropped]
+            self._buffer.extendleft(reversed(pending))
+        for message, error in rejected:
+            self._drop(message, "%s, %s" % (type(error).__name__, error.args))
+        size = len(batch) - len(rejected) - len(pending)
+        if size:
+            lag = time.time() - batch[0].created_on.timestamp()
+            metrics.WRITER_FLUSH_SIZE.observe(size)
+            metrics.WRITER_FLUSH_LAG_SECONDS.observe(lag)
+            self._stats["flushes"] += 1
+            self._stats["flushed"] += size
+            self._stats["last_flush_size"] = size
+            self._stats["max_flush_size"] = max(self._stats["max_flush_size"], size)
+            self._stats["last_flush_lag"] = lag
+            self._stats["max_flush_lag"] = max(self._stats["max_flush_lag"], lag)
+        return not pending
+
+
+def _build_writer():
+    """
+    Builds the message writer according to the CHATROOMS_WRITE_BEHIND
+      setting. When absent or empty, messages are inserted one by one
+      before being broadcast.
+    :return: The message writer, or None.
+    """
+
+    config = getattr(settings, 'CHATROOMS_WRITE_BEHIND', None)
+    if not config:
+        return None
+    writer = MessageWriter(**config)
+    atexit.register(writer.flush_sync)
+    return writer
+
+
+message_writer = _build_writer()
+
+
+async def store_message(room_id, user, body):
+    """
+    Stores a message. In write-behind mode, the message is only
+      buffered, so it will be inserted shortly after.
+    :param room_id: The id of the room the message was sent to.
+    :param user: The user sending the message.
+    :param body: The message body.
+    :return: The message.
+    """
+
+    message = Message(room_id=room_id, user=user, content=body[:512], created_on=timezone.now())
+    if message_writer:
+        await message_writer.write(message)
+    else:
+        await metrics.timed_database_sync_to_async(_save_message, 'save_message')(message)
+    return message
+
+
+def _save_message(message):
+    """
+    Inserts a single message, in its month's partition.
+    :param message: An unsaved Message instance.
+    """
+
+    ensure_month_partition(message.created_on)
+    message.save()
+
+
+async def flush_messages():
+    """
+    Ensures all the buffered messages are inserted, if
+      running in write-behind mode.
+    """
+
+    if message_writer:
+        await message_writer.flush()
+
+
+@metrics.registry.collector
+def collect_writer():
+    """
+    :return: The write-behind stats, if running in write-behind mode.
+    """
+
+    if not message_writer:
+        return []
+    stats = message_writer.stats()
+    buffered = metrics.Gauge('chatrooms_writer_buffered', 'Chat messages buffered, pending to be inserted.')
+    buffered.set(stats["buffered"])
+    flushed = metrics.Counter('chatrooms_writer_flushed_total', 'Chat messages inserted by the write-behind.')
+    flushed.inc(stats["flushed"])
+    errors = metrics.Counter('chatrooms_writer_errors_total', 'Failed write-behind flushes.')
+    errors.inc(stats["errors"])
+    dropped = metrics.Counter('chatrooms_writer_dropped_total', 'Chat messages dropped by the write-behind.')
+    dropped.inc(stats["dropped"])
+    lag = metrics.Gauge('chatrooms_writer_max_flush_lag_seconds', 'Maximum time a message waited to be inserted.')
+    lag.set(stats["max_flush_lag"])
+    return [buffered, flushed, errors, dropped, lag]
@@ -0,0 +1,206 @@
+import time
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .redis_pools import RedisPools
+
+
+class LocalPresence:
+    """
+    Tracks the user sessions and the room members in memory.
+      This is only accurate when a single server process is
+      running.
+    """
+
+    heartbeat_interval = None
+
+    def __init__(self):
+        self.sessions = {}
+        self.rooms = {}
+
+    async def claim_user(self, user_id, channel_name):
+        """
+        Registers the session of a user.
+        :param user_id: The id of the user.
+        :param channel_name: The channel of the user's connection.
+        :return: Whether the session was registered. False means
+          that the user already has another session.
+        """
+
+        if user_id in self.sessions:
+            return False
+        self.sessions[user_id] = channel_name
+        return True
+
+    async def release_user(self, user_id, channel_name):
+        """
+        Unregisters the session of a user, if it belongs to the
+          given channel.
+        :param user_id: The id of the user.
+        :param channel_name: The channel of the user's connection.
+        """
+
+        if self.sessions.get(user_id) == channel_name:
+            del self.sessions[user_id]
+
+    async def join(self, room_name, username):
+        """
+        Adds a user to the members of a room.
+        :param room_name: The name of the room.
+        :param username: The name of the user.
+        """
+
+        self.rooms.setdefault(room_name, set()).add(username)
+
+    async def leave(self, room_name, username):
+        """
+        Removes a user from the members of a room.
+        :param room_name: The name of the room.
+        :param username: The name of the user.
+        """
+
+        self.rooms.get(room_name, set()).discard(username)
+
+    async def members(self, room_name):
+        """
+        :param room_name: The name of the room.
+        :return: The names of the users in the room.
+        """
+
+        return list(self.rooms.get(room_name, ()))
+
+    async def counts(self, room_names):
+        """
+        :param room_names: The names of the rooms.
+        :return: A dict with the amount of users in each room.
+        """
+
+        return {room_name: len(self.rooms.get(room_name, ())) for room_name in room_names}
+
+    async def heartbeat(self, user_id, channel_name, username, room_names):
+        """
+        Keeps the session of a user, and its room memberships,
+          alive. Entries not kept alive will eventually expire.
+        :param user_id: The id of the user.
+        :param channel_name: The channel of the user's connection.
+        :param username: The name of the user.
+        :param room_names: The rooms the user is in.
+        :return: Whether the session still belongs to the given
+          channel. False means it expired, and perhaps another
+          connection claimed it meanwhile.
+        """
+
+        return self.sessions.get(user_id) == channel_name
+
+
+class RedisPresence:
+    """
+    Tracks the user sessions and the room members in Redis,
+      so they are shared among all the server processes.
+
+    Each session is a key expiring after `ttl` seconds, and
+      the members of each room are a sorted set scored by the
+      moment each membership expires. Connections refresh both
+      periodically, so the entries of a crashed node expire by
+      themselves. A session is only refreshed by its own channel:
+      once it expired, and perhaps was claimed by another node,
+      its former connection is told it lost the session.
+    """
+
+    # Releases a session only if it belongs to the given channel.
+    RELEASE_SCRIPT = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+
+    # Refreshes a session, and the room memberships of its user,
+    # only if it still belongs to the given channel.
+    HEARTBEAT_SCRIPT = """
+    if redis.call('get', KEYS[1]) ~= ARGV[1] then
+        return 0
+    end
+    redis.call('expire', KEYS[1], ARGV[2])
+    for i = 2, #KEYS do
+        redis.call('zadd', KEYS[i], ARGV[3], ARGV[4])
+    end
+    return 1
+    """
+
+    def __init__(self, host, ttl=30, prefix='chatrooms:presence'):
+        """
+        :param host: A redis://[:password@]host:port/db address.
+        :param ttl: The time, in seconds, before an entry which
+          is not kept alive expires.
+        :param prefix: The prefix of all the keys.
+        """
+
+        self.pools = RedisPools(host)
+        self.ttl = int(ttl)
+        self.heartbeat_interval = ttl / 3
+        self.prefix = prefix
+
+    def _user_key(self, user_id):
+        return '%s:user:%s' % (self.prefix, user_id)
+
+    def _room_key(self, room_name):
+        return '%s:room:%s' % (self.prefix, room_name)
+
+    async def claim_user(self, user_id, channel_name):
+        redis = await self.pools.get()
+        return bool(await redis.set(self._user_key(user_id), channel_name, expire=self.ttl,
+                                    exist=redis.SET_IF_NOT_EXIST))
+
+    async def release_user(self, user_id, channel_name):
+        redis = await self.pools.get()
+        await redis.eval(self.RELEASE_SCRIPT, keys=[self._user_key(user_id)], args=[channel_name])
+
+    async def join(self, room_name, username):
+        redis = await self.pools.get()
+        await redis.zadd(self._room_key(room_name), time.time() + self.ttl, username)
+
+    async def leave(self, room_name, username):
+        redis = await self.pools.get()
+        await redis.zrem(self._room_key(room_name), username)
+
+    async def members(self, room_name):
+        redis = await self.pools.get()
+        now = time.time()
+        key = self._room_key(room_name)
+        transaction = redis.multi_exec()
+        transaction.zremrangebyscore(key, max=now)
+        members = transaction.zrangebyscore(key, min=now)
+        await transaction.execute()
+        return await members
+
+    async def counts(self, room_names):
+        redis = await self.pools.get()
+        now = time.time()
+        pipeline = redis.pipeline()
+        counts = [pipeline.zcount(self._room_key(room_name), min=now) for room_name in room_names]
+        await pipeline.execute()
+        return {room_name: await count for room_name, count in zip(room_names, counts)}
+
+    async def heartbeat(self, user_id, channel_name, username, room_names):
+        redis = await self.pools.get()
+        return bool(await redis.eval(
+            self.HEARTBEAT_SCRIPT, keys=[self._user_key(user_id)] + [self._room_key(name) for name in room_names],
+            args=[channel_name, self.ttl, repr(time.time() + self.ttl), username]
+        ))
+
+
+def _build_presence():
+    """
+    Builds the presence backend according to the CHATROOMS_PRESENCE
+      setting, which has a BACKEND class path and its CONFIG kwargs
+      (like CHANNEL_LAYERS entries). Sessions and rooms are tracked
+      in memory by default.
+    :return: The presence backend.
+    """
+
+    config = getattr(settings, 'CHATROOMS_PRESENCE', None) or {}
+    backend = import_string(config.get('BACKEND', 'chatrooms.presence.LocalPresence'))
+    return backend(**config.get('CONFIG', {}))
+
+
+presence = _build_presence()
@@ -0,0 +1,130 @@
+import contextlib
+import contextvars
+import cProfile
+import json
+import os
+import random
+import time
+from django.conf import settings
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# The time spent so far, per kind (e.g. "db" or "channel_layer"),
+# by the command or broadcast being handled in this context.
+_spent = contextvars.ContextVar('chatrooms_spent', default=None)
+# Whether a command is being profiled. Only one profiler may be
+# active at a time.
+_profiling = False
+
+
+def _profiling_config():
+    """
+    :return: The CHATROOMS_PROFILING setting, or an empty dict.
+    """
+
+    return getattr(settings, 'CHATROOMS_PROFILING', None) or {}
+
+
+@contextlib.contextmanager
+def spending(kind):
+    """
+    Adds the time spent inside this block to the given kind, for
+      the command or broadcast being handled in this context.
+    :param kind: The kind of time being spent.
+    """
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        spent = _spent.get()
+        if spent is not None:
+            spent[kind] = spent.get(kind, 0.0) + time.perf_counter() - started
+
+
+def _start_profiler(config):
+    """
+    Starts a profiler for the current command, on a sampled
+      fraction (the `profile_rate`) of them.
+    :param config: The profiling settings.
+    :return: The started profiler, or None.
+    """
+
+    global _profiling
+    if _profiling or random.random() >= config.get('profile_rate', 0):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Another profiler is active (e.g. a debugger or coverage tool).
+        logger.warning("Could not start a profile: %s" % (e,))
+        return None
+    _profiling = True
+    return profiler
+
+
+def _dump_profiler(profiler, config, name):
+    """
+    Stops a profiler and dumps its stats, as a pstats file, into
+      the `profile_dir` directory.
+    :param profiler: The profiler to stop.
+    :param config: The profiling settings.
+    :param name: The name of the profiled command.
+    """
+
+    global _profiling
+    profiler.disable()
+    _profiling = False
+    directory = config.get('profile_dir') or 'profiles'
+    try:
+        os.makedirs(directory, exist_ok=True)
+        profiler.dump_stats(os.path.join(directory, '%s-%d-%s.prof' % (
+            time.strftime('%Y%m%d-%H%M%S'), os.getpid(), name
+        )))
+    except OSError as e:
+        logger.warning("Could not dump a profile: %s, %s" % (type(e).__name__, e.args))
+
+
+@contextlib.contextmanager
+def timing(name, room_name=None, payload_size=None, user_id=None):
+    """
+    Times the handling of a command or broadcast. When it takes at
+      least `slow_threshold` seconds, a structured record is logged,
+      telling the time spent in the database and in the channel
+      layer. Also, a sampled fraction of them are profiled.
+
+    The profiler sees everything running in the process meanwhile
+      (e.g. other connections' commands), not only this command.
+    :param name: The command type, or the broadcast handler name.
+    :param room_name: The room involved, if any.
+    :param payload_size: The size of the incoming frame, if any.
+    :param user_id: The id of the user, if any.
+    """
+
+    config = _profiling_config()
+    profiler = _start_profiler(config) if config.get('profile_rate') else None
+    spent = {}
+    token = _spent.set(spent)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        _spent.reset(token)
+        if profiler is not None:
+            _dump_profiler(profiler, config, name)
+        threshold = config.get('slow_threshold')
+        if threshold is not None and elapsed >= threshold:
+            logger.warning("Slow command: %s" % json.dumps({
+                "command": name,
+                "room_name": room_name,
+                "user": user_id,
+                "payload_size": payload_size,
+                "seconds": round(elapsed, 6),
+                "db_seconds": round(spent.get("db", 0.0), 6),
+                "channel_layer_seconds": round(spent.get("channel_layer", 0.0), 6),
+            }))
@@ -0,0 +1,142 @@
+import collections
+import time
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .redis_pools import RedisPools
+
+
+class LocalRateLimiter:
+    """
+    Keeps the token buckets in memory. This is only accurate
+      when a single server process is running.
+    """
+
+    def __init__(self, max_size=100000):
+        """
+        :param max_size: The maximum amount of buckets kept. The
+          least recently used ones are forgotten (i.e. refilled).
+        """
+
+        self.max_size = max_size
+        self._buckets = collections.OrderedDict()
+
+    async def take(self, key, capacity, per):
+        """
+        Takes a token from a bucket.
+        :param key: The bucket key.
+        :param capacity: The amount of tokens of a full bucket.
+        :param per: The time, in seconds, an empty bucket takes
+          to be full again.
+        :return: 0 if the token was taken, or the time, in seconds,
+          to wait until a token is available.
+        """
+
+        now = time.monotonic()
+        tokens, stamp = self._buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - stamp) * capacity / per)
+        retry_after = 0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) * per / capacity
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_size:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+
+class RedisRateLimiter:
+    """
+    Keeps the token buckets in Redis, so they are shared among
+      all the server processes. Each bucket is a hash updated
+      atomically by a script, and expires once it would be full.
+    """
+
+    # Takes a token from the bucket KEYS[1], given the capacity,
+    # the refill period and the current time. Returns 0 or the
+    # time to wait (as a string, since Lua numbers would be
+    # truncated to integers).
+    TAKE_SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local per = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local bucket = redis.call('hmget', KEYS[1], 'tokens', 'stamp')
+    local tokens = tonumber(bucket[1]) or capacity
+    local stamp = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - stamp) * capacity / per)
+    local retry_after = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        retry_after = (1 - tokens) * per / capacity
+    end
+    redis.call('hset', KEYS[1], 'tokens', tostring(tokens), 'stamp', tostring(now))
+    redis.call('pexpire', KEYS[1], math.ceil(per * 1000))
+    return tostring(retry_after)
+    """
+
+    def __init__(self, host, prefix='chatrooms:ratelimit'):
+        """
+        :param host: A redis://[:password@]host:port/db address.
+        :param prefix: The prefix of all the keys.
+        """
+
+        self.pools = RedisPools(host)
+        self.prefix = prefix
+
+    async def take(self, key, capacity, per):
+        redis = await self.pools.get()
+        return float(await redis.eval(self.TAKE_SCRIPT, keys=['%s:%s' % (self.prefix, key)],
+                                      args=[capacity, per, time.time()]))
+
+
+def _build_rate_limiter():
+    """
+    Builds the rate limiter backend according to the BACKEND class
+      path and CONFIG kwargs of the CHATROOMS_RATE_LIMITS setting.
+      Buckets are kept in memory by default.
+    :return: The rate limiter backend.
+    """
+
+    config = getattr(settings, 'CHATROOMS_RATE_LIMITS', None) or {}
+    backend = import_string(config.get('BACKEND', 'chatrooms.ratelimit.LocalRateLimiter'))
+    return backend(**config.get('CONFIG', {}))
+
+
+rate_limiter = _build_rate_limiter()
+
+
+def is_exempt(user):
+    """
+    Tells whether a user is exempt from the rate limits. Staff
+      users (e.g. the bot accounts) are, unless the EXEMPT_STAFF
+      key of the CHATROOMS_RATE_LIMITS setting is false.
+    :param user: The user.
+    :return: Whether the user is exempt.
+    """
+
+    config = getattr(settings, 'CHATROOMS_RATE_LIMITS', None) or {}
+    return user.is_staff and config.get('EXEMPT_STAFF', True)
+
+
+async def check_rate(user_id, command, room_name=None):
+    """
+    Checks a command of a user against the RULES of the
+      CHATROOMS_RATE_LIMITS setting: a dict of command type
+      => {"capacity": N, "per": seconds, "per_room": bool}.
+      Commands without a rule are not limited.
+    :param user_id: The id of the user.
+    :param command: The command type.
+    :param room_name: The room the command targets, if any.
+    :return: 0 if the command is allowed, or the time, in
+      seconds, to wait before trying again.
+    """
+
+    rules = (getattr(settings, 'CHATROOMS_RATE_LIMITS', None) or {}).get('RULES') or {}
+    rule = rules.get(command)
+    if not rule:
+        return 0
+    key = '%s:%s' % (user_id, command)
+    if rule.get('per_room') and isinstance(room_name, str):
+        key += ':' + room_name
+    return await rate_limiter.take(key, rule['capacity'], rule['per'])
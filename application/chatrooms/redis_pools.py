@@ -0,0 +1,32 @@
+import asyncio
+import weakref
+import aioredis
+
+
+class RedisPools:
+    """
+    Lazily creates one Redis connection pool per event loop,
+      since aioredis pools cannot be shared between loops.
+    """
+
+    def __init__(self, address, **kwargs):
+        """
+        :param address: A redis://[:password@]host:port/db address.
+        :param kwargs: Further arguments for aioredis.create_redis_pool.
+        """
+
+        self._address = address
+        self._kwargs = kwargs
+        self._pools = weakref.WeakKeyDictionary()
+
+    async def get(self):
+        """
+        :return: The pool for the current event loop.
+        """
+
+        loop = asyncio.get_event_loop()
+        pool = self._pools.get(loop)
+        if pool is None or pool.closed:
+            pool = await aioredis.create_redis_pool(self._address, encoding='utf-8', **self._kwargs)
+            self._pools[loop] = pool
+        return pool
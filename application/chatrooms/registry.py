@@ -0,0 +1,206 @@
+import asyncio
+import time
+from asgiref.sync import async_to_sync
+from channels.layers import DEFAULT_CHANNEL_LAYER, channel_layers, get_channel_layer
+from . import metrics
+from .models import Room
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# The channel-layer group where room changes are broadcast to
+# all the nodes. Room names cannot contain periods, so this
+# group will never collide with an actual room group.
+REGISTRY_GROUP = 'chatrooms.registry'
+# How often (in seconds) the process renews its membership in
+# that group, well before the channel layer expires it.
+REGISTRY_GROUP_RENEWAL = 3600
+
+
+class RoomRegistry:
+    """
+    A per-process map of room name => room id. It is warmed
+      with all the rooms in a single query, and then kept up
+      to date by the Room post_save / post_delete signals in
+      this process and by the invalidation broadcasts coming
+      from other nodes. This way, resolving a room does not
+      need a query at all.
+
+    The process listens to those broadcasts through a channel
+      of its own, once, regardless of its connections. It uses
+      a channel layer instance of its own, so its receive loop
+      is not tied to the consumers' one. If the listener fails,
+      changes may have been missed, so the registry is loaded
+      again when the listener is restarted.
+    """
+
+    def __init__(self):
+        self._ids = None
+        self._names = {}
+        self._loop = None
+        self._lock = None
+        self._listener = None
+        self._layer = None
+        self._channel = None
+        self._renewed = None
+
+    async def ensure(self):
+        """
+        Ensures this process listens to the room changes, and the
+          registry is loaded. This only involves the channel layer
+          and a query the first time (and once in a while, to renew
+          the subscription).
+        """
+
+        if self._ready():
+            return
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            self._loop, self._lock, self._listener = loop, asyncio.Lock(), None
+        async with self._lock:
+            if self._ready():
+                return
+            if self._listener is None or self._listener.done():
+                # Subscribed before loading, so no change is missed.
+                self.clear()
+                self._layer = channel_layers.make_backend(DEFAULT_CHANNEL_LAYER)
+                self._channel = await self._layer.new_channel()
+                self._renewed = None
+                self._listener = asyncio.ensure_future(self._listen(self._layer, self._channel))
+            if self._renewed is None or time.monotonic() - self._renewed >= REGISTRY_GROUP_RENEWAL:
+                await self._layer.group_add(REGISTRY_GROUP, self._channel)
+                self._renewed = time.monotonic()
+            if not self.warm:
+                await metrics.timed_database_sync_to_async(self.load, 'load_registry')()
+
+    def _ready(self):
+        """
+        :return: Whether the registry is loaded, and listening
+          to the room changes in the current loop.
+        """
+
+        return self.warm and self._listener is not None and not self._listener.done() and \
+            self._loop is asyncio.get_event_loop() and time.monotonic() - self._renewed < REGISTRY_GROUP_RENEWAL
+
+    async def _listen(self, layer, channel):
+        """
+        Applies the room changes broadcast by all the nodes.
+        :param layer: The channel layer.
+        :param channel: The channel of this process.
+        """
+
+        try:
+            while True:
+                event = await layer.receive(channel)
+                if event.get("type") == "registry_room_saved":
+                    self.saved(event["id"], event["name"])
+                elif event.get("type") == "registry_room_deleted":
+                    self.deleted(event["id"])
+        except Exception as e:
+            logger.warning("Stopped listening to the room changes: %s, %s" % (type(e).__name__, e.args))
+
+    @property
+    def warm(self):
+        return self._ids is not None
+
+    def load(self):
+        """
+        Loads all the rooms into the registry. This method
+          performs a query, so it must be run in a sync
+          context.
+        """
+
+        rooms = list(Room.objects.values_list('id', 'name'))
+        self._names = dict(rooms)
+        self._ids = {name: id_ for id_, name in rooms}
+
+    def clear(self):
+        """
+        Forgets all the rooms. The registry must be loaded
+          again before being used (see ensure).
+        """
+
+        self._ids = None
+        self._names = {}
+
+    def get(self, name):
+        """
+        Resolves a room name.
+        :param name: The name of the room.
+        :return: The room id, or None if it does not exist.
+        """
+
+        return (self._ids or {}).get(name)
+
+    def names(self):
+        """
+        :return: The sorted names of all the rooms.
+        """
+
+        return sorted(self._ids or ())
+
+    def saved(self, id_, name):
+        """
+        Tracks a created or renamed room.
+        :param id_: The room id.
+        :param name: The (perhaps new) room name.
+        """
+
+        if self._ids is None:
+            return
+        old_name = self._names.get(id_)
+        if old_name is not None and old_name != name:
+            self._ids.pop(old_name, None)
+        self._names[id_] = name
+        self._ids[name] = id_
+
+    def deleted(self, id_):
+        """
+        Forgets a deleted room.
+        :param id_: The room id.
+        """
+
+        if self._ids is None:
+            return
+        name = self._names.pop(id_, None)
+        if name is not None:
+            self._ids.pop(name, None)
+
+
+registry = RoomRegistry()
+
+
+def _broadcast(event):
+    """
+    Broadcasts a registry change to all the nodes.
+    :param event: The event to broadcast.
+    """
+
+    try:
+        async_to_sync(get_channel_layer().group_send)(REGISTRY_GROUP, event)
+    except Exception as e:
+        logger.warning("Could not broadcast a room registry change: %s, %s" % (type(e).__name__, e.args))
+
+
+def on_room_saved(sender, instance, **kwargs):
+    """
+    This handler is invoked when a room is created or updated.
+    :param sender: Room class.
+    :param instance: A Room instance.
+    """
+
+    registry.saved(instance.id, instance.name)
+    _broadcast({"type": "registry_room_saved", "id": instance.id, "name": instance.name})
+
+
+def on_room_deleted(sender, instance, **kwargs):
+    """
+    This handler is invoked when a room is deleted.
+    :param sender: Room class.
+    :param instance: A Room instance.
+    """
+
+    registry.deleted(instance.id)
+    _broadcast({"type": "registry_room_deleted", "id": instance.id})
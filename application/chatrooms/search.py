@@ -0,0 +1,115 @@
+import base64
+import binascii
+import time
+from django.db import connection
+from django.db.models import BooleanField, FloatField, Q
+from django.db.models.expressions import RawSQL
+from django.utils.dateparse import parse_datetime
+from .metrics import SEARCH_QUERY_SECONDS
+from .models import Message
+
+
+# The text search configuration of the message search vectors.
+# The "simple" one does not stem nor drop stop words, so it fits
+# any language (and the stock codes). It must match the one of
+# the generated search_vector column.
+SEARCH_CONFIG = 'simple'
+# The default amount of search results per page, the maximum one
+# a client may ask for, and the maximum length of the queries.
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 50
+SEARCH_MAX_QUERY_LENGTH = 200
+
+
+def _search_vector():
+    """
+    :return: The (qualified) search vector column of the messages.
+      It is a generated column, unknown to the model, so messages
+      may still be inserted by the ORM.
+    """
+
+    return '%s.search_vector' % connection.ops.quote_name(Message._meta.db_table)
+
+
+def matching(queryset, query):
+    """
+    Filters the messages matching a full-text query, by means of
+      the GIN index on their search vector. The query is written
+      like in web search engines: `word`, `"a phrase"`, `-word`
+      and `word or word`.
+    :param queryset: A queryset of messages.
+    :param query: The full-text query.
+    :return: The filtered queryset.
+    """
+
+    return queryset.filter(RawSQL('%s @@ websearch_to_tsquery(%%s, %%s)' % _search_vector(),
+                                  [SEARCH_CONFIG, query], output_field=BooleanField()))
+
+
+def encode_search_cursor(rank, created_on, id_):
+    """
+    Builds an opaque cursor pointing to a search result. Pages
+      fetched with this cursor will only contain the results
+      ranked after it.
+    :param rank: The rank of the result.
+    :param created_on: The creation date of the message.
+    :param id_: The id of the message.
+    :return: The cursor, as a url-safe string.
+    """
+
+    raw = "%r|%s|%d" % (rank, created_on.isoformat(), id_)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_search_cursor(cursor):
+    """
+    Decodes an opaque cursor into its (rank, created_on, id) key.
+    :param cursor: The cursor, as given by `encode_search_cursor`.
+    :return: A (rank, created_on, id) tuple.
+    :raises ValueError: If the cursor is malformed.
+    """
+
+    try:
+        rank, stamp, id_ = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        created_on = parse_datetime(stamp)
+        if created_on is None:
+            raise ValueError("Invalid cursor stamp")
+        return float(rank), created_on, int(id_)
+    except (binascii.Error, UnicodeError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def search_messages(room_ids, query, after=None, limit=SEARCH_PAGE_SIZE):
+    """
+    Searches the messages of some rooms, best ranked first (and
+      newest first among the equally ranked). Pages are keyset
+      based on (rank, created_on, id).
+    :param room_ids: The ids of the rooms to search in.
+    :param query: The full-text query.
+    :param after: An optional (rank, created_on, id) key. Only the
+      results ranked after it will be retrieved.
+    :param limit: The maximum amount of results to retrieve.
+    :return: A (messages, cursor) tuple, where the cursor is None
+      when there are no more results to retrieve. The messages
+      have their `rank`.
+    """
+
+    started = time.perf_counter()
+    # The rank is taken as a double, so it is told back (in the
+    # cursors) exactly as compared.
+    results = matching(Message.objects.select_related('user').filter(room_id__in=room_ids), query).annotate(
+        rank=RawSQL('ts_rank(%s, websearch_to_tsquery(%%s, %%s))::float8' % _search_vector(),
+                    [SEARCH_CONFIG, query], output_field=FloatField())
+    )
+    if after is not None:
+        rank, created_on, id_ = after
+        results = results.filter(Q(rank__lt=rank) | Q(rank=rank, created_on__lt=created_on) |
+                                 Q(rank=rank, created_on=created_on, id__lt=id_))
+    # One extra row is fetched to know whether another page exists.
+    messages = list(results.order_by("-rank", "-created_on", "-id")[:limit + 1])
+    SEARCH_QUERY_SECONDS.observe(time.perf_counter() - started)
+    if len(messages) > limit:
+        messages = messages[:limit]
+        last = messages[-1]
+        return messages, encode_search_cursor(last.rank, last.created_on, last.id)
+    return messages, None
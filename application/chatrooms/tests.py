@@ -1,16 +1,49 @@
 import asyncio
+import csv
+import datetime
+import gzip
+import io
 import json
+import struct
+import uuid
+import zlib
 
+import msgpack
 import pytest
+from asgiref.sync import async_to_sync
 from channels.routing import URLRouter
+from django.contrib.admin import site
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.loader import MigrationLoader
+from django.http import Http404
+from django.utils import timezone
 from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from autobahn.websocket.compress import PerMessageDeflate, PerMessageDeflateOffer
 from channels.testing import WebsocketCommunicator
+from daphne.ws_protocol import WebSocketFactory
 from channels_authtoken import TokenAuthMiddlewareStack
 from chatrooms.routing import websocket_urlpatterns
 from .models import Room, Message
-from .api import UserLoginView, UserCreateView, MyProfileView, UserLogoutView
-from rest_framework.test import APIRequestFactory
+from .history import LocalRecentMessages, RedisRecentMessages, recent_messages, entries_cursor, decode_cursor, \
+    get_room_messages, message_entry, HISTORY_PAGE_SIZE
+from .persistence import MessageWriter
+from .presence import RedisPresence
+from .registry import registry, REGISTRY_GROUP
+from .outbound import OutboundQueue
+from .compression import CompressingServer, CompressingWebSocketProtocol, accept_deflate, compression_stats
+from .ratelimit import is_exempt
+from .codecs import JsonCodec
+from .partitions import add_months, month_start, ensure_partitions, ensure_month_partition, partition_name, \
+    partitions, detach_partition
+from .api import UserLoginView, UserCreateView, MyProfileView, UserLogoutView, RoomExportView
+from .views import metrics
+from .admin import LatestMessagesFormSet
+from django.test import RequestFactory
+from rest_framework.test import APIRequestFactory, force_authenticate
+from twisted.internet.testing import StringTransport
 import logging
 
 
@@ -22,11 +55,12 @@ USERS = ["alice", "bob", "carl", "david", "erin", "frank"]
 ROOMS = ['friends', 'family', 'stockmarket', 'forex']
 
 
-def make_communicator(token):
+def make_communicator(token, subprotocols=None):
     """
     Creates a chatrooms communicator for the given input token.
     :param token: The token to use. It must correspond to a valid
       token (i.e. a user must be logged in with that token).
+    :param subprotocols: The websocket subprotocols to ask for.
     :return: The communicator.
     """
 
@@ -34,7 +68,7 @@ def make_communicator(token):
         URLRouter(
             websocket_urlpatterns
         )
-    ), '/ws/chat/?token=' + token)
+    ), '/ws/chat/?token=' + token, subprotocols=subprotocols)
 
 
 async def attempt_login(username, password, expect=200):
@@ -136,6 +170,17 @@ async def should_be_websocket_rejected_because_duplicated(token):
     assert message.get('code') == 'already-chatting'
 
 
+@pytest.fixture()
+def redis_host(settings):
+    """
+    Fixture for the Redis address of the tests: the one of the
+      channel layer, with another database.
+    :return: The redis://[:password@]host:port/db address.
+    """
+
+    return settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0].rsplit('/', 1)[0] + '/1'
+
+
 @pytest.fixture()
 async def rooms():
     """
@@ -249,7 +294,7 @@ async def test_chatroom_commands():
     list_ = await alice_communicator.receive_json_from()
     assert list_['type'] == 'notification'
     assert list_['code'] == 'list'
-    assert list_['list'] == [{'name': 'family', 'joined': False}, {'name': 'forex', 'joined': False}, {'name': 'friends', 'joined': False}, {'name': 'stockmarket', 'joined': False}]
+    assert list_['list'] == [{'name': 'family', 'joined': False, 'members': 0}, {'name': 'forex', 'joined': False, 'members': 0}, {'name': 'friends', 'joined': False, 'members': 0}, {'name': 'stockmarket', 'joined': False, 'members': 0}]
     await alice_communicator.send_json_to({'type': 'join', 'room_name': 'family'})
     joined = await alice_communicator.receive_json_from()
     assert joined['type'] == 'room:notification'
@@ -261,7 +306,7 @@ async def test_chatroom_commands():
     list_ = await alice_communicator.receive_json_from()
     assert list_['type'] == 'notification'
     assert list_['code'] == 'list'
-    assert list_['list'] == [{'name': 'family', 'joined': True}, {'name': 'forex', 'joined': False}, {'name': 'friends', 'joined': False}, {'name': 'stockmarket', 'joined': False}]
+    assert list_['list'] == [{'name': 'family', 'joined': True, 'members': 1}, {'name': 'forex', 'joined': False, 'members': 0}, {'name': 'friends', 'joined': False, 'members': 0}, {'name': 'stockmarket', 'joined': False, 'members': 0}]
     await alice_communicator.send_json_to({'type': 'join', 'room_name': 'family'})
     error = await alice_communicator.receive_json_from()
     assert error['type'] == 'error'
@@ -271,7 +316,7 @@ async def test_chatroom_commands():
     list_ = await alice_communicator.receive_json_from()
     assert list_['type'] == 'notification'
     assert list_['code'] == 'list'
-    assert list_['list'] == [{'name': 'family', 'joined': True}, {'name': 'forex', 'joined': False}, {'name': 'friends', 'joined': False}, {'name': 'stockmarket', 'joined': False}]
+    assert list_['list'] == [{'name': 'family', 'joined': True, 'members': 1}, {'name': 'forex', 'joined': False, 'members': 0}, {'name': 'friends', 'joined': False, 'members': 0}, {'name': 'stockmarket', 'joined': False, 'members': 0}]
     # Bob will:
     # 1. Connect and retrieve MOTD.
     # 2. Join "family" room, and receive a success.
@@ -474,3 +519,1092 @@ async def test_chatroom_broadcast():
     # And the 3 will disconnect.
     for name in ['alice', 'bob', 'carl']:
         await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_chatroom_history():
+    """
+    Tests paging backwards through a room history with
+      the cursors given by the join status and by the
+      history command itself.
+    """
+
+    token = await attempt_login('david', 'daviddavid$12345')
+    communicator = make_communicator(token)
+    connected, _ = await communicator.connect()
+    assert connected
+    motd = await communicator.receive_json_from()
+    assert motd['code'] == 'api-motd'
+    # Not joined yet: the history cannot be retrieved.
+    await communicator.send_json_to({'type': 'history', 'room_name': 'stockmarket'})
+    error = await communicator.receive_json_from()
+    assert error['type'] == 'error'
+    assert error['code'] == 'room:not-joined'
+    assert error['details']['name'] == 'stockmarket'
+    await communicator.send_json_to({'type': 'join', 'room_name': 'stockmarket'})
+    joined = await communicator.receive_json_from()
+    assert joined['code'] == 'joined'
+    assert joined['you']
+    assert joined['status']['messages'] == []
+    assert joined['status']['before'] is None
+    # Post 5 messages, and page through them 2 by 2.
+    for index in range(5):
+        await communicator.send_json_to({'type': 'message', 'room_name': 'stockmarket', 'body': 'Message %d' % index})
+        message = await communicator.receive_json_from()
+        assert message['code'] == 'message'
+    bodies = []
+    before = None
+    while True:
+        await communicator.send_json_to({'type': 'history', 'room_name': 'stockmarket', 'before': before, 'limit': 2})
+        history = await communicator.receive_json_from()
+        assert history['type'] == 'notification'
+        assert history['code'] == 'history'
+        assert history['room_name'] == 'stockmarket'
+        assert len(history['messages']) <= 2
+        assert all(message['you'] and message['user'] == 'david' for message in history['messages'])
+        bodies.extend(message['body'] for message in history['messages'])
+        before = history['before']
+        if before is None:
+            break
+    assert bodies == ['Message 4', 'Message 3', 'Message 2', 'Message 1', 'Message 0']
+    # Malformed cursors and limits are rejected.
+    await communicator.send_json_to({'type': 'history', 'room_name': 'stockmarket', 'before': 'not-a-cursor'})
+    error = await communicator.receive_json_from()
+    assert error['type'] == 'error'
+    assert error['code'] == 'room:invalid-cursor'
+    await communicator.send_json_to({'type': 'history', 'room_name': 'stockmarket', 'limit': 1000})
+    error = await communicator.receive_json_from()
+    assert error['type'] == 'error'
+    assert error['code'] == 'invalid-format'
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_chatroom_search():
+    """
+    Tests the full-text search over the history of the
+      joined rooms, ranked and paged.
+    """
+
+    token = await attempt_login('david', 'daviddavid$12345')
+    communicator = make_communicator(token)
+    connected, _ = await communicator.connect()
+    assert connected
+    motd = await communicator.receive_json_from()
+    assert motd['code'] == 'api-motd'
+    bodies = {'friends': ['Tesla earnings beat, tesla up', 'Tesla earnings', 'Nothing to see here'],
+              'family': ['Tesla ahead of earnings', 'Dinner at eight']}
+    for room_name, messages in bodies.items():
+        await communicator.send_json_to({'type': 'join', 'room_name': room_name})
+        joined = await communicator.receive_json_from()
+        assert joined['code'] == 'joined'
+        for body in messages:
+            await communicator.send_json_to({'type': 'message', 'room_name': room_name, 'body': body})
+            message = await communicator.receive_json_from()
+            assert message['code'] == 'message'
+    # The best matches come first, among all the joined rooms, 2 by 2.
+    results = []
+    after = None
+    while True:
+        await communicator.send_json_to({'type': 'search', 'query': 'tesla earnings', 'after': after, 'limit': 2})
+        search = await communicator.receive_json_from()
+        assert search['type'] == 'notification'
+        assert search['code'] == 'search'
+        assert search['query'] == 'tesla earnings'
+        assert len(search['results']) <= 2
+        results.extend((result['room_name'], result['body']) for result in search['results'])
+        after = search['after']
+        if after is None:
+            break
+    assert results[0] == ('friends', 'Tesla earnings beat, tesla up')
+    assert sorted(results[1:]) == [('family', 'Tesla ahead of earnings'), ('friends', 'Tesla earnings')]
+    # Excluded words, and single rooms.
+    await communicator.send_json_to({'type': 'search', 'query': 'tesla -beat', 'room_name': 'friends'})
+    search = await communicator.receive_json_from()
+    assert [(result['body'], result['user'], result['you']) for result in search['results']] == [
+        ('Tesla earnings', 'david', True)
+    ]
+    await communicator.send_json_to({'type': 'search', 'query': 'tesla', 'room_name': 'stockmarket'})
+    error = await communicator.receive_json_from()
+    assert error['type'] == 'error'
+    assert error['code'] == 'room:not-joined'
+    # Malformed queries and cursors are rejected.
+    await communicator.send_json_to({'type': 'search', 'query': '  '})
+    error = await communicator.receive_json_from()
+    assert error['code'] == 'invalid-format'
+    await communicator.send_json_to({'type': 'search', 'query': 'tesla', 'after': 'not-a-cursor'})
+    error = await communicator.receive_json_from()
+    assert error['code'] == 'search:invalid-cursor'
+    # Once parted, the rooms are not searched anymore.
+    for room_name in bodies:
+        await communicator.send_json_to({'type': 'part', 'room_name': room_name})
+        parted = await communicator.receive_json_from()
+        assert parted['code'] == 'parted'
+    await communicator.send_json_to({'type': 'search', 'query': 'tesla'})
+    search = await communicator.receive_json_from()
+    assert search['results'] == []
+    assert search['after'] is None
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_chatroom_batching():
+    """
+    Tests the opt-in batching of the room notifications.
+    """
+
+    token = await attempt_login('david', 'daviddavid$12345')
+    communicator = make_communicator(token)
+    connected, _ = await communicator.connect()
+    assert connected
+    motd = await communicator.receive_json_from()
+    assert motd['code'] == 'api-motd'
+    await communicator.send_json_to({'type': 'options', 'batch_ms': 5000})
+    error = await communicator.receive_json_from()
+    assert error['type'] == 'error'
+    assert error['code'] == 'invalid-format'
+    await communicator.send_json_to({'type': 'options', 'batch_ms': 200})
+    options = await communicator.receive_json_from()
+    assert options['type'] == 'notification'
+    assert options['code'] == 'options'
+    assert options['options'] == {'batch_ms': 200}
+    await communicator.send_json_to({'type': 'join', 'room_name': 'family'})
+    joined = await communicator.receive_json_from()
+    assert joined['code'] == 'joined'
+    assert joined['you']
+    # Both messages arrive in the same batch.
+    for index in range(2):
+        await communicator.send_json_to({'type': 'message', 'room_name': 'family', 'body': 'Batched %d' % index})
+    batch = await communicator.receive_json_from()
+    assert batch['type'] == 'batch'
+    assert [event['code'] for event in batch['events']] == ['message', 'message']
+    assert [event['body'] for event in batch['events']] == ['Batched 0', 'Batched 1']
+    assert all(event['you'] for event in batch['events'])
+    # Without batching, each notification is a frame again.
+    await communicator.send_json_to({'type': 'options', 'batch_ms': 0})
+    options = await communicator.receive_json_from()
+    assert options['options'] == {'batch_ms': 0}
+    await communicator.send_json_to({'type': 'message', 'room_name': 'family', 'body': 'Not batched'})
+    message = await communicator.receive_json_from()
+    assert message['type'] == 'room:notification'
+    assert message['body'] == 'Not batched'
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_chatroom_msgpack():
+    """
+    Tests the msgpack subprotocol: binary frames with
+      compact keys, in both directions. It creates its
+      own user and room, with some messages.
+    """
+
+    @database_sync_to_async
+    def _packed_room():
+        user = User.objects.filter(username='packer').first() or User.objects.create_user(
+            'packer', 'packer@example.org', 'packerpacker$12345'
+        )
+        room, _ = Room.objects.get_or_create(name='packed')
+        Message.objects.filter(room=room).delete()
+        now = timezone.now()
+        Message.objects.bulk_create([
+            Message(room=room, user=user, content='Message %d' % index,
+                    created_on=now - datetime.timedelta(seconds=10 - index))
+            for index in range(5)
+        ])
+
+    await _packed_room()
+    token = await attempt_login('packer', 'packerpacker$12345')
+    communicator = make_communicator(token, ['finchat.msgpack'])
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    assert subprotocol == 'finchat.msgpack'
+
+    async def receive():
+        frame = await communicator.receive_from()
+        assert isinstance(frame, bytes)
+        return msgpack.unpackb(frame, raw=False)
+
+    async def send(content):
+        await communicator.send_to(bytes_data=msgpack.packb(content, use_bin_type=True))
+
+    motd = await receive()
+    assert motd['t'] == 'notification'
+    assert motd['c'] == 'api-motd'
+    await send({'t': 'join', 'r': 'packed'})
+    joined = await receive()
+    assert joined['t'] == 'room:notification'
+    assert joined['c'] == 'joined'
+    assert joined['y']
+    assert joined['st']['us'] == [{'n': 'packer', 'y': True}]
+    assert [message['b'] for message in joined['st']['m']] == [
+        'Message 4', 'Message 3', 'Message 2', 'Message 1', 'Message 0'
+    ]
+    await send({'t': 'message', 'r': 'packed', 'b': 'Packed'})
+    message = await receive()
+    assert message['c'] == 'message'
+    assert message['b'] == 'Packed'
+    assert message['u'] == 'packer'
+    assert message['y']
+    # Text frames are not valid under this subprotocol.
+    await communicator.send_to(text_data=json.dumps({'type': 'list'}))
+    error = await receive()
+    assert error['t'] == 'error'
+    assert error['c'] == 'invalid-format'
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_chatroom_rate_limits(settings):
+    """
+    Tests the rate limits of the commands: messages are
+      limited per room, limited commands are told when
+      to retry, and staff users are exempt.
+    """
+
+    settings.CHATROOMS_RATE_LIMITS = {'RULES': {'message': {'capacity': 2, 'per': 60, 'per_room': True}}}
+    token = await attempt_login('david', 'daviddavid$12345')
+    communicator = make_communicator(token)
+    connected, _ = await communicator.connect()
+    assert connected
+    motd = await communicator.receive_json_from()
+    assert motd['code'] == 'api-motd'
+    for room_name in ['forex', 'friends']:
+        await communicator.send_json_to({'type': 'join', 'room_name': room_name})
+        joined = await communicator.receive_json_from()
+        assert joined['code'] == 'joined'
+    for index in range(2):
+        await communicator.send_json_to({'type': 'message', 'room_name': 'forex', 'body': 'Limited %d' % index})
+        message = await communicator.receive_json_from()
+        assert message['code'] == 'message'
+    await communicator.send_json_to({'type': 'message', 'room_name': 'forex', 'body': 'Limited 2'})
+    error = await communicator.receive_json_from()
+    assert error['type'] == 'error'
+    assert error['code'] == 'rate-limited'
+    assert error['details']['type'] == 'message'
+    assert 0 < error['details']['retry_after'] <= 30
+    # Other rooms have their own limits.
+    await communicator.send_json_to({'type': 'message', 'room_name': 'friends', 'body': 'Not limited'})
+    message = await communicator.receive_json_from()
+    assert message['code'] == 'message'
+    await communicator.disconnect()
+    # Staff users (e.g. the bot accounts) are not limited,
+    # unless told otherwise.
+    assert is_exempt(User(username='finbot', is_staff=True))
+    assert not is_exempt(User(username='someone'))
+    settings.CHATROOMS_RATE_LIMITS['EXEMPT_STAFF'] = False
+    assert not is_exempt(User(username='finbot', is_staff=True))
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_chatroom_metrics(settings):
+    """
+    Tests the metrics endpoint, while a user is
+      connected and chatting. It is only served to
+      the allowed addresses.
+    """
+
+    token = await attempt_login('david', 'daviddavid$12345')
+    communicator = make_communicator(token)
+    connected, _ = await communicator.connect()
+    assert connected
+    motd = await communicator.receive_json_from()
+    assert motd['code'] == 'api-motd'
+    await communicator.send_json_to({'type': 'join', 'room_name': 'stockmarket'})
+    joined = await communicator.receive_json_from()
+    assert joined['code'] == 'joined'
+    await communicator.send_json_to({'type': 'message', 'room_name': 'stockmarket', 'body': 'Measured'})
+    message = await communicator.receive_json_from()
+    assert message['code'] == 'message'
+    with pytest.raises(Http404):
+        metrics(RequestFactory().get('/metrics'))
+    settings.CHATROOMS_METRICS_ALLOWED_IPS = ['10.0.0.0/8']
+    with pytest.raises(Http404):
+        metrics(RequestFactory().get('/metrics'))
+    settings.CHATROOMS_METRICS_ALLOWED_IPS = ['10.0.0.0/8', '127.0.0.1']
+    response = metrics(RequestFactory().get('/metrics'))
+    assert response.status_code == 200
+    assert response['Content-Type'].startswith('text/plain')
+    lines = response.content.decode().splitlines()
+    # Users of previous tests may still be connected.
+    assert any(line.startswith('chatrooms_connections ') and int(line.split()[1]) >= 1 for line in lines)
+    assert 'chatrooms_room_members{room="stockmarket"} 1' in lines
+    assert any(line.startswith('chatrooms_commands_total{type="message"} ') for line in lines)
+    assert any(line.startswith('chatrooms_group_send_seconds_count{event="broadcast_message"} ') for line in lines)
+    assert any(line.startswith('chatrooms_broadcast_fanout_bucket{event="broadcast_message",le="1"} ')
+               for line in lines)
+    assert any(line.startswith('chatrooms_db_execution_seconds_count{operation="get_room_messages"} ')
+               for line in lines)
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_chatroom_slow_commands(settings, caplog, tmp_path):
+    """
+    Tests the slow commands log, and the profiling of
+      a sampled fraction of the commands.
+    """
+
+    settings.CHATROOMS_PROFILING = {'slow_threshold': 0, 'profile_rate': 1, 'profile_dir': str(tmp_path)}
+    token = await attempt_login('david', 'daviddavid$12345')
+    communicator = make_communicator(token)
+    connected, _ = await communicator.connect()
+    assert connected
+    motd = await communicator.receive_json_from()
+    assert motd['code'] == 'api-motd'
+    with caplog.at_level(logging.WARNING, logger='chatrooms.profiling'):
+        await communicator.send_json_to({'type': 'list'})
+        listed = await communicator.receive_json_from()
+        assert listed['code'] == 'list'
+    records = [json.loads(record.getMessage().split(': ', 1)[1]) for record in caplog.records
+               if record.getMessage().startswith('Slow command: ')]
+    record = next(record for record in records if record['command'] == 'list')
+    assert record['payload_size'] == len(json.dumps({'type': 'list'}))
+    assert record['seconds'] >= record['db_seconds'] + record['channel_layer_seconds']
+    assert any(path.name.endswith('-list.prof') for path in tmp_path.iterdir())
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_redis_presence(redis_host):
+    """
+    Tests the Redis presence backend, and that a session which
+      expired, and was claimed by another connection, is not
+      taken back by the heartbeat of its former connection.
+    """
+
+    backend = RedisPresence(redis_host, ttl=5, prefix='chatrooms:test:%s' % uuid.uuid4().hex)
+    redis = await backend.pools.get()
+    assert await backend.claim_user(1, 'first')
+    assert not await backend.claim_user(1, 'second')
+    await backend.join('friends', 'alice')
+    await backend.join('family', 'alice')
+    assert await backend.members('friends') == ['alice']
+    assert await backend.counts(['friends', 'forex']) == {'friends': 1, 'forex': 0}
+    assert await backend.heartbeat(1, 'first', 'alice', ['friends', 'family'])
+    # The session expires, and another connection claims it.
+    await redis.delete(backend._user_key(1))
+    assert await backend.claim_user(1, 'second')
+    assert not await backend.heartbeat(1, 'first', 'alice', ['friends', 'family'])
+    assert await redis.get(backend._user_key(1)) == 'second'
+    assert await backend.heartbeat(1, 'second', 'alice', ['friends'])
+    assert 0 < await redis.ttl(backend._user_key(1)) <= 5
+    # Only the connection holding the session releases it.
+    await backend.release_user(1, 'first')
+    assert await redis.get(backend._user_key(1)) == 'second'
+    await backend.release_user(1, 'second')
+    assert await redis.get(backend._user_key(1)) is None
+    await backend.leave('friends', 'alice')
+    assert await backend.members('friends') == []
+    await redis.delete(*await redis.keys(backend.prefix + ':*'))
+    redis.close()
+    await redis.wait_closed()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_chatroom_session_lost(redis_host, monkeypatch):
+    """
+    Tests that a connection whose session was lost, and claimed
+      by another node, is told so and closed.
+    """
+
+    backend = RedisPresence(redis_host, ttl=1, prefix='chatrooms:test:%s' % uuid.uuid4().hex)
+    monkeypatch.setattr('chatrooms.consumers.presence', backend)
+    token = await attempt_login('david', 'daviddavid$12345')
+    communicator = make_communicator(token)
+    connected, _ = await communicator.connect()
+    assert connected
+    motd = await communicator.receive_json_from()
+    assert motd['code'] == 'api-motd'
+    user = await database_sync_to_async(User.objects.get)(username='david')
+    redis = await backend.pools.get()
+    await redis.set(backend._user_key(user.id), 'another-node!channel')
+    fatal = await communicator.receive_json_from(timeout=2)
+    assert fatal == {"type": "fatal", "code": "session-lost"}
+    closed = await communicator.receive_output()
+    assert closed['type'] == 'websocket.close'
+    await communicator.disconnect()
+    assert await redis.get(backend._user_key(user.id)) == 'another-node!channel'
+    await redis.delete(*await redis.keys(backend.prefix + ':*'))
+    redis.close()
+    await redis.wait_closed()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_message_write_behind():
+    """
+    Tests the write-behind buffer: messages are inserted
+      in bulk, by batch size or by time, and the rejected
+      ones are dropped.
+    """
+
+    user = await database_sync_to_async(User.objects.get)(username='erin')
+    room = await database_sync_to_async(Room.objects.get)(name='forex')
+    count = database_sync_to_async(lambda: Message.objects.filter(room=room, user=user).count())
+    writer = MessageWriter(max_batch=2, flush_interval=0.2, max_buffer=4)
+    for index in range(3):
+        await writer.write(Message(room=room, user=user, content='Buffered %d' % index, created_on=timezone.now()))
+    # The first batch is complete, the second one is not.
+    await asyncio.sleep(0.1)
+    assert await count() == 2
+    assert writer.stats()['buffered'] == 1
+    # The second one is flushed when the interval elapses.
+    await asyncio.sleep(0.3)
+    assert await count() == 3
+    stats = writer.stats()
+    assert stats['buffered'] == 0
+    assert stats['flushes'] == 2
+    assert stats['flushed'] == 3
+    assert stats['max_flush_size'] == 2
+    # A rejected message is dropped, but the other messages
+    # of its batch are still inserted (also the ones of a
+    # month without a partition yet).
+    writer = MessageWriter(max_batch=4, flush_interval=0.2, max_buffer=4)
+    ahead = add_months(month_start(timezone.now()), 50)
+    for content, created_on in [('Valid 1', timezone.now()), ('x' * 513, timezone.now()), ('Valid 2', ahead),
+                                ('Valid 3', timezone.now())]:
+        await writer.write(Message(room=room, user=user, content=content, created_on=created_on))
+    assert await writer.flush()
+    assert await count() == 6
+    stats = writer.stats()
+    assert stats['flushed'] == 3
+    assert stats['dropped'] == 1
+    assert stats['buffered'] == 0
+    # Concurrent flushes insert the batches in order.
+    writer = MessageWriter(max_batch=1, flush_interval=10, max_buffer=20)
+    for index in range(12):
+        await writer.write(Message(room=room, user=user, content='Ordered %02d' % index, created_on=timezone.now()))
+    await asyncio.gather(writer.flush(), writer.flush(), database_sync_to_async(writer.flush_sync)())
+    assert writer.stats()['buffered'] == 0
+    contents = await database_sync_to_async(lambda: list(Message.objects.filter(
+        room=room, content__startswith='Ordered'
+    ).order_by('id').values_list('content', flat=True)))()
+    assert contents == ['Ordered %02d' % index for index in range(12)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('backend', ['local', 'redis'])
+async def test_recent_messages_buffers(backend, redis_host):
+    """
+    Tests the recent messages buffers: priming is discarded if
+      a message arrived, or the buffer was invalidated, while
+      the database was queried, and invalidated buffers stay
+      cold until primed again.
+    """
+
+    if backend == 'redis':
+        buffers = RedisRecentMessages(redis_host, size=3, prefix='chatrooms:test:%s' % uuid.uuid4().hex)
+    else:
+        buffers = LocalRecentMessages(size=3)
+
+    def entry(id_):
+        return {"id": id_, "created_on": "2020-10-17T12:00:0%d+00:00" % id_, "stamp": "2020-10-17 12:00:0%d" % id_,
+                "user": "alice", "body": "Message %d" % id_}
+
+    assert await buffers.get(1) is None
+    # A message arrives while querying the latest ones.
+    version = await buffers.version(1)
+    await buffers.push(1, entry(3))
+    await buffers.prime(1, [entry(2), entry(1)], version)
+    assert await buffers.get(1) is None
+    # Messages are deleted while querying the latest ones.
+    version = await buffers.version(1)
+    await buffers.invalidate([1])
+    await buffers.prime(1, [entry(3), entry(2), entry(1)], version)
+    assert await buffers.get(1) is None
+    # Primed buffers are kept up to date, until invalidated.
+    await buffers.prime(1, [entry(3), entry(2)], await buffers.version(1))
+    await buffers.prime(2, [], await buffers.version(2))
+    await buffers.push(1, entry(4))
+    await buffers.push(1, entry(5))
+    assert [item["id"] for item in await buffers.get(1)] == [5, 4, 3]
+    assert await buffers.get(2) == []
+    await buffers.invalidate([1, 2])
+    assert await buffers.get(1) is None
+    assert await buffers.get(2) is None
+    if backend == 'redis':
+        redis = await buffers.pools.get()
+        keys = await redis.keys(buffers.prefix + ':*')
+        await redis.delete(*keys)
+        redis.close()
+        await redis.wait_closed()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_recent_messages_deletion():
+    """
+    Tests that deleting a message drops the recent messages
+      buffer of its room.
+    """
+
+    user, _ = await database_sync_to_async(User.objects.get_or_create)(username='deleter')
+    room, _ = await database_sync_to_async(Room.objects.get_or_create)(name='deletions')
+    message = await database_sync_to_async(Message.objects.create)(room=room, user=user, content='Deleted')
+    await recent_messages.prime(room.id, [message_entry(message)], await recent_messages.version(room.id))
+    assert len(await recent_messages.get(room.id)) == 1
+    await database_sync_to_async(message.delete)()
+    assert await recent_messages.get(room.id) is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_room_registry():
+    """
+    Tests the room registry: it is loaded once per process, and
+      kept up to date with the rooms created, renamed or deleted
+      in this process or in other nodes, even while this process
+      has no connections.
+    """
+
+    token = await attempt_login('david', 'daviddavid$12345')
+    communicator = make_communicator(token)
+    connected, _ = await communicator.connect()
+    assert connected
+    await communicator.receive_json_from()
+    await communicator.send_json_to({'type': 'list'})
+    await communicator.receive_json_from()
+    await communicator.disconnect()
+    assert registry.warm
+    loaded = registry._listener
+    # Changes in this process.
+    room = await database_sync_to_async(Room.objects.create)(name='registered')
+    assert registry.get('registered') == room.id
+    room.name = 'renamed'
+    await database_sync_to_async(room.save)()
+    assert registry.get('registered') is None
+    assert registry.get('renamed') == room.id
+    remote_id = room.id + 1000
+    await database_sync_to_async(room.delete)()
+    assert registry.get('renamed') is None
+    # Changes in another node only arrive through the channel layer.
+    layer = get_channel_layer()
+    await layer.group_send(REGISTRY_GROUP, {"type": "registry_room_saved", "id": remote_id, "name": "remote"})
+    for _ in range(50):
+        if registry.get('remote') is not None:
+            break
+        await asyncio.sleep(0.02)
+    assert registry.get('remote') == remote_id
+    await layer.group_send(REGISTRY_GROUP, {"type": "registry_room_deleted", "id": remote_id})
+    for _ in range(50):
+        if registry.get('remote') is None:
+            break
+        await asyncio.sleep(0.02)
+    assert registry.get('remote') is None
+    # The registry is neither loaded nor subscribed again.
+    await registry.ensure()
+    assert registry._listener is loaded
+
+
+@pytest.mark.django_db
+def test_history_pending_cursor():
+    """
+    Tests the cursor of a full recent messages buffer whose
+      oldest entries were not inserted yet (in write-behind
+      mode): the older page has the other messages of the same
+      date, but not the ones already seen.
+    """
+
+    room = Room.objects.create(name='pending')
+    users = [User.objects.create_user('pending%d' % index, 'pending%d@example.org' % index, 'pending$12345')
+             for index in range(3)]
+    stamp = timezone.now() - datetime.timedelta(minutes=1)
+    older = Message.objects.create(room=room, user=users[0], content='Older',
+                                   created_on=stamp - datetime.timedelta(seconds=1))
+    for user in users:
+        Message.objects.create(room=room, user=user, content='Same date', created_on=stamp)
+    newer = [message_entry(Message(id=None, room=room, user=users[0], content='Newer',
+                                   created_on=stamp + datetime.timedelta(seconds=index + 1)))
+             for index in range(HISTORY_PAGE_SIZE - 2)]
+    seen = [message_entry(Message(id=None, room=room, user=user, content='Same date', created_on=stamp))
+            for user in users[:2]]
+    cursor = entries_cursor(list(reversed(newer)) + seen)
+    messages, _ = get_room_messages(room.id, decode_cursor(cursor))
+    assert [(message.user, message.content) for message in messages] == [(users[2], 'Same date'), (users[0], 'Older')]
+    assert messages[-1].id == older.id
+
+
+def test_json_codec_backends():
+    """
+    Tests that the default JSON codec encodes the protocol
+      messages to the same bytes json.dumps does, and that
+      the fast one encodes them as compact JSON, and both
+      decode each other's.
+    """
+
+    messages = [
+        {"type": "room:notification", "code": "joined", "you": True, "user": "alice", "room_name": "friends",
+         "stamp": "2020-10-17 12:00:00", "status": {
+             "users": [{"name": "alice", "you": True}, {"name": "bob", "you": False}],
+             "messages": [{"stamp": "2020-10-17 11:59:00", "user": "bob", "body": "¡Hola! \"quoted\" \u2028 😀",
+                           "you": False}],
+             "before": None}},
+        {"type": "room:notification", "code": "message", "you": False, "user": "bob", "room_name": "friends",
+         "body": "tab\tnewline\ncontrol\x01 backslash\\", "stamp": "2020-10-17 12:00:00", "seq": 2 ** 40},
+        {"type": "error", "code": "rate-limited", "details": {"type": "message", "retry_after": 0.125}},
+    ]
+    stdlib = JsonCodec()
+    assert not stdlib.fast
+    for message in messages:
+        assert stdlib.encode(message) == json.dumps(message).encode('utf-8')
+    assert stdlib.batch([stdlib.encode(message) for message in messages]) == json.dumps({
+        "type": "batch", "events": messages
+    }).encode('utf-8')
+    with pytest.raises(ValueError):
+        stdlib.decode(b'{"type": ')
+
+    pytest.importorskip('orjson')
+    fast = JsonCodec(fast=True)
+    assert fast.fast
+    for message in messages:
+        encoded = fast.encode(message)
+        assert encoded == json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        assert fast.decode(encoded) == stdlib.decode(encoded) == message
+        assert fast.decode(stdlib.encode(message)) == message
+        assert stdlib.decode(fast.frame(encoded)["text_data"]) == message
+    assert json.loads(fast.batch([fast.encode(message) for message in messages])) == {
+        "type": "batch", "events": messages
+    }
+    with pytest.raises(ValueError):
+        fast.decode(b'{"type": ')
+
+
+@pytest.mark.django_db
+def test_message_partitions(settings, tmp_path):
+    """
+    Tests the monthly partitions of the message table, and the
+      retention job: expired partitions are archived, and the
+      remaining expired messages are deleted per room. Missing
+      partitions are created on demand.
+    """
+
+    settings.CHATROOMS_MESSAGE_RETENTION_DAYS = 60
+    now = timezone.now()
+    first = add_months(month_start(now), -14)
+    ensure_partitions(first, now)
+    assert ensure_partitions(first, now) == []
+    user = User.objects.get(username='erin')
+    friends = Room.objects.get(name='friends')
+    short = Room.objects.create(name='short-lived', retention_days=30)
+    old = Message.objects.create(room=friends, user=user, content='Archived', created_on=first)
+    kept = Message.objects.create(room=friends, user=user, content='Kept', created_on=now - datetime.timedelta(days=45))
+    purged = Message.objects.create(room=short, user=user, content='Purged', created_on=now - datetime.timedelta(days=45))
+    # The foreign keys are checked right away, so the partitions
+    # may be altered in this same (test) transaction.
+    with connection.cursor() as cursor:
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+    # The recent messages buffers of the affected rooms are dropped.
+    for room in (friends, short):
+        async_to_sync(recent_messages.prime)(room.id, [], async_to_sync(recent_messages.version)(room.id))
+    out = io.StringIO()
+    call_command('partition_messages', archive_dir=str(tmp_path), stdout=out)
+    assert async_to_sync(recent_messages.get)(friends.id) is None
+    assert async_to_sync(recent_messages.get)(short.id) is None
+    names = [name for _, name in partitions()]
+    assert partition_name(add_months(month_start(now), 3)) in names
+    assert partition_name(first) not in names
+    assert "Deleted 1 messages of room %d" % short.id in out.getvalue()
+    assert list(Message.objects.filter(id__in=[old.id, kept.id, purged.id]).values_list('id', flat=True)) == [kept.id]
+    with gzip.open(str(tmp_path / ('%s.csv.gz' % partition_name(first))), 'rt') as archived:
+        assert archived.read().splitlines()[1].endswith(',erin,friends,Archived')
+    # Missing partitions are created on demand.
+    ahead = add_months(month_start(now), 40)
+    ensure_month_partition(ahead)
+    ensure_month_partition(ahead)
+    assert partition_name(ahead) in [name for _, name in partitions()]
+    assert Message.objects.create(room=friends, user=user, content='Ahead', created_on=ahead).id
+    # Detached partitions are renamed, so their month may be partitioned again.
+    detached = detach_partition(partition_name(ahead))
+    assert detached.startswith(partition_name(ahead) + '_d')
+    ensure_month_partition(ahead)
+    assert partition_name(ahead) in [name for _, name in partitions()]
+    assert Message.objects.create(room=friends, user=user, content='Imported', created_on=ahead).id
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT content FROM %s' % connection.ops.quote_name(detached))
+        assert cursor.fetchall() == [('Ahead',)]
+    # The migrations state tells the indexes which really exist (the
+    # search one is out of the state, as its column).
+    call_command('makemigrations', 'chatrooms', check=True, dry_run=True, stdout=io.StringIO())
+    state = MigrationLoader(connection).project_state(('chatrooms', '0007_message_admin_indexes'))
+    with connection.schema_editor(collect_sql=True) as editor:
+        expected = {str(statement.parts['name']).strip('"') for statement in editor._model_indexes_sql(state.apps.get_model('chatrooms', 'Message'))}
+    with connection.cursor() as cursor:
+        indexes = {index for index, details in connection.introspection.get_constraints(
+            cursor, Message._meta.db_table
+        ).items() if details['index'] and not details['primary_key']}
+    assert indexes == expected | {'chatrooms_message_search_idx'}
+
+
+@pytest.mark.django_db
+def test_message_admin(admin_user, monkeypatch):
+    """
+    Tests the message admin, paged by keyset and filtered
+      by room and user, and the latest messages of a room.
+    """
+
+    user = User.objects.get(username='erin')
+    room = Room.objects.create(name='admin-paging')
+    now = timezone.now()
+    Message.objects.bulk_create([
+        Message(room=room, user=user, content='Paged %d' % index, created_on=now - datetime.timedelta(minutes=index))
+        for index in range(5)
+    ])
+    message_admin = site._registry[Message]
+    monkeypatch.setattr(message_admin, 'list_per_page', 2)
+    contents = []
+    query = '?room__id__exact=%d&user__id__exact=%d' % (room.id, user.id)
+    while query:
+        request = RequestFactory().get('/admin/chatrooms/message/' + query)
+        request.user = admin_user
+        response = message_admin.changelist_view(request)
+        response.render()
+        changelist = response.context_data['cl']
+        assert changelist.result_count == 5
+        assert len(changelist.result_list) <= 2
+        contents.extend(message.content for message in changelist.result_list)
+        query = changelist.older_url
+    assert contents == ['Paged %d' % index for index in range(5)]
+    assert changelist.latest_url
+    # The room inline only loads the latest messages.
+    monkeypatch.setattr(LatestMessagesFormSet, 'limit', 3)
+    request = RequestFactory().get('/admin/chatrooms/room/%d/change/' % room.id)
+    request.user = admin_user
+    response = site._registry[Room].change_view(request, str(room.id))
+    formset = response.context_data['inline_admin_formsets'][0].formset
+    assert [form.instance.content for form in formset.forms] == ['Paged 0', 'Paged 1', 'Paged 2']
+
+
+@pytest.mark.django_db
+def test_room_export(admin_user, tmp_path):
+    """
+    Tests the streamed exports of a room transcript, by
+      the endpoint and by the command.
+    """
+
+    user = User.objects.get(username='erin')
+    room = Room.objects.create(name='exported')
+    start = timezone.now() - datetime.timedelta(days=3)
+    Message.objects.bulk_create([
+        Message(room=room, user=user, content='Day %d, "quoted", comma' % index,
+                created_on=start + datetime.timedelta(days=index))
+        for index in range(3)
+    ])
+    view = RoomExportView.as_view()
+    # Only staff users may export.
+    request = factory.get('/rooms/exported/export.ndjson')
+    force_authenticate(request, user=user)
+    assert view(request, room_name='exported', export_format='ndjson').status_code == 403
+    request = factory.get('/rooms/exported/export.ndjson', {'since': (start + datetime.timedelta(days=1)).isoformat()})
+    force_authenticate(request, user=admin_user)
+    response = view(request, room_name='exported', export_format='ndjson')
+    assert response.status_code == 200
+    assert response.streaming
+    assert response['Content-Type'] == 'application/x-ndjson'
+    lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+    assert [(line['user'], line['room'], line['content']) for line in lines] == [
+        ('erin', 'exported', 'Day %d, "quoted", comma' % index) for index in (1, 2)
+    ]
+    request = factory.get('/rooms/exported/export.csv', {'until': 'not-a-date'})
+    force_authenticate(request, user=admin_user)
+    assert view(request, room_name='exported', export_format='csv').status_code == 400
+    request = factory.get('/rooms/missing/export.csv')
+    force_authenticate(request, user=admin_user)
+    assert view(request, room_name='missing', export_format='csv').status_code == 404
+    # The command, fetching one row at a time.
+    output = tmp_path / 'exported.csv'
+    call_command('export_room', 'exported', format_='csv', output=str(output), chunk_size=1, stderr=io.StringIO())
+    with open(str(output), newline='') as exported:
+        rows = list(csv.reader(exported))
+    assert rows[0] == ['id', 'created_on', 'user', 'room', 'content']
+    assert [row[4] for row in rows[1:]] == ['Day %d, "quoted", comma' % index for index in range(3)]
+
+
+# The secondary indexes of the message table: whether they are
+# valid, and how many partition indexes are attached to them.
+MESSAGE_INDEXES_QUERY = (
+    "SELECT index_class.relname, pg_index.indisvalid, "
+    "(SELECT count(*) FROM pg_inherits WHERE pg_inherits.inhparent = pg_index.indexrelid) FROM pg_index "
+    "JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid "
+    "WHERE pg_index.indrelid = 'chatrooms_message'::regclass AND NOT pg_index.indisprimary ORDER BY 1"
+)
+
+
+@pytest.mark.django_db
+def test_message_import(tmp_path):
+    """
+    Tests the bulk import of messages: valid records are
+      copied (and their partitions created), and invalid
+      ones are rejected, with their reason.
+    """
+
+    room = Room.objects.create(name='imported')
+    old = add_months(month_start(timezone.now()), -30)
+    records = [
+        {"created_on": old.isoformat(), "user": "erin", "room": "imported", "content": "Imported, \"old\"\nline"},
+        {"created_on": "2020-10-17T12:00:00", "user": "frank", "room": "imported", "content": "Imported, naive"},
+        {"created_on": "2020-10-17T12:00:00", "user": "nobody", "room": "imported", "content": "Unknown user"},
+        {"created_on": "2020-10-17T12:00:00", "user": "erin", "room": "nowhere", "content": "Unknown room"},
+        {"created_on": "yesterday", "user": "erin", "room": "imported", "content": "Invalid date"},
+        {"created_on": "2020-10-17T12:00:00", "user": "erin", "room": "imported", "content": "x" * 513},
+    ]
+    path = tmp_path / 'messages.ndjson'
+    path.write_text('\n'.join([json.dumps(record) for record in records] + ['[1, 2]', '{"broken']) + '\n')
+    rejects = tmp_path / 'rejects.ndjson'
+    with connection.cursor() as cursor:
+        # The foreign keys are checked right away, so the indexes
+        # may be created again in this same (test) transaction.
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        cursor.execute(MESSAGE_INDEXES_QUERY)
+        indexes = [name for name, _, _ in cursor.fetchall()]
+    out = io.StringIO()
+    call_command('import_messages', str(path), batch_size=3, rejects=str(rejects), without_indexes=True, stdout=out)
+    assert "Read 3 records: 2 imported, 1 rejected" in out.getvalue()
+    assert "Imported 2 messages (6 rejected)" in out.getvalue()
+    with connection.cursor() as cursor:
+        cursor.execute(MESSAGE_INDEXES_QUERY)
+        rebuilt = cursor.fetchall()
+    assert partition_name(old) in [name for _, name in partitions()]
+    # The indexes are valid, and exist in every partition (also
+    # in the ones created by the import).
+    assert [name for name, _, _ in rebuilt] == indexes
+    assert all(valid and children == len(partitions()) for _, valid, children in rebuilt)
+    assert list(Message.objects.filter(room=room).order_by('created_on').values_list(
+        'created_on', 'user__username', 'content'
+    )) == [(datetime.datetime(2020, 10, 17, 12, tzinfo=datetime.timezone.utc), 'frank', 'Imported, naive'),
+           (old, 'erin', 'Imported, "old"\nline')]
+    rejected = [json.loads(line) for line in rejects.read_text().splitlines()]
+    assert [(line['line'], line['reason']) for line in rejected] == [
+        (3, 'unknown user: nobody'), (4, 'unknown room: nowhere'), (5, 'invalid created_on: yesterday'),
+        (6, 'content longer than 512 characters'), (7, 'not a JSON object'),
+        (8, rejected[-1]['reason'])
+    ]
+    assert rejected[-1]['reason'].startswith('invalid JSON')
+    # The exports may be imported back.
+    output = tmp_path / 'imported.csv'
+    call_command('export_room', 'imported', format_='csv', output=str(output), stderr=io.StringIO())
+    call_command('import_messages', str(output), stdout=io.StringIO())
+    assert Message.objects.filter(room=room).count() == 4
+
+
+class SlowTransport(StringTransport):
+    """
+    A transport whose write buffer is full over `buffer_size` bytes,
+      until drained. Like twisted's TCP transports, it pauses its
+      streaming producer when full, and resumes it when drained.
+      An HTTP channel producer is registered, like in daphne.
+    """
+
+    def __init__(self, buffer_size=64):
+        super().__init__()
+        self.buffer_size = buffer_size
+        self.registerProducer(object(), True)
+
+    def write(self, data):
+        super().write(data)
+        if self.streaming and len(self.value()) > self.buffer_size:
+            self.producer.pauseProducing()
+
+    def drain(self):
+        """
+        Empties the buffer, and resumes the producer.
+        :return: The frames which were in the buffer.
+        """
+
+        data = self.value()
+        self.clear()
+        self.producer.resumeProducing()
+        return read_frames(data)
+
+
+def read_frames(data):
+    """
+    Parses the websocket frames sent by a server.
+    :param data: The bytes sent by the server.
+    :return: A list of (opcode, rsv1, payload) tuples.
+    """
+
+    frames = []
+    while data:
+        length, offset = data[1] & 0x7f, 2
+        if length == 126:
+            length, offset = struct.unpack('>H', data[2:4])[0], 4
+        elif length == 127:
+            length, offset = struct.unpack('>Q', data[2:10])[0], 10
+        frames.append((data[0] & 0x0f, bool(data[0] & 0x40), data[offset:offset + length]))
+        data = data[offset + length:]
+    return frames
+
+
+def make_protocol(transport):
+    """
+    Creates the websocket protocol of the development server, over
+      a transport, and already open (as after the handshake).
+    :param transport: The transport to use.
+    :return: The protocol.
+    """
+
+    server = CompressingServer(application=None, endpoints=['tcp:port=0:interface=127.0.0.1'])
+    server.ws_factory = WebSocketFactory(server)
+    protocol = server.ws_factory.buildProtocol(None)
+    protocol.makeConnection(transport)
+    protocol.state = protocol.STATE_OPEN
+    protocol.websocket_version = 13
+    protocol.client_addr = ['127.0.0.1', 50000]
+    return protocol
+
+
+def test_outbound_queue_policies():
+    """
+    Tests the outbound queue policies, when the client
+      does not read fast enough.
+    """
+
+    # Dropping the oldest frames. The first frame is written
+    # right away, and then the connection gets paused.
+    sent = []
+    queue = OutboundQueue(sent.append, high_water=3, policy='drop-oldest')
+    queue.put('m0')
+    queue.pause()
+    for index in range(1, 6):
+        queue.put('m%d' % index)
+    assert queue.stats()['depth'] == 3
+    assert queue.stats()['dropped'] == 2
+    queue.resume()
+    assert sent == ['m0', 'm3', 'm4', 'm5']
+
+    # Coalescing presence frames of the same user and room.
+    sent = []
+    queue = OutboundQueue(sent.append, high_water=3, policy='coalesce-presence')
+    queue.pause()
+    queue.put('m0')
+    queue.put('joined', ('friends', 'bob'))
+    queue.put('parted', ('friends', 'bob'))
+    queue.put('m1')
+    assert queue.stats()['coalesced'] == 1
+    # Without superseded frames, the oldest presence frame goes.
+    queue.put('m2')
+    assert queue.stats()['dropped'] == 1
+    queue.resume()
+    assert sent == ['m0', 'm1', 'm2']
+
+    # Disconnecting the client. No frame is accepted afterwards.
+    sent, disconnected = [], []
+    queue = OutboundQueue(sent.append, high_water=2, policy='disconnect',
+                          disconnect=lambda: disconnected.append(True))
+    queue.pause()
+    for index in range(3):
+        queue.put('m%d' % index)
+    assert queue.stats()['dropped'] == 2
+    assert disconnected
+    queue.put('m3')
+    queue.resume()
+    assert sent == []
+
+
+def test_outbound_queue_protocol(settings):
+    """
+    Tests that the websocket protocol of the development server
+      queues the frames while the write buffer of its transport
+      is full, and applies the policy to them.
+    """
+
+    settings.CHATROOMS_OUTBOUND_QUEUE = {'high_water': 2, 'policy': 'coalesce-presence'}
+    transport = SlowTransport(buffer_size=8)
+    protocol = make_protocol(transport)
+    assert transport.producer is protocol
+    protocol.handle_reply({"type": "websocket.send", "text": "m0-filling-the-buffer"})
+    protocol.handle_reply({"type": "websocket.send", "text": "joined", "presence": ["friends", "bob"]})
+    protocol.handle_reply({"type": "websocket.send", "text": "m1"})
+    protocol.handle_reply({"type": "websocket.send", "text": "parted", "presence": ["friends", "bob"]})
+    protocol.handle_reply({"type": "websocket.close"})
+    assert protocol.outbound.stats()['dropped'] == 1
+    assert protocol.outbound.stats()['depth'] == 3
+    assert [payload for _, _, payload in read_frames(transport.value())] == [b"m0-filling-the-buffer"]
+    # Once drained, the pending frames are sent, in order, until
+    # the buffer is full again.
+    received = []
+    while transport.value():
+        received.extend(transport.drain())
+    assert [(opcode, payload) for opcode, _, payload in received] == [
+        (1, b"m0-filling-the-buffer"), (1, b"m1"), (1, b"parted"), (8, b"\x03\xe8")
+    ]
+
+    # Disconnecting a slow client, with its codec.
+    settings.CHATROOMS_OUTBOUND_QUEUE = {'high_water': 1, 'policy': 'disconnect'}
+    transport = SlowTransport(buffer_size=8)
+    protocol = make_protocol(transport)
+    protocol.handle_reply({"type": "websocket.send", "bytes": b"m0-filling-the-buffer"})
+    protocol.handle_reply({"type": "websocket.send", "bytes": b"m1"})
+    protocol.handle_reply({"type": "websocket.send", "bytes": b"m2"})
+    frames = read_frames(transport.value())
+    assert frames[0][2] == b"m0-filling-the-buffer"
+    assert json.loads(frames[1][2]) == {"type": "fatal", "code": "slow-consumer"}
+    assert frames[2][0] == 8
+
+
+def test_compression_protocol(settings):
+    """
+    Tests that the websocket protocol of the development server
+      only compresses the messages reaching the threshold, when
+      permessage-deflate was negotiated, and counts them.
+    """
+
+    settings.CHATROOMS_COMPRESSION = {'threshold': 64}
+    settings.CHATROOMS_OUTBOUND_QUEUE = None
+    accept = accept_deflate([PerMessageDeflateOffer()])
+    assert accept is not None
+    transport = SlowTransport(buffer_size=2 ** 20)
+    protocol = make_protocol(transport)
+    assert isinstance(protocol, CompressingWebSocketProtocol)
+    protocol._perMessageCompress = PerMessageDeflate.create_from_offer_accept(True, accept)
+    before = compression_stats()
+    small, large = '{"type": "small"}', json.dumps({"messages": ["A message body"] * 50})
+    protocol.handle_reply({"type": "websocket.send", "text": small})
+    protocol.handle_reply({"type": "websocket.send", "text": large})
+    (_, small_compressed, small_payload), (_, large_compressed, large_payload) = read_frames(transport.value())
+    assert not small_compressed
+    assert small_payload == small.encode()
+    assert large_compressed
+    assert len(large_payload) < len(large)
+    assert zlib.decompressobj(-zlib.MAX_WBITS).decompress(large_payload + b'\x00\x00\xff\xff') == large.encode()
+    after = compression_stats()
+    assert after['compressed_messages'] - before.get('compressed_messages', 0) == 1
+    assert after['compressed_in'] - before.get('compressed_in', 0) == len(large)
+    assert after['compressed_out'] - before.get('compressed_out', 0) == len(large_payload)
+    assert after['uncompressed_messages'] - before.get('uncompressed_messages', 0) == 1
+    assert after['ratio'] < 1
+
+    # Without the extension negotiated, nothing is compressed.
+    transport = SlowTransport(buffer_size=2 ** 20)
+    protocol = make_protocol(transport)
+    protocol.handle_reply({"type": "websocket.send", "text": large})
+    assert read_frames(transport.value()) == [(1, False, large.encode())]
+    # Nor is it negotiated when the compression is disabled.
+    settings.CHATROOMS_COMPRESSION = None
+    assert accept_deflate([PerMessageDeflateOffer()]) is None
+
+
+@pytest.mark.django_db
+def test_runserver_compression(monkeypatch):
+    """
+    Tests that the runserver command of the project is the one
+      serving with the compressing (and queueing) protocol.
+    """
+
+    servers = []
+    monkeypatch.setattr(CompressingServer, 'run', lambda server: servers.append(server))
+    call_command('runserver', '127.0.0.1:8799', use_reloader=False, stdout=io.StringIO())
+    assert len(servers) == 1
+    assert type(servers[0]) is CompressingServer
+    servers[0].ws_factory = WebSocketFactory(servers[0])
+    assert servers[0].ws_factory.protocol is CompressingWebSocketProtocol
+    assert servers[0].ws_factory.perMessageCompressionAccept is accept_deflate
@@ -4,10 +4,12 @@ from . import views, api
 app_name = 'chatrooms'
 urlpatterns = [
     path('', views.index, name='index'),
+    path('metrics', views.metrics, name='metrics'),
 
     # API endpoints:
     path('profile', api.MyProfileView.as_view(), name="profile"),
     path('login', api.UserLoginView.as_view(), name="login"),
     path('register', api.UserCreateView.as_view(), name="register"),
-    path('logout', api.UserLogoutView.as_view(), name="logout")
+    path('logout', api.UserLogoutView.as_view(), name="logout"),
+    path('rooms/<str:room_name>/export.<str:export_format>', api.RoomExportView.as_view(), name="room-export")
 ]
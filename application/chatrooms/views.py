@@ -1,4 +1,9 @@
+import ipaddress
+from django.conf import settings
+from django.http import HttpResponse, Http404
 from django.shortcuts import render
+from django.views.decorators.http import require_GET
+from . import metrics as chat_metrics
 from .forms import LoginForm, RegisterForm
 import logging
 
@@ -18,3 +23,22 @@ def index(request):
         'login': LoginForm(initial={}),
         'register': RegisterForm(initial={})
     })
+
+
+@require_GET
+def metrics(request):
+    """
+    The metrics of this server process, in the Prometheus
+      text format, to be scraped by Prometheus. Only served
+      to the addresses in the CHATROOMS_METRICS_ALLOWED_IPS
+      setting (addresses or networks), if any.
+    """
+
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR') or '')
+    except ValueError:
+        raise Http404()
+    allowed = getattr(settings, 'CHATROOMS_METRICS_ALLOWED_IPS', None) or ()
+    if not any(address in ipaddress.ip_network(network, strict=False) for network in allowed):
+        raise Http404()
+    return HttpResponse(chat_metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,9 +1,91 @@
 import os
 import csv
 import json
+import time
+import bisect
+import signal
 import asyncio
+import hashlib
+import functools
+import itertools
+import collections
 import urllib.parse
 import aiohttp
+from aiohttp import web
+try:
+    import aioredis
+except ImportError:
+    aioredis = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Quotes are cached for FINBOT_QUOTE_TTL seconds. Unknown symbols are
+# cached for FINBOT_QUOTE_NEGATIVE_TTL seconds. The quotes are fetched
+# from FINBOT_STOOQ_URL, which may point to a local stand-in for tests.
+QUOTE_TTL = float(os.getenv('FINBOT_QUOTE_TTL', '') or 60)
+QUOTE_NEGATIVE_TTL = float(os.getenv('FINBOT_QUOTE_NEGATIVE_TTL', '') or 300)
+STOOQ_URL = os.getenv('FINBOT_STOOQ_URL', '') or 'https://stooq.com'
+# Symbols asked within FINBOT_BATCH_WINDOW seconds are fetched together,
+# in requests of up to FINBOT_BATCH_SIZE symbols. Users may ask up to
+# FINBOT_MAX_SYMBOLS symbols in a single command.
+BATCH_WINDOW = float(os.getenv('FINBOT_BATCH_WINDOW', '') or 0.05)
+BATCH_SIZE = int(os.getenv('FINBOT_BATCH_SIZE', '') or 20)
+MAX_SYMBOLS = int(os.getenv('FINBOT_MAX_SYMBOLS', '') or 10)
+# Commands are attended by FINBOT_WORKERS concurrent workers, from a
+# queue of up to FINBOT_QUEUE_SIZE pending commands. Each command has
+# FINBOT_COMMAND_TIMEOUT seconds to be answered. Dispatcher stats are
+# printed every FINBOT_STATS_INTERVAL seconds (0 to never print them).
+WORKERS = int(os.getenv('FINBOT_WORKERS', '') or 4)
+QUEUE_SIZE = int(os.getenv('FINBOT_QUEUE_SIZE', '') or 100)
+COMMAND_TIMEOUT = float(os.getenv('FINBOT_COMMAND_TIMEOUT', '') or 10)
+STATS_INTERVAL = float(os.getenv('FINBOT_STATS_INTERVAL', '') or 60)
+# The dispatcher stats, and the latency histograms of the commands, are
+# also served (in the Prometheus text format) at the /metrics path of
+# the FINBOT_METRICS_PORT port, if set.
+METRICS_PORT = int(os.getenv('FINBOT_METRICS_PORT', '') or 0)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# In fleet mode (FINBOT_FLEET being a redis:// url or a file:// directory
+# shared by all the instances), the rooms are split among the instances.
+# Each instance is identified by FINBOT_INSTANCE (by default, its username)
+# and must renew its membership within FINBOT_FLEET_TTL seconds.
+FLEET = os.getenv('FINBOT_FLEET', '')
+FLEET_TTL = float(os.getenv('FINBOT_FLEET_TTL', '') or 15)
+# The rooms which could not be joined (e.g. the joins were rate-limited)
+# are joined again every FINBOT_JOIN_RETRY_INTERVAL seconds. In fleet mode,
+# they are joined again on each rebalance instead.
+JOIN_RETRY_INTERVAL = float(os.getenv('FINBOT_JOIN_RETRY_INTERVAL', '') or 10)
+# The websocket messages are encoded and decoded with orjson (when it is
+# installed) if FINBOT_FAST_JSON is 1, and with the standard library
+# otherwise. orjson encodes compact JSON: the same content, in less bytes.
+FAST_JSON = orjson is not None and os.getenv('FINBOT_FAST_JSON', '') == '1'
+
+
+def dumps(payload):
+    """
+    Encodes a websocket message.
+    :param payload: The message to encode.
+    :return: The JSON text.
+    """
+
+    if FAST_JSON:
+        return orjson.dumps(payload).decode('utf-8')
+    return json.dumps(payload)
+
+
+def loads(data):
+    """
+    Decodes a websocket message.
+    :param data: The JSON text or bytes.
+    :return: The decoded message.
+    :raises ValueError: If it is not valid JSON.
+    """
+
+    if FAST_JSON:
+        return orjson.loads(data)
+    return json.loads(data)
 
 
 async def parse(message):
@@ -19,7 +101,7 @@ async def parse(message):
         return False
 
     try:
-        obj = json.loads(message.data)
+        obj = loads(message.data)
         if not isinstance(obj, dict):
             return None
         return obj
@@ -27,18 +109,20 @@ async def parse(message):
         return None
 
 
-async def join_rooms(websocket, rooms):
+async def join_rooms(websocket, rooms, joins, send):
     """
     Attempts to join all rooms defined in the FINBOT_ROOMS environment variable. If empty, lists
       all the rooms and attempts to join all of them.
     :param websocket: The websocket to use for the room(s) joining.
     :param rooms: The colon-separated list of rooms to join
+    :param joins: The joins tracker, which retries the failed joins.
+    :param send: The coroutine function to send a message with.
     """
 
     rooms = [] if rooms == '' else rooms.split(':')
 
     if not rooms:
-        await websocket.send_str(json.dumps({'type': 'list'}))
+        await websocket.send_str(dumps({'type': 'list'}))
         result = await parse(await websocket.receive())
         # A {"type": "notification", "code": "list", "list": [{"name": ..., ...}, ...]} message is expected.
         # The room names will be extracted out of it.
@@ -49,53 +133,752 @@ async def join_rooms(websocket, rooms):
                                ))
         else:
             rooms = [room['name'] for room in result.get('list', [])]
-    # For each room name, we attempt a join. It doesn't matter, with respect to the flow, if we fail to join.
-    # Aside from the fact that there's no reason to fail unless an implementation error, it would mean that
-    # the bot had already joined the room beforehand.
-    for room in rooms:
-        print(">>> finbot: joining room " + room)
-        await websocket.send_str(json.dumps({'type': 'join', 'room_name': room}))
+    # For each room name, we attempt a join. The replies are tracked by the joins tracker, so the
+    # joins which fail (e.g. being rate-limited) are attempted again later.
+    await joins.sync(send, rooms)
+
+
+async def retry_joins(joins, send, interval=JOIN_RETRY_INTERVAL):
+    """
+    Periodically attempts again the joins which failed.
+    :param joins: The joins tracker.
+    :param send: The coroutine function to send a message with.
+    :param interval: The time, in seconds, between attempts.
+    """
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await joins.sync(send)
+        except Exception as e:
+            print(">>> finbot: WARNING exception while joining the rooms: %s, %s" % (type(e).__name__, e.args))
+
+
+async def fetch_quotes(session, assets):
+    """
+    Fetches the prices of several assets in stooq, in a single request.
+    :param session: The http session to use.
+    :param assets: The asset codes to ask.
+    :return: A dictionary of asset => (symbol, price) tuple, with (None, None) for the assets
+      which are unknown or have no data.
+    :raises Exception: On network or unexpected HTTP errors.
+    """
+
+    url = '%s/q/l/?s=%s&f=sd2t2ohlcv&h&e=csv' % (
+        STOOQ_URL, '+'.join(urllib.parse.quote(asset.lower()) for asset in assets),
+    )
+    async with session.get(url) as response:
+        if response.status != 200:
+            raise RuntimeError("Unexpected HTTP code %s" % response.status)
+        rows = [row for row in csv.DictReader((await response.text()).split('\n')) if row.get('Symbol')]
+    # Rows are matched by symbol. Stooq answers one row per asked symbol, in order,
+    # so the position is used when a symbol comes back in a different notation, but
+    # only if that row was not matched by symbol to another asset.
+    by_symbol = {row['Symbol'].lower(): index for index, row in enumerate(rows)}
+    matched = {asset: by_symbol.get(asset.lower()) for asset in assets}
+    used = set(matched.values())
+    quotes = {}
+    for index, asset in enumerate(assets):
+        position = matched[asset]
+        if position is None and len(rows) == len(assets) and index not in used:
+            position = index
+            used.add(index)
+        row = None if position is None else rows[position]
+        if row is None:
+            print(">>> finbot: WARNING empty data for symbol %s" % asset)
+            quotes[asset] = (None, None)
+        elif row['Close'] == 'N/D':
+            print(">>> finbot: WARNING bad or unavailable stock symbol %s" % asset)
+            quotes[asset] = (None, None)
+        else:
+            quotes[asset] = (row['Symbol'], row['Close'])
+    return quotes
+
+
+class QuoteBatcher:
+    """
+    Collects the assets being asked during a short window, and fetches them
+      all in a single upstream request (or a few of them, if there are many
+      assets). Each asker gets the quote of its own asset.
+    """
+
+    def __init__(self, fetch_many, window=BATCH_WINDOW, max_size=BATCH_SIZE):
+        """
+        :param fetch_many: The upstream fetch: a coroutine function taking a list of assets,
+          and returning a dictionary of asset => (symbol, price) tuple.
+        :param window: The time, in seconds, to wait for more assets before fetching.
+        :param max_size: The maximum amount of assets per upstream request.
+        """
+
+        self.fetch_many = fetch_many
+        self.window = window
+        self.max_size = max_size
+        self._pending = {}
+        self._timer = None
+
+    async def fetch(self, asset):
+        """
+        Fetches the quote of an asset, in the next batch.
+        :param asset: The asset code to ask.
+        :return: A (symbol, price) tuple, or (None, None) if the asset is unknown.
+        """
+
+        future = self._pending.get(asset)
+        if future is None:
+            future = asyncio.get_event_loop().create_future()
+            self._pending[asset] = future
+            if len(self._pending) >= self.max_size:
+                self._flush()
+            elif self._timer is None:
+                self._timer = asyncio.get_event_loop().call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        """
+        Sends the pending assets as a batch.
+        """
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            asyncio.ensure_future(self._resolve(batch))
+
+    async def _resolve(self, batch):
+        """
+        Fetches a batch, and resolves the quotes of each asset.
+        :param batch: A dictionary of asset => future.
+        """
+
+        try:
+            quotes = await self.fetch_many(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for asset, future in batch.items():
+            if not future.done():
+                future.set_result(quotes.get(asset, (None, None)))
+
+
+class QuoteCache:
+    """
+    Caches the quotes of the assets, so the same asset is not fetched again while
+      its quote is fresh. Unknown assets are cached as well (for a different time).
+      Concurrent requests for the same asset share a single upstream fetch.
+    """
+
+    def __init__(self, fetch, ttl=QUOTE_TTL, negative_ttl=QUOTE_NEGATIVE_TTL, max_size=1000):
+        """
+        :param fetch: The upstream fetch: a coroutine function taking an asset, and returning
+          a (symbol, price) tuple, or (None, None) for unknown assets. Errors are not cached.
+        :param ttl: The time, in seconds, quotes are cached.
+        :param negative_ttl: The time, in seconds, unknown assets are cached.
+        :param max_size: The maximum amount of cached assets.
+        """
+
+        self.fetch = fetch
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._pending = {}
 
+    async def get(self, asset):
+        """
+        Gets the quote of an asset, from the cache or from upstream.
+        :param asset: The asset code to ask.
+        :return: A (symbol, price) tuple, or (None, None) if the asset is unknown.
+        """
 
-async def ask_stock(session, asset):
+        asset = asset.lower()
+        now = asyncio.get_event_loop().time()
+        entry = self._entries.get(asset)
+        if entry is not None:
+            expiration, quote = entry
+            if expiration > now:
+                return quote
+            del self._entries[asset]
+
+        future = self._pending.get(asset)
+        if future is None:
+            future = asyncio.ensure_future(self.fetch(asset))
+            future.add_done_callback(functools.partial(self._fetched, asset))
+            self._pending[asset] = future
+        # Shielded, so a cancelled request does not cancel the fetch for other requests.
+        return await asyncio.shield(future)
+
+    def _fetched(self, asset, future):
+        """
+        Caches the result of an upstream fetch, unless it failed.
+        :param asset: The asset code.
+        :param future: The finished fetch.
+        """
+
+        self._pending.pop(asset, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        quote = future.result()
+        ttl = self.ttl if quote[1] else self.negative_ttl
+        self._entries[asset] = (asyncio.get_event_loop().time() + ttl, quote)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+async def ask_stock(quotes, asset):
     """
-    Asks the price of a particular asset in stooq.
+    Asks the price of a particular asset.
+    :param quotes: The quote cache to ask to.
     :param asset: The assset code to ask
-    :return: Its price.
+    :return: A (symbol, price) tuple, or (None, None) if not found.
     """
 
-    url = 'https://stooq.com/q/l/?s=%s&f=sd2t2ohlcv&h&e=csv' % (urllib.parse.quote(asset.lower()),)
     try:
-        async with session.get(url) as response:
-            if response.status != 200:
-                print(">>> finbot: WARNING unexpected HTTP code %s for symbol %s" % (response.status_code, asset))
-                return None, None
-            else:
-                reader = csv.DictReader((await response.text()).split('\n'))
-                try:
-                    row = next(reader)
-                    if row['Close'] == 'N/D':
-                        print(">>> finbot: WARNING bad or unavailable stock symbol %s" % asset)
-                        return None, None
-                    return row['Symbol'], row['Close']
-                except StopIteration:
-                    print(">>> finbot: WARNING empty data for symbol %s" % asset)
-                    return None, None
+        return await quotes.get(asset)
     except Exception as e:
         print(">>> finbot: WARNING exception while trying to get data for symbol %s: %s, %s" % (asset, type(e).__name__, e.args))
         return None, None
 
-async def lifecycle(session, token, host, rooms):
+
+class Dispatcher:
+    """
+    Runs the commands in a bounded pool of workers, so a slow command does not
+      block the other ones (nor the reading of the websocket). Commands wait in
+      a bounded queue: when it is full, new commands are rejected right away.
+    """
+
+    def __init__(self, workers=WORKERS, queue_size=QUEUE_SIZE, timeout=COMMAND_TIMEOUT):
+        """
+        :param workers: The amount of concurrent workers.
+        :param queue_size: The maximum amount of commands waiting for a worker.
+        :param timeout: The time, in seconds, each command has to run.
+        """
+
+        self.workers = workers
+        self.timeout = timeout
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks = []
+        self._busy = 0
+        self._stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "completed": 0,
+            "timeouts": 0,
+            "errors": 0,
+            "max_queue_depth": 0,
+            "last_wait_time": 0.0,
+            "max_wait_time": 0.0,
+            "last_service_time": 0.0,
+            "max_service_time": 0.0,
+            "total_service_time": 0.0,
+        }
+        # The wait and service times, counted per latency bucket (the last one being +Inf).
+        self._latency_counts = {kind: [0] * (len(LATENCY_BUCKETS) + 1) for kind in ("wait", "service")}
+        self._latency_sums = {kind: 0.0 for kind in ("wait", "service")}
+
+    def stats(self):
+        """
+        :return: The dispatcher stats. Times are measured in seconds: the wait time goes
+          from the submission of a command to its start, and the service time from its
+          start to its end.
+        """
+
+        return dict(self._stats, queue_depth=self._queue.qsize(), busy_workers=self._busy)
+
+    def _observe(self, kind, value):
+        """
+        Counts a time in the latency histogram of its kind.
+        :param kind: Either "wait" or "service".
+        :param value: The time, in seconds.
+        """
+
+        self._latency_counts[kind][bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self._latency_sums[kind] += value
+
+    def latencies(self):
+        """
+        :return: A dict of kind => (cumulative bucket counts, sum) of the command times.
+        """
+
+        return {
+            kind: (list(itertools.accumulate(counts)), self._latency_sums[kind])
+            for kind, counts in self._latency_counts.items()
+        }
+
+    def start(self):
+        """
+        Starts the workers.
+        """
+
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    def stop(self):
+        """
+        Stops the workers. Pending commands are discarded.
+        """
+
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def submit(self, command, on_timeout=None):
+        """
+        Queues a command.
+        :param command: A coroutine function (with no arguments) to run.
+        :param on_timeout: An optional coroutine function (with no arguments) to run if
+          the command times out.
+        :return: Whether the command was queued, or False if the queue is full.
+        """
+
+        self._stats["submitted"] += 1
+        try:
+            self._queue.put_nowait((asyncio.get_event_loop().time(), command, on_timeout))
+        except asyncio.QueueFull:
+            self._stats["rejected"] += 1
+            return False
+        self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self._queue.qsize())
+        return True
+
+    async def _work(self):
+        """
+        Runs queued commands, one at a time.
+        """
+
+        loop = asyncio.get_event_loop()
+        while True:
+            submitted, command, on_timeout = await self._queue.get()
+            started = loop.time()
+            self._busy += 1
+            self._stats["last_wait_time"] = started - submitted
+            self._stats["max_wait_time"] = max(self._stats["max_wait_time"], started - submitted)
+            self._observe("wait", started - submitted)
+            try:
+                await asyncio.wait_for(command(), self.timeout)
+                self._stats["completed"] += 1
+            except asyncio.TimeoutError:
+                print(">>> finbot: WARNING a command timed out after %s seconds" % self.timeout)
+                self._stats["timeouts"] += 1
+                if on_timeout:
+                    await self._attempt(on_timeout)
+            except Exception as e:
+                print(">>> finbot: WARNING exception while running a command: %s, %s" % (type(e).__name__, e.args))
+                self._stats["errors"] += 1
+            self._busy -= 1
+            service_time = loop.time() - started
+            self._stats["last_service_time"] = service_time
+            self._stats["max_service_time"] = max(self._stats["max_service_time"], service_time)
+            self._stats["total_service_time"] += service_time
+            self._observe("service", service_time)
+
+    async def _attempt(self, callback):
+        """
+        Runs a callback, reporting (and otherwise ignoring) its errors.
+        :param callback: A coroutine function (with no arguments) to run.
+        """
+
+        try:
+            await callback()
+        except Exception as e:
+            print(">>> finbot: WARNING exception while running a callback: %s, %s" % (type(e).__name__, e.args))
+
+
+async def print_stats(dispatcher, interval=STATS_INTERVAL):
+    """
+    Prints the dispatcher stats periodically.
+    :param dispatcher: The dispatcher to print the stats of.
+    :param interval: The time, in seconds, between prints.
+    """
+
+    while True:
+        await asyncio.sleep(interval)
+        print(">>> finbot: Dispatcher stats: %s" % json.dumps(dispatcher.stats()))
+
+
+def render_metrics(dispatcher):
+    """
+    Renders the dispatcher stats and command latencies in the Prometheus text format.
+    :param dispatcher: The dispatcher to render the metrics of.
+    :return: The metrics text.
+    """
+
+    stats = dispatcher.stats()
+    lines = []
+    for name, key, kind in (("finbot_commands_submitted_total", "submitted", "counter"),
+                            ("finbot_commands_rejected_total", "rejected", "counter"),
+                            ("finbot_commands_completed_total", "completed", "counter"),
+                            ("finbot_commands_timeouts_total", "timeouts", "counter"),
+                            ("finbot_commands_errors_total", "errors", "counter"),
+                            ("finbot_queue_depth", "queue_depth", "gauge"),
+                            ("finbot_busy_workers", "busy_workers", "gauge")):
+        lines += ["# TYPE %s %s" % (name, kind), "%s %s" % (name, stats[key])]
+    for kind, (counts, total) in dispatcher.latencies().items():
+        name = "finbot_command_%s_seconds" % kind
+        lines.append("# TYPE %s histogram" % name)
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+            lines.append('%s_bucket{le="%s"} %d' % (name, bound, count))
+        lines += ["%s_sum %s" % (name, total), "%s_count %d" % (name, counts[-1])]
+    return "\n".join(lines) + "\n"
+
+
+async def serve_metrics(dispatcher, port=METRICS_PORT):
+    """
+    Serves the metrics at the /metrics path.
+    :param dispatcher: The dispatcher to serve the metrics of.
+    :param port: The port to listen at.
+    :return: The runner of the metrics server, to clean it up.
+    """
+
+    async def metrics(request):
+        return web.Response(text=render_metrics(dispatcher), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    print(">>> finbot: Serving metrics at port %d" % port)
+    return runner
+
+
+class HashRing:
+    """
+    A consistent hash ring of instances. Each room is owned by the first instance
+      found clockwise from the hash of its name, so adding or removing an instance
+      only moves the rooms of the affected ring segments.
+    """
+
+    def __init__(self, instances, replicas=100):
+        """
+        :param instances: The instance names.
+        :param replicas: The amount of virtual nodes per instance.
+        """
+
+        self.instances = sorted(set(instances))
+        self._ring = sorted((self._hash("%s#%d" % (instance, index)), instance)
+                            for instance in self.instances for index in range(replicas))
+        self._keys = [key for key, _ in self._ring]
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+    def owner(self, room_name):
+        """
+        :param room_name: The name of the room.
+        :return: The instance owning the room, or None if there are no instances.
+        """
+
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._keys, self._hash(room_name)) % len(self._ring)
+        return self._ring[index][1]
+
+
+class RedisMembership:
+    """
+    Tracks the fleet members in a Redis sorted set, scored by the moment each
+      membership expires.
+    """
+
+    def __init__(self, url, ttl=FLEET_TTL, key='finbot:fleet'):
+        """
+        :param url: A redis://[:password@]host:port/db address.
+        :param ttl: The time, in seconds, before a membership which is not renewed expires.
+        :param key: The key of the sorted set.
+        """
+
+        if aioredis is None:
+            raise RuntimeError("The aioredis library is required for a redis:// fleet")
+        self.url = url
+        self.ttl = ttl
+        self.key = key
+        self._redis = None
+
+    async def _get(self):
+        if self._redis is None:
+            self._redis = await aioredis.create_redis_pool(self.url, encoding='utf-8')
+        return self._redis
+
+    async def heartbeat(self, instance):
+        """
+        Registers, or renews, the membership of an instance.
+        :param instance: The instance name.
+        """
+
+        redis = await self._get()
+        await redis.zadd(self.key, time.time() + self.ttl, instance)
+
+    async def members(self):
+        """
+        :return: The names of the (not expired) instances.
+        """
+
+        redis = await self._get()
+        now = time.time()
+        transaction = redis.multi_exec()
+        transaction.zremrangebyscore(self.key, max=now)
+        members = transaction.zrangebyscore(self.key, min=now)
+        await transaction.execute()
+        return await members
+
+    async def leave(self, instance):
+        """
+        Removes the membership of an instance.
+        :param instance: The instance name.
+        """
+
+        redis = await self._get()
+        await redis.zrem(self.key, instance)
+
+
+class DirectoryMembership:
+    """
+    Tracks the fleet members as files in a directory shared by all the instances
+      (e.g. a mounted volume), one per instance, renewed by touching them. This is
+      a stand-in for Redis in local setups and tests.
+    """
+
+    def __init__(self, path, ttl=FLEET_TTL):
+        """
+        :param path: The directory path.
+        :param ttl: The time, in seconds, before a membership which is not renewed expires.
+        """
+
+        self.path = path
+        self.ttl = ttl
+        os.makedirs(path, exist_ok=True)
+
+    async def heartbeat(self, instance):
+        with open(os.path.join(self.path, instance), 'a'):
+            pass
+        os.utime(os.path.join(self.path, instance))
+
+    async def members(self):
+        now = time.time()
+        members = []
+        for entry in os.scandir(self.path):
+            try:
+                if entry.is_file() and entry.stat().st_mtime + self.ttl > now:
+                    members.append(entry.name)
+            except FileNotFoundError:
+                pass
+        return members
+
+    async def leave(self, instance):
+        try:
+            os.remove(os.path.join(self.path, instance))
+        except FileNotFoundError:
+            pass
+
+
+def make_membership(url):
+    """
+    Builds the fleet membership tracker for a FINBOT_FLEET url.
+    :param url: A redis:// url, or a file:// url of a directory.
+    :return: The membership tracker.
+    """
+
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme in ('redis', 'rediss'):
+        return RedisMembership(url)
+    elif parsed.scheme == 'file':
+        return DirectoryMembership(urllib.parse.unquote(parsed.path))
+    raise ValueError("Unsupported FINBOT_FLEET url: %s" % url)
+
+
+class Joins:
+    """
+    Tracks the rooms the bot must be in, and the ones it actually joined, as told by the server
+      replies. Syncing joins the rooms not joined yet (e.g. because their joins were rate-limited),
+      and parts the rooms not wanted anymore.
+    """
+
+    def __init__(self):
+        self.wanted = set()
+        self.joined = set()
+
+    async def sync(self, send, wanted=None):
+        """
+        Joins the wanted rooms not joined yet, and parts the joined rooms not wanted anymore.
+        :param send: The coroutine function to send a message with.
+        :param wanted: The names of the rooms to be in, if they changed.
+        """
+
+        if wanted is not None:
+            self.wanted = set(wanted)
+        for room_name in sorted(self.wanted - self.joined):
+            print(">>> finbot: joining room " + room_name)
+            await send({"type": "join", "room_name": room_name})
+        for room_name in sorted(self.joined - self.wanted):
+            print(">>> finbot: parting room " + room_name)
+            self.joined.discard(room_name)
+            await send({"type": "part", "room_name": room_name})
+
+    def receive(self, message):
+        """
+        Tracks a message from the server, if it is a reply to a join (or part).
+        :param message: The parsed message.
+        :return: Whether the message was a reply to a join (or part).
+        """
+
+        type_ = message.get('type')
+        code = message.get('code')
+        details = message.get('details') or {}
+        if type_ == 'room:notification' and code in ('joined', 'parted') and message.get('you'):
+            if code == 'joined':
+                self.joined.add(message.get('room_name'))
+            else:
+                self.joined.discard(message.get('room_name'))
+        elif type_ == 'error' and code == 'room:already-joined':
+            self.joined.add(details.get('name'))
+        elif type_ == 'error' and code == 'room:invalid':
+            print(">>> finbot: WARNING room %s does not exist" % (details.get('name'),))
+            self.wanted.discard(details.get('name'))
+        elif type_ == 'error' and code == 'rate-limited' and details.get('type') in ('join', 'part'):
+            print(">>> finbot: WARNING %s rate-limited for %ss. It will be attempted again" % (
+                details.get('type'), details.get('retry_after')
+            ))
+        else:
+            return False
+        return True
+
+
+class Fleet:
+    """
+    Splits the rooms among the fleet instances. Each instance periodically renews
+      its membership, lists the rooms, and joins the rooms it owns (in the hash
+      ring of the current members) while parting the rooms it does not own anymore.
+    """
+
+    def __init__(self, membership, instance, rooms=None, interval=FLEET_TTL / 3):
+        """
+        :param membership: The membership tracker.
+        :param instance: The name of this instance.
+        :param rooms: An optional list of room names to restrict the fleet to.
+        :param interval: The time, in seconds, between rebalances.
+        """
+
+        self.membership = membership
+        self.instance = instance
+        self.rooms = set(rooms or ())
+        self.interval = interval
+        self.ring = HashRing([instance])
+        self.owned = set()
+        self.joins = Joins()
+
+    def owns(self, room_name):
+        """
+        :param room_name: The name of the room.
+        :return: Whether this instance serves the room.
+        """
+
+        return room_name in self.owned
+
+    async def run(self, send):
+        """
+        Renews the membership and asks for the rooms, periodically. The rebalance
+          takes place when the list of rooms arrives.
+        :param send: The coroutine function to send a message with.
+        """
+
+        while True:
+            try:
+                await self.membership.heartbeat(self.instance)
+                members = await self.membership.members()
+                self.ring = HashRing(set(members) | {self.instance})
+                await send({"type": "list"})
+            except Exception as e:
+                print(">>> finbot: WARNING exception while updating the fleet: %s, %s" % (type(e).__name__, e.args))
+            await asyncio.sleep(self.interval)
+
+    async def rebalance(self, send, room_names):
+        """
+        Joins the owned rooms (also the ones whose joins failed before), and parts the rooms
+          not owned anymore.
+        :param send: The coroutine function to send a message with.
+        :param room_names: The names of the existing rooms.
+        """
+
+        if self.rooms:
+            room_names = [room_name for room_name in room_names if room_name in self.rooms]
+        self.owned = {room_name for room_name in room_names if self.ring.owner(room_name) == self.instance}
+        await self.joins.sync(send, self.owned)
+
+    async def leave(self):
+        """
+        Removes the membership of this instance, so the other instances take its rooms on
+          their next rebalance, instead of once the membership expires.
+        """
+
+        try:
+            await self.membership.leave(self.instance)
+            print(">>> finbot: Left the fleet")
+        except Exception as e:
+            print(">>> finbot: WARNING exception while leaving the fleet: %s, %s" % (type(e).__name__, e.args))
+
+
+def parse_assets(payload):
+    """
+    Parses the payload of a stock command: one or more comma-separated asset codes.
+    :param payload: The command payload.
+    :return: The distinct asset codes, in order, and up to FINBOT_MAX_SYMBOLS of them.
+    """
+
+    if not isinstance(payload, str):
+        return []
+    assets = []
+    for asset in payload.split(','):
+        asset = asset.strip()
+        if asset and asset.lower() not in (known.lower() for known in assets):
+            assets.append(asset)
+    return assets[:MAX_SYMBOLS]
+
+
+async def answer_stock(send, quotes, room_name, assets):
+    """
+    Answers a stock command, with one message per asset.
+    :param send: The coroutine function to send a message with.
+    :param quotes: The quote cache to ask to.
+    :param room_name: The room to answer to.
+    :param assets: The asset codes to ask.
+    """
+
+    results = await asyncio.gather(*(ask_stock(quotes, asset) for asset in assets))
+    for asset, (normalized_asset, price) in zip(assets, results):
+        if price:
+            print(">>> finbot: Parsed stooq data: %s %s" % (normalized_asset, price))
+            body = "%s quote is $%s per share" % (normalized_asset, price)
+        else:
+            print(">>> finbot: Stooq data not found for: %s" % (asset,))
+            body = "I could not find stock data for %s" % asset
+        await send({"type": "message", "room_name": room_name, "body": body})
+
+
+async def lifecycle(session, token, host, rooms, fleet=None):
     """
     The whole bot lifecycle in the websocket.
     :param token: The token to init the lifecycle with.
+    :param fleet: An optional fleet, to serve only the rooms this instance owns.
     """
 
     print(">>> finbot: Starting websocket connection.")
+    fleet_task = None
+    quotes = QuoteCache(QuoteBatcher(functools.partial(fetch_quotes, session)).fetch)
+    dispatcher = Dispatcher()
+    joins = fleet.joins if fleet else Joins()
     try:
         uri = "ws://%s/ws/chat/?token=%s" % (host, token)
 
         async with session.ws_connect(uri) as websocket:
+            # Workers answer concurrently, so the sends are serialized.
+            send_lock = asyncio.Lock()
+
+            async def send(payload):
+                async with send_lock:
+                    await websocket.send_str(dumps(payload))
+
             # Wait for the greeting.
             await asyncio.sleep(1)
             # Process the greeting (wait until a text/binary message).
@@ -113,42 +896,77 @@ async def lifecycle(session, token, host, rooms):
                 os._exit(1)
             # Process the connection to all the specified or available
             # rooms (according to the FINBOT_ROOMS environment variable).
-            await join_rooms(websocket, rooms)
-            # Process the lifecycle.
+            # In fleet mode, the rooms are joined by the fleet instead.
+            if fleet:
+                fleet_task = asyncio.ensure_future(fleet.run(send))
+            else:
+                await join_rooms(websocket, rooms, joins, send)
+                asyncio.ensure_future(retry_joins(joins, send))
+            # Process the lifecycle. Commands are attended by the
+            # dispatcher workers, so this loop keeps reading.
+            dispatcher.start()
+            if STATS_INTERVAL > 0:
+                asyncio.ensure_future(print_stats(dispatcher))
+            if METRICS_PORT:
+                await serve_metrics(dispatcher)
             async for message in websocket:
                 parsed = await parse(message)
                 if parsed:
                     type_ = parsed.get('type')
                     code = parsed.get('code')
-                    if type_ == 'room:notification' and code == 'custom':
+                    if joins.receive(parsed):
+                        pass
+                    elif type_ == 'error' and code == 'rate-limited':
+                        print(">>> finbot: WARNING rate-limited: %s. Is the bot account a staff one?" % (parsed,))
+                    elif fleet and type_ == 'notification' and code == 'list':
+                        await fleet.rebalance(send, [room['name'] for room in parsed.get('list') or []])
+                    elif fleet and type_ == 'room:notification' and not fleet.owns(parsed.get('room_name')):
+                        # Still joined while parting a room this instance does not own anymore.
+                        pass
+                    elif type_ == 'room:notification' and code == 'custom':
                         print(">>> finbot: Received a message: %s" % (parsed,))
                         custom = parsed.get('command')
                         if custom == 'stock':
                             room_name = parsed.get('room_name')
-                            asset = parsed.get('payload')
-                            if room_name and asset:
-                                print(">>> finbot: A stock message. Processing...")
-                                normalized_asset, price = await ask_stock(session, asset)
-                                if price:
-                                    print(">>> finbot: Parsed stooq data: %s %s" % (normalized_asset, price))
-                                    await websocket.send_str(json.dumps(
-                                        {"type": "message", "room_name": room_name,
-                                         "body": "%s quote is $%s per share" % (normalized_asset, price)}
-                                    ))
-                                else:
-                                    print(">>> finbot: Stooq data not found for: %s" % (asset,))
-                                    await websocket.send_str(json.dumps({"type": "message", "room_name": room_name,
-                                                                         "body": "I could not find stock data for %s" % asset}))
+                            assets = parse_assets(parsed.get('payload'))
+                            if room_name and assets:
+                                print(">>> finbot: A stock message. Queuing...")
+                                queued = dispatcher.submit(
+                                    functools.partial(answer_stock, send, quotes, room_name, assets),
+                                    functools.partial(send, {
+                                        "type": "message", "room_name": room_name,
+                                        "body": "I could not get stock data for %s in time" % ", ".join(assets)
+                                    })
+                                )
+                                if not queued:
+                                    print(">>> finbot: Too many pending commands. Rejecting.")
+                                    await send({"type": "message", "room_name": room_name,
+                                                "body": "I am busy right now. Please ask again later"})
                         else:
                             print(">>> finbot: I don't know about the command: %s" % custom)
     except Exception as e:
         print(">>> finbot: Aborting due to exception: %s, %s" % (type(e).__name__, e.args))
+        if fleet:
+            await fleet.leave()
         os._exit(1)
+    finally:
+        # Also on a clean shutdown (the bot being cancelled, or the websocket closed).
+        if fleet_task:
+            fleet_task.cancel()
+        if fleet:
+            await fleet.leave()
 
 
 async def bot():
     print(">>> finbot: Starting")
     host = os.environ.get('FINBOT_HOST', '') or 'localhost:8000'
+    rooms = os.getenv('FINBOT_ROOMS', '')
+    try:
+        fleet = Fleet(make_membership(FLEET), os.getenv('FINBOT_INSTANCE', '') or os.environ['FINBOT_USERNAME'],
+                      rooms.split(':') if rooms else None) if FLEET else None
+    except (KeyError, ValueError, RuntimeError) as e:
+        print(">>> finbot: Misconfigured fleet: %s. Terminating." % (e,))
+        os._exit(1)
     async with aiohttp.ClientSession() as session:
         try:
             async with session.post('http://%s/login' % host, json={
@@ -160,15 +978,26 @@ async def bot():
                     os._exit(1)
                 else:
                     print(">>> finbot: Successful login")
-                    await lifecycle(session, (await response.json())['token'], host, os.getenv('FINBOT_ROOMS', ''))
+                    await lifecycle(session, (await response.json())['token'], host, rooms, fleet)
         except KeyError:
             print(">>> finbot: Misconfigured. Environment variables "
                   "FINBOT_USERNAME and FINBOT_PASSWORD are required. Terminating.")
             os._exit(1)
+        except asyncio.CancelledError:
+            raise
         except:
             print(">>> finbot: Network error while trying to hit the /login url. Terminating.")
             os._exit(1)
 
 
 if __name__ == '__main__':
-    asyncio.get_event_loop().run_until_complete(bot())
+    loop = asyncio.get_event_loop()
+    main = asyncio.ensure_future(bot())
+    # On SIGINT or SIGTERM (e.g. docker stop), the bot is cancelled,
+    # so it shuts down cleanly (e.g. leaving the fleet).
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, main.cancel)
+    try:
+        loop.run_until_complete(main)
+    except asyncio.CancelledError:
+        print(">>> finbot: Terminated.")
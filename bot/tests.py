@@ -0,0 +1,334 @@
+import asyncio
+import functools
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import bot
+from bot import Joins, Fleet, HashRing, DirectoryMembership, QuoteCache, QuoteBatcher, Dispatcher, fetch_quotes, \
+    parse_assets
+
+
+def make_sender():
+    """
+    Creates a send coroutine function which keeps the sent messages.
+    :return: A (send, sent messages) tuple.
+    """
+
+    sent = []
+
+    async def send(payload):
+        sent.append(payload)
+
+    return send, sent
+
+
+@pytest.mark.asyncio
+async def test_fleet_joins():
+    """
+    Tests that only the rooms whose joins succeeded are considered joined,
+      and that the failed joins are attempted again on each rebalance.
+    """
+
+    send, sent = make_sender()
+    fleet = Fleet(None, 'finbot')
+    await fleet.rebalance(send, ['forex', 'friends'])
+    assert fleet.owned == {'forex', 'friends'}
+    assert sent == [{"type": "join", "room_name": "forex"}, {"type": "join", "room_name": "friends"}]
+    # The first join succeeds, and the second one is rate-limited.
+    assert fleet.joins.receive({"type": "room:notification", "code": "joined", "you": True, "user": "finbot",
+                                "room_name": "forex"})
+    assert fleet.joins.receive({"type": "error", "code": "rate-limited",
+                                "details": {"type": "join", "retry_after": 3.0}})
+    assert fleet.joins.joined == {'forex'}
+    # Other users joining, or other commands being limited, are not replies to the joins.
+    assert not fleet.joins.receive({"type": "room:notification", "code": "joined", "you": False, "user": "alice",
+                                    "room_name": "forex"})
+    assert not fleet.joins.receive({"type": "error", "code": "rate-limited",
+                                    "details": {"type": "message", "retry_after": 3.0}})
+    sent.clear()
+    await fleet.rebalance(send, ['forex', 'friends'])
+    assert sent == [{"type": "join", "room_name": "friends"}]
+    # A room already joined counts as joined.
+    assert fleet.joins.receive({"type": "error", "code": "room:already-joined", "details": {"name": "friends"}})
+    sent.clear()
+    await fleet.rebalance(send, ['forex', 'friends'])
+    assert sent == []
+    # Rooms not existing anymore are parted.
+    await fleet.rebalance(send, ['friends'])
+    assert sent == [{"type": "part", "room_name": "forex"}]
+    assert fleet.joins.joined == {'friends'}
+
+
+@pytest.mark.asyncio
+async def test_joins_invalid_rooms():
+    """
+    Tests that invalid rooms are not attempted again.
+    """
+
+    send, sent = make_sender()
+    joins = Joins()
+    await joins.sync(send, ['nowhere'])
+    assert joins.receive({"type": "error", "code": "room:invalid", "details": {"name": "nowhere"}})
+    sent.clear()
+    await joins.sync(send)
+    assert sent == []
+    assert joins.joined == set()
+
+
+class FakeUpstream:
+    """
+    A local stand-in for the quotes upstream, counting the fetches.
+    """
+
+    def __init__(self, prices, delay=0.0, error=None):
+        """
+        :param prices: A dictionary of asset => price, for the known assets.
+        :param delay: The time, in seconds, each fetch takes.
+        :param error: An optional exception to raise on each fetch.
+        """
+
+        self.prices = prices
+        self.delay = delay
+        self.error = error
+        self.calls = []
+
+    async def fetch(self, asset):
+        self.calls.append(asset)
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        price = self.prices.get(asset)
+        return (asset.upper(), price) if price else (None, None)
+
+
+@pytest.mark.asyncio
+async def test_quote_cache_ttl():
+    """
+    Tests that the quotes are cached for their TTL, and the unknown assets
+      for their own (negative) TTL.
+    """
+
+    upstream = FakeUpstream({'aapl.us': '120.5'})
+    quotes = QuoteCache(upstream.fetch, ttl=0.2, negative_ttl=0.4)
+    assert await quotes.get('AAPL.US') == ('AAPL.US', '120.5')
+    assert await quotes.get('aapl.us') == ('AAPL.US', '120.5')
+    assert await quotes.get('nope') == (None, None)
+    assert await quotes.get('nope') == (None, None)
+    assert upstream.calls == ['aapl.us', 'nope']
+    # The quote expires, but the unknown asset does not yet.
+    await asyncio.sleep(0.3)
+    assert await quotes.get('aapl.us') == ('AAPL.US', '120.5')
+    assert await quotes.get('nope') == (None, None)
+    assert upstream.calls == ['aapl.us', 'nope', 'aapl.us']
+    await asyncio.sleep(0.2)
+    assert await quotes.get('nope') == (None, None)
+    assert upstream.calls == ['aapl.us', 'nope', 'aapl.us', 'nope']
+
+
+@pytest.mark.asyncio
+async def test_quote_cache_coalescing():
+    """
+    Tests that concurrent requests for the same asset share a single fetch,
+      that failed fetches are not cached, and that the cache is bounded.
+    """
+
+    upstream = FakeUpstream({'aapl.us': '120.5', 'msft.us': '210.1'}, delay=0.1)
+    quotes = QuoteCache(upstream.fetch, ttl=60, negative_ttl=60, max_size=1)
+    results = await asyncio.gather(*(quotes.get(asset) for asset in ['aapl.us', 'AAPL.US', 'aapl.us', 'msft.us']))
+    assert results == [('AAPL.US', '120.5')] * 3 + [('MSFT.US', '210.1')]
+    assert sorted(upstream.calls) == ['aapl.us', 'msft.us']
+    # Only the latest asset is kept.
+    await quotes.get('msft.us')
+    await quotes.get('aapl.us')
+    assert upstream.calls.count('aapl.us') == 2
+    assert upstream.calls.count('msft.us') == 1
+    # Errors are told to all the concurrent requests, and not cached.
+    failing = QuoteCache(FakeUpstream({}, delay=0.1, error=RuntimeError("down")).fetch)
+    results = await asyncio.gather(failing.get('aapl.us'), failing.get('aapl.us'), return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
+    failing.fetch = upstream.fetch
+    assert await failing.get('aapl.us') == ('AAPL.US', '120.5')
+
+
+@pytest.mark.asyncio
+async def test_quote_batcher():
+    """
+    Tests that the assets asked within the window are fetched together, in
+      batches of up to the maximum size, and each asker gets its own quote.
+    """
+
+    batches = []
+
+    async def fetch_many(assets):
+        batches.append(assets)
+        return {asset: (asset.upper(), '1.5') for asset in assets if asset != 'nope'}
+
+    batcher = QuoteBatcher(fetch_many, window=0.05, max_size=3)
+    results = await asyncio.gather(*(batcher.fetch(asset) for asset in ['a.us', 'b.us', 'a.us', 'c.us', 'nope']))
+    assert results == [('A.US', '1.5'), ('B.US', '1.5'), ('A.US', '1.5'), ('C.US', '1.5'), (None, None)]
+    # The first batch is sent when full, and the second one when the window elapses.
+    assert batches == [['a.us', 'b.us', 'c.us'], ['nope']]
+    # Errors are told to all the askers of the batch.
+
+    async def failing(assets):
+        raise RuntimeError("down")
+
+    batcher = QuoteBatcher(failing, window=0.05, max_size=3)
+    results = await asyncio.gather(batcher.fetch('a.us'), batcher.fetch('b.us'), return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+@pytest.mark.asyncio
+async def test_fetch_quotes(monkeypatch):
+    """
+    Tests that the rows of a batched stooq answer are matched to the asked
+      assets: by symbol, by position when the symbol comes back in another
+      notation (unless that row belongs to another asset), and as unknown
+      when there is no data.
+    """
+
+    requests = []
+
+    async def quotes(request):
+        requests.append(request.query['s'])
+        return web.Response(text="Symbol,Date,Time,Open,High,Low,Close,Volume\r\n"
+                                 "MSFT.US,2020-10-16,22:00:12,220,222,219,219.66,32775919\r\n"
+                                 "AAPL.US,2020-10-16,22:00:09,121,121.5,118.8,119.02,115393808\r\n"
+                                 "NOPE,N/D,N/D,N/D,N/D,N/D,N/D,N/D\r\n")
+
+    app = web.Application()
+    app.router.add_get('/q/l/', quotes)
+    async with TestServer(app) as server, aiohttp.ClientSession() as session:
+        monkeypatch.setattr(bot, 'STOOQ_URL', str(server.make_url('')).rstrip('/'))
+        assert await fetch_quotes(session, ['aapl.us', 'MSFT.US', 'nope']) == {
+            'aapl.us': ('AAPL.US', '119.02'), 'MSFT.US': ('MSFT.US', '219.66'), 'nope': (None, None)
+        }
+        # As many rows as assets: the unmatched ones are matched by position.
+        assert (await fetch_quotes(session, ['msft', 'aapl', 'other']))['aapl'] == ('AAPL.US', '119.02')
+        # But never to a row matched by symbol to another asset.
+        assert await fetch_quotes(session, ['aapl.us', 'msft', 'other']) == {
+            'aapl.us': ('AAPL.US', '119.02'), 'msft': (None, None), 'other': (None, None)
+        }
+    assert requests == ['aapl.us msft.us nope', 'msft aapl other', 'aapl.us msft other']
+
+
+def test_parse_assets():
+    """
+    Tests the parsing of the stock command payloads.
+    """
+
+    assert parse_assets('aapl.us, MSFT.US,,aapl.US') == ['aapl.us', 'MSFT.US']
+    assert parse_assets(None) == []
+    assert len(parse_assets(','.join('s%d' % index for index in range(50)))) == bot.MAX_SYMBOLS
+
+
+@pytest.mark.asyncio
+async def test_dispatcher():
+    """
+    Tests that the dispatcher runs the commands concurrently, rejects them when
+      its queue is full, and tells when they time out or fail.
+    """
+
+    dispatcher = Dispatcher(workers=2, queue_size=1, timeout=0.2)
+    done = []
+    release = asyncio.Event()
+
+    async def blocked(name):
+        await release.wait()
+        done.append(name)
+
+    # Before starting, only one command fits in the queue.
+    assert dispatcher.submit(functools.partial(blocked, 'first'))
+    assert not dispatcher.submit(functools.partial(blocked, 'rejected'))
+    dispatcher.start()
+    await asyncio.sleep(0.01)
+    # Both workers are busy, and the queue holds one more command.
+    assert dispatcher.submit(functools.partial(blocked, 'second'))
+    await asyncio.sleep(0.01)
+    assert dispatcher.submit(functools.partial(blocked, 'third'))
+    assert not dispatcher.submit(functools.partial(blocked, 'rejected'))
+    assert dispatcher.stats()['busy_workers'] == 2
+    release.set()
+    await asyncio.sleep(0.05)
+    assert done == ['first', 'second', 'third']
+
+    timed_out = []
+
+    async def slow():
+        await asyncio.sleep(1)
+
+    async def failing():
+        raise RuntimeError("broken")
+
+    async def tell():
+        timed_out.append('told')
+
+    for command, on_timeout in [(slow, tell), (failing, None), (slow, None)]:
+        assert dispatcher.submit(command, on_timeout)
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.5)
+    dispatcher.stop()
+    stats = dispatcher.stats()
+    assert timed_out == ['told']
+    assert stats['submitted'] == 8
+    assert stats['rejected'] == 2
+    assert stats['completed'] == 3
+    assert stats['timeouts'] == 2
+    assert stats['errors'] == 1
+    wait_counts, _ = dispatcher.latencies()['wait']
+    assert wait_counts[-1] == 6
+
+
+def test_hash_ring():
+    """
+    Tests that each room is owned by a single instance, regardless of the
+      order of the instances, and that adding an instance only moves some
+      rooms, all of them to the new instance.
+    """
+
+    rooms = ['room-%d' % index for index in range(200)]
+    ring = HashRing(['finbot-1', 'finbot-2', 'finbot-3'])
+    owners = {room: ring.owner(room) for room in rooms}
+    assert set(owners.values()) == {'finbot-1', 'finbot-2', 'finbot-3'}
+    assert owners == {room: HashRing(['finbot-3', 'finbot-1', 'finbot-2']).owner(room) for room in rooms}
+    bigger = HashRing(['finbot-1', 'finbot-2', 'finbot-3', 'finbot-4'])
+    moved = [room for room in rooms if bigger.owner(room) != owners[room]]
+    assert 0 < len(moved) < len(rooms) / 2
+    assert all(bigger.owner(room) == 'finbot-4' for room in moved)
+    assert HashRing([]).owner('room-0') is None
+
+
+@pytest.mark.asyncio
+async def test_fleet_rebalance(tmp_path):
+    """
+    Tests that the fleet instances split the rooms among them, and that the
+      rooms of an instance leaving are taken by the others right away.
+    """
+
+    membership = DirectoryMembership(str(tmp_path), ttl=60)
+    rooms = ['room-%d' % index for index in range(20)]
+    fleets = [Fleet(membership, 'finbot-1', interval=0.02), Fleet(membership, 'finbot-2', interval=0.02)]
+    senders = [make_sender() for _ in fleets]
+    tasks = [asyncio.ensure_future(fleet.run(send)) for fleet, (send, _) in zip(fleets, senders)]
+    await asyncio.sleep(0.1)
+    for fleet, (send, sent) in zip(fleets, senders):
+        assert {"type": "list"} in sent
+        await fleet.rebalance(send, rooms)
+        for room in fleet.owned:
+            fleet.joins.receive({"type": "room:notification", "code": "joined", "you": True, "room_name": room})
+    first, second = fleets[0].owned, fleets[1].owned
+    assert first and second
+    assert first | second == set(rooms)
+    assert not first & second
+    # The second instance leaves: the first one takes its rooms
+    # on its next rebalance, without waiting for the TTL.
+    tasks[1].cancel()
+    await fleets[1].leave()
+    await asyncio.sleep(0.1)
+    send, sent = senders[0]
+    sent.clear()
+    await fleets[0].rebalance(send, rooms)
+    assert fleets[0].owned == set(rooms)
+    assert sent == [{"type": "join", "room_name": room} for room in sorted(second)]
+    tasks[0].cancel()